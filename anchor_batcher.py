@@ -0,0 +1,183 @@
+import concurrent.futures
+import json
+import logging
+import re
+import threading
+from collections import Counter, deque
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from openai import OpenAI
+
+from config import ANCHOR_BATCH_CONCURRENCY, ANCHOR_BATCH_SIZE, ANCHOR_MODEL_NAME
+from helpers import generate_batch_anchor_prompt
+from job_ledger import get_job_ledger
+from json_repair import repair_json
+from llm import chat_completion
+from nodes import (anchor_before_conversion, anchor_excerpt, apply_early_anchor_response, check_duplicate, finalize,
+                   save_skipped_component)
+
+logger = logging.getLogger(__name__)
+
+
+class AnchorBatcher:
+    """
+    Classifies queued documents in the main process, several per anchor request.
+
+    Every anchor request repeats the same long instruction block for a short excerpt,
+    so `iter_anchored` packs the text-layer excerpts of up to `batch_size` queued
+    documents into one request whose answer is keyed by document. Documents missing
+    from the answer, or all of them if it can't be parsed, are classified with
+    single-document requests. Duplicates of extracted documents (`check_duplicate`)
+    are finalized before any request, and skipped components are recorded right here;
+    neither reaches a worker. The anchor fields of the others are handed to the
+    workers with `pop_anchor`, so the graph does not classify them again. Documents
+    without a usable text layer are passed through and classified after their
+    conversion.
+
+    Batches are classified by up to `concurrency` background threads, so the
+    duplicate checks and anchor requests of the next batches overlap with the
+    submission of the documents already classified.
+    """
+
+    def __init__(self, client=None, model_name: str = ANCHOR_MODEL_NAME, batch_size: int = ANCHOR_BATCH_SIZE,
+                 concurrency: int = ANCHOR_BATCH_CONCURRENCY):
+        self.client = client or OpenAI()
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        # Anchor and duplicate-check fields of queued documents, until a worker picks them up.
+        self.anchors: Dict[str, Dict[str, Any]] = {}
+        self.stats: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def iter_anchored(self, pdfs: Iterable[Path]) -> Iterator[Path]:
+        """
+        Classifies the PDFs batch by batch and yields those that are not skipped.
+
+        Args:
+            pdfs (Iterable[Path]): The PDFs to process, consumed lazily.
+
+        Yields:
+            Path: The PDFs to hand to the workers, in their original order.
+        """
+        pending: Deque[Tuple[List[Path], concurrent.futures.Future]] = deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency,
+                                                   thread_name_prefix="anchor-batch") as executor:
+            batch: List[Path] = []
+            for pdf in pdfs:
+                batch.append(pdf)
+                if len(batch) < self.batch_size:
+                    continue
+                pending.append((batch, executor.submit(self._classify, batch)))
+                batch = []
+                # Hand out finished batches right away, and wait once `concurrency` are in flight.
+                while pending and (pending[0][1].done() or len(pending) > self.concurrency):
+                    yield from self._result(*pending.popleft())
+            if batch:
+                pending.append((batch, executor.submit(self._classify, batch)))
+            while pending:
+                yield from self._result(*pending.popleft())
+
+    def pop_anchor(self, pdf_name: str) -> Optional[Dict[str, Any]]:
+        """Returns (and forgets) the anchor fields of a classified document, if any."""
+        with self._lock:
+            return self.anchors.pop(pdf_name, None)
+
+    def report(self):
+        """Logs how many documents were classified with how many requests."""
+        if self.stats["documents"]:
+            logger.info(
+                f"Batched anchor: {self.stats['documents']} document(s) classified with {self.stats['requests']} "
+                f"request(s), {self.stats['fallbacks']} of them alone; {self.stats['skipped']} skipped before conversion."
+            )
+
+    @staticmethod
+    def _result(batch: List[Path], future: concurrent.futures.Future) -> List[Path]:
+        try:
+            return future.result()
+        except Exception as e:
+            # The workers classify the documents themselves.
+            logger.warning(f"Batched anchor failed for {len(batch)} document(s): {e}")
+            return batch
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _classify(self, batch: List[Path]) -> List[Path]:
+        base_states = {}
+        states = {}
+        excerpts = {}
+        finished = set()
+        for pdf in batch:
+            base_states[pdf.name] = {"pdf_path": str(pdf), "title": pdf.stem, "anchor_model_name": self.model_name,
+                                     "client_anchor": self.client}
+            try:
+                state = check_duplicate(base_states[pdf.name])
+                if state.get("duplicate_of"):
+                    get_job_ledger().start(pdf)
+                    finalize(state)
+                    finished.add(pdf.name)
+                    continue
+                self._keep(state, base_states[pdf.name])
+                excerpt = anchor_excerpt(state)
+            except Exception as e:
+                logger.warning(f"Could not prepare the anchor excerpt of {pdf.name}: {e}")
+                excerpt = ""
+            if excerpt:
+                key = str(len(excerpts) + 1)
+                states[key] = state
+                excerpts[key] = excerpt
+
+        answers = self._request_batch(excerpts) if len(excerpts) > 1 else {}
+        for key, state in states.items():
+            try:
+                if key in answers:
+                    anchored = apply_early_anchor_response(state, json.dumps([answers[key]]))
+                else:
+                    self._count("requests")
+                    self._count("fallbacks")
+                    anchored = anchor_before_conversion(state)
+            except Exception as e:
+                # The worker classifies the document itself.
+                logger.warning(f"Batched anchor failed for {Path(state['pdf_path']).name}: {e}")
+                continue
+            self._count("documents")
+            pdf = Path(state["pdf_path"])
+            if anchored.get("skip_reason"):
+                self._count("skipped")
+                finished.add(pdf.name)
+                get_job_ledger().start(pdf)
+                save_skipped_component(anchored)
+            else:
+                self._keep(anchored, base_states[pdf.name])
+        return [pdf for pdf in batch if pdf.name not in finished]
+
+    def _keep(self, state: Dict[str, Any], base_state: Dict[str, Any]):
+        """Keeps the fields the main process added to a document's state for its worker."""
+        fields = {k: v for k, v in state.items() if k not in base_state}
+        if fields:
+            with self._lock:
+                self.anchors[Path(state["pdf_path"]).name] = fields
+
+    def _request_batch(self, excerpts: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+        """Sends one anchor request for several excerpts and returns the answers by key."""
+        messages = [
+            {"role": "system", "content": "You are an information extraction assistant."},
+            {"role": "user", "content": generate_batch_anchor_prompt(excerpts)}
+        ]
+        self._count("requests")
+        try:
+            raw = chat_completion(self.client, self.model_name, messages)
+        except Exception as e:
+            logger.warning(f"Batched anchor request for {len(excerpts)} documents failed: {e}")
+            return {}
+        data, _ = repair_json(re.sub(r"<think>.*?</think>", "", raw, flags=re.DOTALL))
+        if not isinstance(data, dict):
+            logger.warning(f"Could not parse the batched anchor answer for {len(excerpts)} documents.")
+            return {}
+        answers = {key: data[key] for key in excerpts if isinstance(data.get(key), dict)}
+        if len(answers) < len(excerpts):
+            logger.info(f"Batched anchor answered {len(answers)} of {len(excerpts)} documents; classifying the rest alone.")
+        return answers
@@ -0,0 +1,131 @@
+"""
+Micro-benchmark: per-chunk `score_chunk` (as it was) vs. the single-pass `ChunkScorer`.
+
+Builds a large synthetic datasheet markdown (or reads one with --markdown), splits it
+into chunks, checks that both implementations give identical scores and reports the
+timings. By default it runs a short component list, the common case (substring
+search per name), and a long one that takes the trie path (TRIE_MIN_COMPONENTS names
+or more).
+
+    python benchmarks/bench_scoring.py --pages 2000 --components 1000
+    python benchmarks/bench_scoring.py --markdown conversion_cache/<key>/document-with-image-refs.md
+"""
+import argparse
+import random
+import re
+import string
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scoring import TRIE_MIN_COMPONENTS, ChunkScorer  # noqa: E402
+
+
+def legacy_score_chunk(chunk: str, components: list, title: str):
+    """`helpers.score_chunk` before the multi-pattern scorer, kept verbatim for comparison."""
+    score = 0
+    chunk_lower = chunk.lower()
+
+    KEYWORD_PATTERN = re.compile(
+    r"\b("
+    r"part( numbers?)?|"
+    r"type numbers?|"
+    r"ordering|"
+    r"markings?|"
+    r"package options?|"
+    r"product series|"
+    r"packages?"
+    r")\b",
+    re.IGNORECASE
+    )
+    if len(title) >= 5:
+        title_prefix = title[:5].lower()
+        score += chunk_lower.count(title_prefix)*0.5
+    if components:
+        score += sum(1 for m in components if m.lower() in chunk_lower)
+    keyword_matches = KEYWORD_PATTERN.findall(chunk)
+    score += len(keyword_matches)
+
+    return score
+
+
+def random_mpn(rng: random.Random) -> str:
+    prefix = "".join(rng.choices(string.ascii_uppercase, k=rng.randint(2, 4)))
+    body = "".join(rng.choices(string.digits, k=rng.randint(3, 6)))
+    suffix = "".join(rng.choices(string.ascii_uppercase + string.digits + "-", k=rng.randint(0, 5)))
+    return prefix + body + suffix
+
+
+def synthetic_document(rng: random.Random, pages: int, mpns: list) -> list:
+    words = ("voltage current rating package marking ordering information part number type numbers "
+             "thermal resistance typical maximum minimum temperature product series tape reel").split()
+    chunks = []
+    for _ in range(pages):
+        lines = [f"## {' '.join(rng.choices(words, k=4)).title()}"]
+        for _ in range(rng.randint(10, 40)):
+            if rng.random() < 0.3:
+                lines.append(f"| {rng.choice(mpns)} | {rng.choice(words)} | {rng.randint(1, 999)} |")
+            else:
+                lines.append(" ".join(rng.choices(words, k=rng.randint(6, 18))))
+        chunks.append("\n".join(lines))
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=500, help="Chunks in the synthetic document.")
+    parser.add_argument("--components", type=int, nargs="+", default=[20, 1000],
+                        help="Component names to generate, one run per value.")
+    parser.add_argument("--markdown", type=Path, help="Score this markdown file instead (split on blank lines).")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for count in args.components:
+        run(args, count)
+
+
+def run(args, count: int):
+    rng = random.Random(args.seed)
+    mpns = [random_mpn(rng) for _ in range(count)]
+    # Include names that are prefixes of each other and differ only in case.
+    components = mpns[: count // 2] + [m[:-2] for m in mpns[:10] if len(m) > 4] + [m.lower() for m in mpns[:5]]
+    title = mpns[0] + "_Manufacturer_123_datasheet"
+    if args.markdown:
+        chunks = [c for c in args.markdown.read_text(encoding="utf-8").split("\n\n") if c.strip()]
+    else:
+        chunks = synthetic_document(rng, args.pages, mpns)
+
+    size_kb = sum(len(c) for c in chunks) / 1024
+    names = len({c.lower() for c in components if c})
+    path = "trie" if names >= TRIE_MIN_COMPONENTS else "substring"
+    print(f"\n{len(chunks)} chunks, {size_kb:.0f} KiB, {names} distinct component names ({path} path)")
+
+    def best_of(fn):
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+        return best, result
+
+    legacy_time, legacy = best_of(lambda: [legacy_score_chunk(c, components, title) for c in chunks])
+    compile_time, scorer = best_of(lambda: ChunkScorer(components, title))
+    new_time, new = best_of(lambda: scorer.score_all(chunks))
+
+    mismatches = [(i, a, b) for i, (a, b) in enumerate(zip(legacy, new)) if a != b or type(a) is not type(b)]
+    if mismatches:
+        print(f"MISMATCH in {len(mismatches)} chunks, e.g. {mismatches[:5]}")
+        sys.exit(1)
+    # `get_scorer` reuses the compiled scorer across calls with the same components.
+    print(f"legacy score_chunk per chunk: {legacy_time * 1000:8.1f} ms")
+    print(f"ChunkScorer compile:          {compile_time * 1000:8.1f} ms")
+    print(f"ChunkScorer.score_all:        {new_time * 1000:8.1f} ms")
+    print(f"speedup: {legacy_time / new_time:.1f}x, {legacy_time / (compile_time + new_time):.1f}x incl. compile, "
+          f"scores identical")
+
+
+if __name__ == "__main__":
+    main()
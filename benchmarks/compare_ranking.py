@@ -0,0 +1,109 @@
+"""
+Offline comparison of the chunk rankings of `filter_chunks`: "keywords" vs. "bm25".
+
+Every document in extracted_items.csv with saved metadata (metadata/<stem>_metadata.json
+holds its chunks, anchor components and title) is ranked both ways and packed into the
+token budget of --model, exactly as `filter_chunks` does. Reported per ranking:
+
+    recall  share of the document's extracted MPNs found in the selected chunks
+    mrr     mean reciprocal rank of the first chunk that contains one of them
+    tokens  mean tokens packed into the extraction input
+
+The extracted MPNs were found in keyword-selected chunks, so the comparison is biased
+towards "keywords"; a gain for "bm25" is therefore conservative.
+
+    python benchmarks/compare_ranking.py
+    python benchmarks/compare_ranking.py --model llama-3.1-8b-instant --details
+"""
+import argparse
+import csv
+import json
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import CSV_OUTPUT, METADATA_DIR, MODEL_NAME  # noqa: E402
+from helpers import normalize_components, select_chunks  # noqa: E402
+
+RANKINGS = ("keywords", "bm25")
+
+
+def load_extracted_mpns(items_path: Path) -> dict:
+    """Returns the lowercased MPNs extracted from every source PDF."""
+    mpns = defaultdict(set)
+    with open(items_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            mpn = (row.get("mpn") or "").strip().lower()
+            if mpn and row.get("source"):
+                mpns[row["source"]].add(mpn)
+    return mpns
+
+
+def load_metadata(path: Path) -> dict:
+    metadata = json.loads(path.read_text(encoding="utf-8"))
+    # `save_full_state` stores lists as JSON strings.
+    chunks = metadata.get("chunks") or "[]"
+    return {
+        "chunks": json.loads(chunks) if isinstance(chunks, str) else chunks,
+        "components": normalize_components(metadata.get("component", "[]")),
+        "title": metadata.get("title") or path.name[: -len("_metadata.json")],
+    }
+
+
+def evaluate(chunks: list, components: list, title: str, mpns: set, model: str, ranking: str) -> dict:
+    scores, selected, budget = select_chunks(chunks, components, title, model, ranking=ranking)
+    selected_text = "\n".join(chunks[i] for i in selected).lower()
+    ranked = sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True)
+    first_hit = next((rank for rank, i in enumerate(ranked, 1) if any(m in chunks[i].lower() for m in mpns)), None)
+    return {
+        "recall": sum(1 for m in mpns if m in selected_text) / len(mpns),
+        "rr": 1 / first_hit if first_hit else 0.0,
+        "tokens": budget["used_tokens"],
+        "selected": len(selected),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=Path, default=CSV_OUTPUT, help="CSV of extracted items (mpn, source).")
+    parser.add_argument("--metadata", type=Path, default=METADATA_DIR, help="Directory of *_metadata.json files.")
+    parser.add_argument("--model", default=MODEL_NAME, help="Model whose token budget is used.")
+    parser.add_argument("--details", action="store_true", help="Print the result of every document.")
+    args = parser.parse_args()
+
+    extracted = load_extracted_mpns(args.items)
+    results = {ranking: [] for ranking in RANKINGS}
+    missing = 0
+    for source, mpns in sorted(extracted.items()):
+        metadata_path = args.metadata / f"{Path(source).stem}_metadata.json"
+        if not metadata_path.exists():
+            missing += 1
+            continue
+        document = load_metadata(metadata_path)
+        if not document["chunks"]:
+            continue
+        row = {}
+        for ranking in RANKINGS:
+            row[ranking] = evaluate(document["chunks"], document["components"], document["title"], mpns,
+                                    args.model, ranking)
+            results[ranking].append(row[ranking])
+        if args.details:
+            print(f"{source}: " + "  ".join(
+                f"{r} recall={row[r]['recall']:.2f} rr={row[r]['rr']:.2f} chunks={row[r]['selected']}" for r in RANKINGS
+            ))
+
+    count = len(results[RANKINGS[0]])
+    print(f"{count} documents compared ({missing} without metadata), budget of {args.model}")
+    if not count:
+        return
+    print(f"{'ranking':10} {'recall':>8} {'mrr':>8} {'tokens':>8} {'full recall':>12}")
+    for ranking in RANKINGS:
+        rows = results[ranking]
+        print(f"{ranking:10} {sum(r['recall'] for r in rows) / count:8.3f} {sum(r['rr'] for r in rows) / count:8.3f} "
+              f"{sum(r['tokens'] for r in rows) / count:8.0f} {sum(r['recall'] == 1 for r in rows):12d}")
+
+
+if __name__ == "__main__":
+    main()
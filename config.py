@@ -1,13 +1,33 @@
+import os
+import socket
 from pathlib import Path
 
 # --- Directories ---
 DOCUMENTS_DIR = Path("documents")
 MARKDOWN_DIR = Path("markdown")
+CONVERSION_CACHE_DIR = Path("conversion_cache")  # Docling output stored once per PDF content + converter options
 PROCESSED_DIR = Path("processed")
 SKIPPED_DIR = Path("skipped")
 FAILED_DIR = Path("failed")
 SKIPPED_LARGE_FILES_DIR = Path("skipped_large_files")
 METADATA_DIR = Path("metadata")
+STATE_DIR = Path("state")  # Shared run state (SQLite databases) used by all workers
+
+# --- Conversion ---
+# "always": OCR every page (the original behaviour).
+# "auto":   probe each page's embedded text layer and only OCR pages without one;
+#           falls back to full OCR when the text-layer result contains no tables.
+OCR_MODE = "auto"
+TEXT_LAYER_MIN_CHARS = 50  # Pages with fewer text-layer characters are OCR'd
+# Long documents are triaged from their text layer and only the best pages are converted
+PAGE_TRIAGE_ENABLED = True
+PAGE_TRIAGE_MIN_PAGES = 12  # Documents with at most this many pages are converted whole
+PAGE_TRIAGE_LEAD_PAGES = 2  # Leading pages always kept (anchor excerpt)
+PAGE_TRIAGE_TOP_PAGES = 8  # Best scoring pages kept in addition to the lead pages
+# "background": table and picture PNGs are cropped and encoded by a writer thread, off the critical path.
+# "off":        no page/picture images are generated and no PNGs are written.
+IMAGE_EXPORT = "background"
+IMAGE_WRITER_QUEUE_SIZE = 64  # Images waiting to be cropped and encoded before the worker blocks
 
 # --- CSV Outputs ---
 CSV_OUTPUT = Path("extracted_items.csv")
@@ -16,6 +36,25 @@ CSV_SKIPPED_OUTPUT = Path("skipped_components.csv")
 CSV_FAILED_OUTPUT = Path("failed_extractions.csv")
 FAILURE_LOG_PATH = Path("failed_pdfs.csv")
 
+# --- Result Sink ---
+# All output rows go through one writer in the main process.
+# "csv":     append to the CSV files above.
+# "sqlite":  one table per output in RESULTS_DB_PATH.
+# "parquet": one Parquet part per flushed batch under RESULTS_PARQUET_DIR/<table>/ (requires pyarrow).
+RESULT_SINK_BACKEND = "csv"
+RESULT_SINK_BATCH_ROWS = 500  # Flush once this many rows are buffered...
+RESULT_SINK_FLUSH_SECONDS = 5  # ...or after this many seconds
+RESULTS_DB_PATH = Path("results.db")
+RESULTS_PARQUET_DIR = Path("results_parquet")
+# Rows whose write failed are retried on the next flushes; after RESULT_SINK_MAX_WRITE_ATTEMPTS
+# failed writes (or at shutdown) they are spilled as CSV to RESULT_SINK_FALLBACK_DIR.
+RESULT_SINK_MAX_WRITE_ATTEMPTS = 3
+RESULT_SINK_FALLBACK_DIR = Path("unwritten_results")
+# Corpus-wide index of the validated items keyed by normalized MPN, updated by the
+# result sink as documents are finalized (see mpn_index.py).
+MPN_INDEX_ENABLED = True
+MPN_INDEX_DB_PATH = Path("mpn_index.db")
+
 # --- Model Configuration ---ç
 MODEL_NAME = "llama-3.3-70b-versatile"
 ANCHOR_MODEL_NAME = "gpt-4o"
@@ -24,3 +63,152 @@ ANCHOR_MODEL_NAME = "gpt-4o"
 # MODEL_NAME = "meta-llama/llama-4-maverick-17b-128e-instruct"
 # MODEL_NAME = "gemma2-9b-it"
 # MODEL_NAME = "llama-3.1-8b-instant"
+
+# --- Chunking ---
+# Chunks are budgeted in model tokens, counted locally with tiktoken (cl100k_base is
+# close to the Llama 3 vocabulary). Without tiktoken, ~4 characters count as one token.
+TOKENIZER_ENCODING = "cl100k_base"
+CHUNK_MAX_TOKENS = 1500
+# Tokens of document text `filter_chunks` packs into the extraction prompt, per model.
+# Leave room for the instructions, the previous items and the completion.
+CHUNK_TOKEN_BUDGETS = {
+    "llama-3.3-70b-versatile": 9000,
+    "llama-3.1-8b-instant": 6000,
+    "gemma2-9b-it": 4000,
+}
+DEFAULT_CHUNK_TOKEN_BUDGET = 6000
+# How `filter_chunks` ranks chunks.
+# "keywords": `score_chunk` counts of ordering keywords, component names and the title prefix;
+#             chunks must score above MIN_CHUNK_SCORE.
+# "bm25":     Okapi BM25 over the document's chunks (see scoring.py), so rare terms such
+#             as the part numbers outweigh words found in every section; chunks must
+#             share a term with the query.
+CHUNK_RANKING = "keywords"
+MIN_CHUNK_SCORE = 1
+
+# --- Extraction Output ---
+# How `call_llm` receives the extracted items.
+# "text":   wait for the whole completion and locate the JSON array in it.
+# "json":   schema-constrained output for the models in JSON_OUTPUT_FORMATS; other
+#           models fall back to "stream".
+# "stream": stream the completion and parse items as each object closes, with a
+#           completion cap sized to the input and an early stop on runaway output.
+EXTRACTION_OUTPUT_MODE = "text"
+# response_format supported per model: "json_schema" (strict schema) or "json_object".
+JSON_OUTPUT_FORMATS = {
+    "gpt-4o": "json_schema",
+    "gpt-4o-mini": "json_schema",
+    "llama-3.3-70b-versatile": "json_object",
+}
+STREAM_TOKENS_PER_ITEM = 60  # Completion tokens budgeted per expected item
+STREAM_MIN_COMPLETION_TOKENS = 1024
+STREAM_MAX_COMPLETION_TOKENS = 8192
+STREAM_MAX_ITEMS = 500  # Stop a stream after this many items
+STREAM_REPEAT_LIMIT = 5  # Stop when the same item is generated this many times in a row
+STREAM_STALL_CHARS = 4000  # Stop when this many characters arrive without completing an item
+
+# --- Extraction Strategy ---
+# "combined":   the selected chunks are joined into a single extraction call.
+# "map_reduce": the relevant chunks are grouped into parts of at most MAP_REDUCE_CALL_TOKENS
+#               tokens that are extracted by independent, concurrent calls; the partial
+#               item lists are merged by MPN in `validate_items`.
+EXTRACTION_STRATEGY = "combined"
+MAP_REDUCE_CALL_TOKENS = 3000
+MAP_REDUCE_MAX_CALLS = 12  # Chunk tokens per document are capped at MAP_REDUCE_MAX_CALLS * MAP_REDUCE_CALL_TOKENS
+MAP_REDUCE_CONCURRENCY = 4  # Concurrent extraction calls per document
+
+# --- Anchor Classification ---
+# With ANCHOR_BEFORE_CONVERSION the anchor step classifies the document from the text
+# layer of its first pages, before conversion, so skipped components are never
+# converted. Scanned documents (excerpt shorter than ANCHOR_EXCERPT_MIN_CHARS) are
+# classified from the converted markdown as before.
+ANCHOR_BEFORE_CONVERSION = True
+ANCHOR_EXCERPT_PAGES = 2
+ANCHOR_EXCERPT_MIN_CHARS = 200
+# With ANCHOR_BATCH_SIZE > 1 the main process classifies the queued documents before
+# handing them to the workers, packing the excerpts of up to ANCHOR_BATCH_SIZE documents
+# into one anchor request. Documents missing from a batch answer are classified alone.
+# Up to ANCHOR_BATCH_CONCURRENCY batches are classified by background threads while the
+# documents of earlier batches are already being submitted to the workers.
+ANCHOR_BATCH_SIZE = 8
+ANCHOR_BATCH_CONCURRENCY = 4
+
+# --- Parallelism ---
+NUM_GPUS = 5
+MAX_WORKERS = (NUM_GPUS * 4)
+MAX_IN_FLIGHT = (MAX_WORKERS * 2)  # Documents submitted to the single-stage pool at any time
+
+# --- Document Submission ---
+DOCUMENT_ORDER = "none"  # "none" (directory order, streamed), "name", "size", "size-desc" or "mtime"
+DOCUMENT_LIMIT = None  # Maximum documents per run; None for no limit
+DOCUMENT_BATCH_SIZE = 500  # PDFs registered in / looked up from the job ledger per query
+
+# --- Multi-Node Sharding ---
+# Several machines can share one documents directory (see sharding.py and `main.py --shard-mode`).
+NODE_ID = os.environ.get("NODE_ID") or socket.gethostname()
+LEASE_DB_PATH = Path("leases.db")  # Must be on the filesystem shared by all nodes
+LEASE_SECONDS = 900  # A dead node's documents are taken over once its leases expire
+LEASE_RENEW_SECONDS = 60  # How often a live node renews its leases
+NODE_OUTPUT_DIR = Path("outputs") / "nodes"  # Per-node result sink outputs of a sharded run
+MERGED_OUTPUT_DIR = Path("outputs") / "merged"  # Written by `main.py --merge-outputs`
+
+# --- Pipeline Mode ---
+# "single":    every worker process runs the whole graph for one PDF at a time.
+# "two_stage": a process pool only converts and chunks PDFs and feeds a queue that a
+#              much wider thread pool drains by running the LLM part of the graph.
+# "async":     like "two_stage", but the LLM part runs as asyncio tasks with async
+#              clients, keeping up to ASYNC_MAX_CONCURRENCY documents in flight.
+PIPELINE_MODE = "single"
+CONVERSION_WORKERS = (NUM_GPUS * 2)
+LLM_WORKERS = 64
+PIPELINE_MAX_PENDING = (LLM_WORKERS * 2)  # Converted (or converting) documents waiting for the LLM stage
+PIPELINE_REPORT_SECONDS = 60
+ASYNC_MAX_CONCURRENCY = 200
+
+# --- Rate Limits ---
+# Requests and tokens per minute per model, shared by every worker process through
+# RATE_LIMIT_DB_PATH. Match these to the quotas of your API tier; models that are
+# not listed are not throttled.
+RATE_LIMITS = {
+    MODEL_NAME: {"rpm": 1000, "tpm": 300000},
+    ANCHOR_MODEL_NAME: {"rpm": 5000, "tpm": 450000},
+}
+RATE_LIMIT_COMPLETION_TOKENS = 1024  # Completion tokens budgeted per call on top of the prompt estimate
+RATE_LIMIT_DB_PATH = STATE_DIR / "rate_limits.db"
+
+# --- Retries & Circuit Breaker ---
+LLM_MAX_RETRIES = 5  # Retries of a transient LLM failure, with jittered exponential backoff
+LLM_RETRY_BASE_SECONDS = 2
+LLM_RETRY_MAX_SECONDS = 60
+CIRCUIT_BREAKER_THRESHOLD = 10  # Consecutive transient failures of a model (across all workers) that open the circuit
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = 120
+CIRCUIT_BREAKER_DB_PATH = STATE_DIR / "circuit_breakers.db"
+
+# --- LLM Response Cache ---
+# Responses are cached by a hash of model + messages + temperature, so reruns with
+# byte-identical prompts don't pay for the call again. `python main.py --no-llm-cache`
+# bypasses lookups for one run (responses are still stored).
+LLM_CACHE_ENABLED = True
+LLM_CACHE_MAX_BYTES = 2 * 1024 ** 3
+LLM_CACHE_DB_PATH = STATE_DIR / "llm_cache.db"
+
+# --- Job Ledger ---
+JOB_LEDGER_DB_PATH = STATE_DIR / "jobs.db"  # Per-document stage, status, attempts and timings
+JOB_MAX_ATTEMPTS = 3  # Documents that raised an error are retried on later runs up to this many attempts
+# Finished PDFs stay in DOCUMENTS_DIR and the ledger records their outcome. Set to True to
+# also move them into PROCESSED_DIR / SKIPPED_DIR / FAILED_DIR as before.
+ARCHIVE_FINISHED_PDFS = False
+
+# --- Duplicate Detection ---
+# The same datasheet is often downloaded from several sources. A document whose bytes
+# (SHA-256) match, or whose text is near-identical to, an already extracted document
+# reuses that document's results under its own source, without conversion or LLM calls.
+# Near-duplicates are found with MinHash signatures of word shingles of the PDF text
+# layer (of the converted markdown for scanned documents), bucketed with LSH.
+DEDUP_ENABLED = True
+DEDUP_DB_PATH = STATE_DIR / "dedup.db"
+DEDUP_SHINGLE_WORDS = 5
+DEDUP_PERMUTATIONS = 128
+DEDUP_BANDS = 16  # LSH bands of DEDUP_PERMUTATIONS / DEDUP_BANDS rows each
+DEDUP_SIMILARITY = 0.9  # Minimum estimated Jaccard similarity of a near-duplicate
+DEDUP_MIN_SHINGLES = 50  # Documents with less text are only matched exactly
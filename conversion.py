@@ -0,0 +1,411 @@
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from functools import partial
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import pypdfium2 as pdfium
+from docling.datamodel.base_models import InputFormat
+from docling.document_converter import DocumentConverter
+from docling_core.types.doc import ImageRefMode, PictureItem, TableItem
+
+from config import (CONVERSION_CACHE_DIR, IMAGE_EXPORT, OCR_MODE, PAGE_TRIAGE_ENABLED, PAGE_TRIAGE_LEAD_PAGES,
+                    PAGE_TRIAGE_MIN_PAGES, PAGE_TRIAGE_TOP_PAGES, TEXT_LAYER_MIN_CHARS)
+from helpers import extract_all_tables_with_optional_header, score_chunks
+from image_writer import get_image_writer
+
+logger = logging.getLogger(__name__)
+
+MARKDOWN_FILENAME = "document-with-image-refs.md"
+STATS_FILENAME = "conversion-stats.json"
+
+
+def file_sha256(path: Path, block_size: int = 1 << 20) -> str:
+    """
+    Returns the SHA-256 hex digest of a file's bytes, read in blocks.
+
+    Args:
+        path (Path): The file to hash.
+        block_size (int): Bytes read per block.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def converter_fingerprint(converter: DocumentConverter) -> str:
+    """
+    Returns a fingerprint of everything in a converter that changes its output.
+
+    Covers the PDF pipeline options (OCR engine and languages, `images_scale`,
+    table structure settings, image generation, ...) and the docling version.
+    The accelerator settings only change speed and are left out.
+
+    Args:
+        converter (DocumentConverter): The converter returned by `setup_converter`.
+
+    Returns:
+        str: A SHA-256 hex digest of the options.
+    """
+    opts = converter.format_to_options[InputFormat.PDF].pipeline_options
+    options = opts.model_dump(mode="json", exclude={"accelerator_options"})
+    options["ocr_engine"] = type(opts.ocr_options).__name__
+    options["docling_version"] = metadata.version("docling")
+    payload = json.dumps(options, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def conversion_cache_key(pdf: Path, converter: DocumentConverter,
+                         text_converter: Optional[DocumentConverter] = None,
+                         pages: Optional[List[int]] = None, sha256: Optional[str] = None) -> str:
+    """
+    Returns the conversion cache key of a PDF: a hash of its bytes plus the converter options.
+
+    Args:
+        pdf (Path): The PDF file.
+        converter (DocumentConverter): The OCR converter that would convert it.
+        text_converter (Optional[DocumentConverter]): The text-layer converter, if
+                                                      the fast path is enabled.
+        pages (Optional[List[int]]): The pages selected by triage, None for all pages.
+        sha256 (Optional[str]): The `file_sha256` of the PDF, if already computed.
+
+    Returns:
+        str: The cache key.
+    """
+    parts = [sha256 or file_sha256(pdf), converter_fingerprint(converter)]
+    if text_converter is not None:
+        parts += [converter_fingerprint(text_converter), f"text-layer-min-chars={TEXT_LAYER_MIN_CHARS}"]
+    if pages is not None:
+        parts.append(f"pages={','.join(map(str, pages))}")
+    return hashlib.sha256(":".join(parts).encode("utf-8")).hexdigest()
+
+
+# PDFium is not thread-safe; the `AnchorBatcher` threads read text layers concurrently.
+_PDFIUM_LOCK = threading.Lock()
+
+
+def read_text_layer(pdf: Path, max_pages: Optional[int] = None) -> List[str]:
+    """
+    Reads the embedded text layer of the pages of a PDF, without any OCR.
+
+    Args:
+        pdf (Path): The PDF file.
+        max_pages (Optional[int]): Only read this many leading pages.
+
+    Returns:
+        List[str]: The text of each page; empty for scanned pages.
+    """
+    with _PDFIUM_LOCK:
+        doc = pdfium.PdfDocument(str(pdf))
+        try:
+            texts = []
+            for index in range(len(doc) if max_pages is None else min(len(doc), max_pages)):
+                page = doc[index]
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            return texts
+        finally:
+            doc.close()
+
+
+def page_count(pdf: Path) -> int:
+    """Returns the number of pages of a PDF."""
+    with _PDFIUM_LOCK:
+        doc = pdfium.PdfDocument(str(pdf))
+        try:
+            return len(doc)
+        finally:
+            doc.close()
+
+
+# Conversion work of the current process, to estimate what skipping a document before
+# conversion saved. Reported by `workers.report_timings`.
+_SAVINGS: Counter = Counter()
+_SAVINGS_LOCK = threading.Lock()
+
+
+def record_skipped_conversion(pages: int):
+    """Counts a document that was skipped before conversion."""
+    with _SAVINGS_LOCK:
+        _SAVINGS["skipped_documents"] += 1
+        _SAVINGS["skipped_pages"] += pages
+
+
+def conversion_savings() -> Dict[str, float]:
+    """
+    Returns the conversion counters of the current process: converted pages and
+    their conversion seconds, and the documents and pages skipped before conversion.
+    """
+    with _SAVINGS_LOCK:
+        return dict(_SAVINGS)
+
+
+def triage_pages(page_texts: List[str]) -> Optional[List[int]]:
+    """
+    Picks the pages worth a full conversion from their raw text layer.
+
+    Every page is scored with `score_chunks` on the ordering keywords only. The
+    title and component names are left out on purpose: the selection is part of
+    the conversion cache key, so it must depend on the content alone for renamed
+    copies to share a cache entry. The first PAGE_TRIAGE_LEAD_PAGES pages (needed
+    for the anchor excerpt) are always kept, plus the PAGE_TRIAGE_TOP_PAGES best
+    scoring pages. Short documents and documents whose text layer is mostly
+    missing are not triaged.
+
+    Args:
+        page_texts (List[str]): The text layer of each page.
+
+    Returns:
+        Optional[List[int]]: The selected 1-based page numbers in document order, or
+                             None if the whole document should be converted.
+    """
+    if len(page_texts) <= PAGE_TRIAGE_MIN_PAGES:
+        return None
+    with_text = sum(1 for text in page_texts if len(text.strip()) >= TEXT_LAYER_MIN_CHARS)
+    if with_text < len(page_texts) / 2:
+        return None
+
+    scores = [(score, page_no) for page_no, score in enumerate(score_chunks(page_texts, [], ""), start=1)]
+    selected = set(range(1, PAGE_TRIAGE_LEAD_PAGES + 1))
+    ranked = sorted((entry for entry in scores if entry[0] > 0), key=lambda x: x[0], reverse=True)
+    selected.update(page_no for _score, page_no in ranked[:PAGE_TRIAGE_TOP_PAGES])
+    return sorted(selected)
+
+
+def page_runs(pages: List[int], needs_ocr: Dict[int, bool]) -> List[Tuple[int, int, bool]]:
+    """
+    Groups consecutive pages that share the same OCR need.
+
+    Args:
+        pages (List[int]): The 1-based page numbers to convert, in order.
+        needs_ocr (Dict[int, bool]): Whether each page needs OCR.
+
+    Returns:
+        List[Tuple[int, int, bool]]: (first_page, last_page, needs_ocr) runs with
+                                     1-based, inclusive page numbers.
+    """
+    runs = []
+    for page_no in pages:
+        flag = needs_ocr[page_no]
+        if runs and runs[-1][2] == flag and runs[-1][1] == page_no - 1:
+            runs[-1] = (runs[-1][0], page_no, flag)
+        else:
+            runs.append((page_no, page_no, flag))
+    return runs
+
+
+def export_document(conv_res, output_dir: Path, name: str = "document",
+                    images: Optional[List[Tuple[str, Any]]] = None) -> Path:
+    """
+    Writes a docling conversion result to `output_dir`: the markdown with referenced
+    images, and the table and picture crops.
+
+    The crops are neither cut nor encoded here: `images` collects (filename, crop)
+    pairs, where the crop is a callable that cuts the element from its page image,
+    and the background image writer calls it. With `IMAGE_EXPORT = "off"` no crops
+    are made at all.
+
+    Args:
+        conv_res: The result of `DocumentConverter.convert`.
+        output_dir (Path): The directory to write to.
+        name (str): Prefix of the written files, so several parts of one document
+                    can share a directory.
+        images (Optional[List[Tuple[str, Any]]]): Collects the crops to write.
+
+    Returns:
+        Path: The path of the written markdown file.
+    """
+    if images is not None and IMAGE_EXPORT != "off":
+        table_counter = 0
+        picture_counter = 0
+
+        for element, _level in conv_res.document.iterate_items():
+            if isinstance(element, TableItem):
+                table_counter += 1
+                element_image_filename = f"{name}-table-{table_counter}.png"
+            elif isinstance(element, PictureItem):
+                picture_counter += 1
+                element_image_filename = f"{name}-picture-{picture_counter}.png"
+            else:
+                continue
+            images.append((element_image_filename, partial(element.get_image, conv_res.document)))
+
+    md_path = output_dir / f"{name}-with-image-refs.md"
+    conv_res.document.save_as_markdown(md_path, image_mode=ImageRefMode.REFERENCED)
+    return md_path
+
+
+def _clear_dir(path: Path):
+    for child in path.iterdir():
+        if child.is_dir():
+            shutil.rmtree(child)
+        else:
+            child.unlink()
+
+
+def _convert_full(pdf: Path, converter: DocumentConverter, output_dir: Path,
+                  images: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    """Converts the whole PDF with the OCR converter into `output_dir`."""
+    conv_res = converter.convert(pdf)
+    export_document(conv_res, output_dir, images=images)
+    pages = len(conv_res.pages)
+    return {"mode": "ocr", "pages": pages, "converted_pages": pages, "ocr_pages": pages}
+
+
+def _convert_runs(pdf: Path, converter: DocumentConverter, text_converter: Optional[DocumentConverter],
+                  pages: List[int], needs_ocr: Dict[int, bool], output_dir: Path,
+                  images: List[Tuple[str, Any]]) -> str:
+    """Converts each run of pages with the converter it needs and joins the markdown."""
+    markdown_parts = []
+    for part, (first, last, ocr) in enumerate(page_runs(pages, needs_ocr), start=1):
+        conv_res = (converter if ocr else text_converter).convert(pdf, page_range=(first, last))
+        part_md_path = export_document(conv_res, output_dir, name=f"part-{part}", images=images)
+        markdown_parts.append(part_md_path.read_text(encoding="utf-8").strip())
+    markdown = "\n\n".join(markdown_parts)
+    (output_dir / MARKDOWN_FILENAME).write_text(markdown, encoding="utf-8")
+    return markdown
+
+
+def _convert(pdf: Path, converter: DocumentConverter, text_converter: Optional[DocumentConverter],
+             page_texts: List[str], selected: Optional[List[int]], output_dir: Path,
+             images: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    """
+    Converts the selected pages (all if None), skipping OCR on pages with a text layer
+    when a `text_converter` is given.
+
+    Falls back to OCR on every selected page when the text-layer result contains no
+    tables.
+    """
+    if selected is None and (text_converter is None or not page_texts):
+        return _convert_full(pdf, converter, output_dir, images)
+
+    pages = selected if selected is not None else list(range(1, len(page_texts) + 1))
+    needs_ocr = {
+        page_no: text_converter is None or len(page_texts[page_no - 1].strip()) < TEXT_LAYER_MIN_CHARS
+        for page_no in pages
+    }
+    if selected is None and all(needs_ocr.values()):
+        return _convert_full(pdf, converter, output_dir, images)
+
+    mode = "ocr"
+    markdown = _convert_runs(pdf, converter, text_converter, pages, needs_ocr, output_dir, images)
+    if not all(needs_ocr.values()):
+        mode = "mixed" if any(needs_ocr.values()) else "text"
+        if not extract_all_tables_with_optional_header(markdown):
+            logger.info(f"Text-layer conversion of {pdf.name} found no tables. Falling back to full OCR.")
+            _clear_dir(output_dir)
+            images.clear()
+            if selected is None:
+                stats = _convert_full(pdf, converter, output_dir, images)
+                stats["mode"] = "fallback"
+                return stats
+            needs_ocr = {page_no: True for page_no in pages}
+            _convert_runs(pdf, converter, text_converter, pages, needs_ocr, output_dir, images)
+            mode = "fallback"
+
+    return {
+        "mode": mode,
+        "pages": len(page_texts),
+        "converted_pages": len(pages),
+        "ocr_pages": sum(needs_ocr.values()),
+    }
+
+
+def convert_with_cache(pdf: Path, converter: DocumentConverter,
+                       text_converter: Optional[DocumentConverter] = None,
+                       sha256: Optional[str] = None) -> Tuple[Path, str, Dict[str, Any]]:
+    """
+    Converts a PDF to markdown, reusing the stored output of identical content.
+
+    The docling output is stored once per `conversion_cache_key` under
+    `CONVERSION_CACHE_DIR`, so renamed duplicates are converted only once, and a
+    changed file or changed converter options never reuse stale output. Output
+    is written to a temporary directory and renamed into place, so concurrent
+    workers never see a partial conversion. Table and picture PNGs are handed to
+    the background image writer once the output is in place, so they may appear
+    shortly after this function returns.
+
+    Before converting, the raw text layer is read once. With PAGE_TRIAGE_ENABLED,
+    long documents are only converted on the pages picked by `triage_pages`. With
+    `OCR_MODE = "auto"` and a `text_converter`, only pages without a usable text
+    layer are OCR'd.
+
+    Args:
+        pdf (Path): The PDF file.
+        converter (DocumentConverter): The OCR converter returned by `setup_converter`.
+        text_converter (Optional[DocumentConverter]): The converter returned by
+                                                      `setup_converter(do_ocr=False)`.
+        sha256 (Optional[str]): The `file_sha256` of the PDF, if already computed.
+
+    Returns:
+        Tuple[Path, str, Dict[str, Any]]: The markdown path, the cache key and the
+                                          conversion stats ('mode', 'pages',
+                                          'converted_pages', 'ocr_pages').
+    """
+    if OCR_MODE != "auto":
+        text_converter = None
+
+    page_texts: List[str] = []
+    if text_converter is not None or PAGE_TRIAGE_ENABLED:
+        try:
+            page_texts = read_text_layer(pdf)
+        except Exception as e:
+            logger.warning(f"Could not read the text layer of {pdf.name}: {e}")
+    selected = triage_pages(page_texts) if PAGE_TRIAGE_ENABLED and page_texts else None
+
+    key = conversion_cache_key(pdf, converter, text_converter, selected, sha256)
+    cache_dir = CONVERSION_CACHE_DIR / key
+    md_path = cache_dir / MARKDOWN_FILENAME
+
+    if md_path.exists():
+        logger.info(f"Reusing cached conversion {key[:12]} for {pdf.name}.")
+        stats_path = cache_dir / STATS_FILENAME
+        stats = json.loads(stats_path.read_text(encoding="utf-8")) if stats_path.exists() else {}
+        return md_path, key, {**stats, "cached": True}
+
+    if selected is not None:
+        logger.info(f"Page triage kept {len(selected)} of {len(page_texts)} pages of {pdf.name}: {selected}")
+    logger.info(f"No cached conversion for {pdf.name}. Converting PDF...")
+    start_time = time.time()
+    CONVERSION_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{key[:12]}-", dir=CONVERSION_CACHE_DIR))
+    images: List[Tuple[str, Any]] = []
+    try:
+        stats = _convert(pdf, converter, text_converter, page_texts, selected, tmp_dir, images)
+        stats["images"] = len(images)  # Elements to crop; ones without a page image write nothing
+        stats["seconds"] = round(time.time() - start_time, 2)
+        with _SAVINGS_LOCK:
+            _SAVINGS["converted_pages"] += stats["converted_pages"]
+            _SAVINGS["conversion_seconds"] += stats["seconds"]
+        (tmp_dir / STATS_FILENAME).write_text(json.dumps(stats), encoding="utf-8")
+        try:
+            tmp_dir.rename(cache_dir)
+        except OSError:
+            # Another worker stored the same content first; keep its output.
+            logger.info(f"Conversion {key[:12]} was stored concurrently by another worker.")
+            images = []
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    writer = get_image_writer() if images else None
+    for filename, image in images:
+        writer.submit(cache_dir / filename, image)
+
+    logger.info(f"Document converted and figures exported in {stats['seconds']:.2f} seconds "
+                f"({stats['mode']}: {stats['converted_pages']}/{stats['pages']} pages converted, "
+                f"{stats['ocr_pages']} OCR'd).")
+    return md_path, key, {**stats, "cached": False}
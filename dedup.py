@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from config import (DEDUP_BANDS, DEDUP_DB_PATH, DEDUP_MIN_SHINGLES, DEDUP_PERMUTATIONS, DEDUP_SHINGLE_WORDS,
+                    DEDUP_SIMILARITY)
+
+logger = logging.getLogger(__name__)
+
+# Words of the shingles; markdown table and heading syntax is ignored, so the text layer
+# and the converted markdown of the same datasheet shingle alike.
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-/+][a-z0-9]+)*")
+
+# Universal hashing modulo a Mersenne prime. Shingle hashes and coefficients are below
+# 2**32, so a * x + b never overflows uint64.
+_PRIME = np.uint64((1 << 61) - 1)
+_BLOCK = 4096
+
+
+def _hash32(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=4).digest(), "little")
+
+
+def _coefficients(permutations: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Derived from fixed strings rather than a seeded RNG, so signatures stay comparable
+    # across NumPy versions and runs.
+    a = np.array([_hash32(f"a{i}") | 1 for i in range(permutations)], dtype=np.uint64)
+    b = np.array([_hash32(f"b{i}") for i in range(permutations)], dtype=np.uint64)
+    return a[:, None], b[:, None]
+
+
+_A, _B = _coefficients(DEDUP_PERMUTATIONS)
+
+
+def shingle_hashes(text: str, size: int = DEDUP_SHINGLE_WORDS) -> np.ndarray:
+    """Returns the distinct 32-bit hashes of the `size`-word shingles of a text."""
+    words = WORD_PATTERN.findall(text.lower())
+    shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((_hash32(s) for s in shingles), dtype=np.uint64, count=len(shingles))
+
+
+def minhash_signature(text: str) -> bytes:
+    """
+    Computes the MinHash signature of a document's text.
+
+    Args:
+        text (str): The text layer or markdown of the document.
+
+    Returns:
+        bytes: DEDUP_PERMUTATIONS minimum hashes as uint64 bytes, or b"" if the text
+               has fewer than DEDUP_MIN_SHINGLES shingles.
+    """
+    hashes = shingle_hashes(text)
+    if len(hashes) < DEDUP_MIN_SHINGLES:
+        return b""
+    signature = np.full(DEDUP_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(hashes), _BLOCK):
+        block = hashes[None, start:start + _BLOCK]
+        signature = np.minimum(signature, ((_A * block + _B) % _PRIME).min(axis=1))
+    return signature.tobytes()
+
+
+def similarity(signature_a: bytes, signature_b: bytes) -> float:
+    """Estimates the Jaccard similarity of two documents from their signatures."""
+    a = np.frombuffer(signature_a, dtype=np.uint64)
+    b = np.frombuffer(signature_b, dtype=np.uint64)
+    if not len(a) or len(a) != len(b):
+        return 0.0
+    return float(np.mean(a == b))
+
+
+def band_keys(signature: bytes):
+    """Returns the LSH bucket of every band of a signature."""
+    rows = len(signature) // DEDUP_BANDS
+    return [(band, hashlib.blake2b(signature[band * rows:(band + 1) * rows], digest_size=8).hexdigest())
+            for band in range(DEDUP_BANDS)]
+
+
+class DedupStore:
+    """
+    Persistent index of extracted documents for duplicate detection, in SQLite.
+
+    Every finished extraction is registered as a canonical document with its SHA-256,
+    its MinHash signature (indexed by LSH band buckets) and its results. `find` looks a
+    new document up: first by exact hash, then among the canonical documents that
+    share a band bucket with it, keeping the most similar one above DEDUP_SIMILARITY.
+    Matches are counted per process.
+    """
+
+    def __init__(self, db_path: Path = DEDUP_DB_PATH, threshold: float = DEDUP_SIMILARITY):
+        self.db_path = Path(db_path)
+        self.threshold = threshold
+        self.counts: Counter = Counter()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each process opens its own lazily.
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "pdf_name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, signature BLOB NOT NULL, "
+                "result TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS documents_sha256 ON documents (sha256)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, bucket TEXT NOT NULL, pdf_name TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS bands_bucket ON bands (band, bucket)")
+        return self._conn
+
+    def find(self, pdf_name: str, sha256: str, signature: bytes) -> Optional[Tuple[str, float, Dict[str, Any]]]:
+        """
+        Looks for a canonical document that the given document duplicates.
+
+        Args:
+            pdf_name (str): The document's name; it never matches itself.
+            sha256 (str): The SHA-256 of the PDF bytes.
+            signature (bytes): Its `minhash_signature`, possibly empty.
+
+        Returns:
+            Optional[Tuple[str, float, Dict[str, Any]]]: The canonical document's name,
+            the estimated similarity (1.0 for identical bytes) and its stored results.
+        """
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT pdf_name, result FROM documents WHERE sha256 = ? AND pdf_name != ? LIMIT 1",
+                               (sha256, pdf_name)).fetchone()
+            if row:
+                self.counts["exact"] += 1
+                return row[0], 1.0, json.loads(row[1])
+            if not signature:
+                return None
+            candidates = set()
+            for band, bucket in band_keys(signature):
+                candidates.update(name for (name,) in conn.execute(
+                    "SELECT pdf_name FROM bands WHERE band = ? AND bucket = ?", (band, bucket)))
+            candidates.discard(pdf_name)
+            best = None
+            for name in candidates:
+                row = conn.execute("SELECT signature, result FROM documents WHERE pdf_name = ?", (name,)).fetchone()
+                if row is None:
+                    continue
+                score = similarity(signature, row[0])
+                if score >= self.threshold and (best is None or score > best[1]):
+                    best = (name, score, row[1])
+            if best is None:
+                return None
+            self.counts["near"] += 1
+            return best[0], best[1], json.loads(best[2])
+
+    def register(self, pdf_name: str, sha256: str, signature: bytes, result: Dict[str, Any]):
+        """
+        Registers a finished extraction as a canonical document.
+
+        Args:
+            pdf_name (str): The document name.
+            sha256 (str): The SHA-256 of the PDF bytes.
+            signature (bytes): Its `minhash_signature`, possibly empty (exact matches only).
+            result (Dict[str, Any]): The JSON-serializable results duplicates reuse.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO documents (pdf_name, sha256, signature, result, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (pdf_name, sha256, signature, json.dumps(result, ensure_ascii=False), time.time())
+                )
+                conn.execute("DELETE FROM bands WHERE pdf_name = ?", (pdf_name,))
+                if signature:
+                    conn.executemany("INSERT INTO bands (band, bucket, pdf_name) VALUES (?, ?, ?)",
+                                     [(band, bucket, pdf_name) for band, bucket in band_keys(signature)])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the exact and near-duplicate match counters of the current process."""
+        with self._lock:
+            return dict(self.counts)
+
+
+_STORE: Optional[DedupStore] = None
+
+
+def get_dedup_store() -> DedupStore:
+    """Returns the duplicate detection store of the current process, creating it on first use."""
+    global _STORE
+    if _STORE is None:
+        _STORE = DedupStore()
+    return _STORE
@@ -1,22 +1,72 @@
 from langgraph.graph import StateGraph, START, END
-from nodes import load_and_split, extract_anchor, call_llm, parse_and_repair, finalize, save_full_state, validate_items, save_skipped_component, filter_chunks, decide_what_to_do_next, log_extraction_failure
+from job_ledger import track_stage
+from nodes import check_duplicate, load_and_split, anchor_before_conversion, aanchor_before_conversion, extract_anchor, call_llm, parse_and_repair, finalize, save_full_state, validate_items, save_skipped_component, filter_chunks, decide_what_to_do_next, log_extraction_failure, aextract_anchor, acall_llm, aparse_and_repair
 
-def build_graph():
+def build_graph(include_conversion: bool = True, use_async: bool = False):
+    """
+    Builds and compiles the extraction graph.
+
+    Args:
+        include_conversion (bool): If False, the graph starts after the conversion and
+                                   expects a state already produced by `load_and_split`
+                                   (used by the LLM stage of the pipelines). A state
+                                   already classified by `anchor_before_conversion`
+                                   goes straight to the chunk filter.
+        use_async (bool): If True, the anchor, llm and parse nodes are coroutines that
+                          expect async LLM clients; invoke the graph with `ainvoke`.
+
+    With conversion, the anchor step first runs on the text layer of the first pages
+    (`anchor_before_conversion`), so skipped components are never converted; documents
+    it cannot classify are anchored on the converted markdown as before.
+
+    Duplicates of already extracted documents (`check_duplicate`) go straight to
+    `finalize`: before the conversion when the bytes or the text layer match, after it
+    when only the converted markdown can be compared.
+
+    The main stages record their entry in the job ledger (see `track_stage`).
+    """
     g = StateGraph(dict)
-    g.add_node("load", load_and_split)
-    g.add_node("anchor", extract_anchor)
+    if include_conversion:
+        g.add_node("dedup", check_duplicate)
+        g.add_node("pre_anchor", track_stage("anchor", aanchor_before_conversion if use_async else anchor_before_conversion))
+        g.add_node("load", track_stage("conversion", load_and_split))
+    g.add_node("dedup_converted", check_duplicate)
+    g.add_node("anchor", track_stage("anchor", aextract_anchor if use_async else extract_anchor))
     g.add_node("filter", filter_chunks)
-    g.add_node("llm", call_llm)
-    g.add_node("parse", parse_and_repair)
+    g.add_node("llm", track_stage("extraction", acall_llm if use_async else call_llm))
+    g.add_node("parse", aparse_and_repair if use_async else parse_and_repair)
     g.add_node("decide", decide_what_to_do_next)
-    g.add_node("final", finalize)
-    g.add_node("validate", validate_items)
+    g.add_node("final", track_stage("finalize", finalize))
+    g.add_node("validate", track_stage("validation", validate_items))
     g.add_node("save_skipped", save_skipped_component)
     g.add_node("log_failure", log_extraction_failure)
     g.add_node("save", save_full_state)
 
-    g.add_edge(START, "load")
-    g.add_edge("load", "anchor")
+    def after_conversion(s):
+        if s.get("duplicate_of"):
+            return "final"
+        if not s.get("anchor_source"):
+            return "anchor"
+        # Anchored before the conversion; no chunks means the conversion failed.
+        return "filter" if s.get("chunks") else END
+
+    conversion_routes = {"final": "final", "anchor": "anchor", "filter": "filter", END: END}
+    if include_conversion:
+        g.add_edge(START, "dedup")
+        g.add_conditional_edges(
+            "dedup",
+            lambda s: "final" if s.get("duplicate_of") else "pre_anchor",
+            {"final": "final", "pre_anchor": "pre_anchor"}
+        )
+        g.add_conditional_edges(
+            "pre_anchor",
+            lambda s: "save_skipped" if s.get("skip_reason") else "load",
+            {"save_skipped": "save_skipped", "load": "load"}
+        )
+        g.add_edge("load", "dedup_converted")
+    else:
+        g.add_edge(START, "dedup_converted")
+    g.add_conditional_edges("dedup_converted", after_conversion, conversion_routes)
     g.add_conditional_edges(
         "anchor",
         lambda s: "filter" if s.get("chunks") else "save_skipped",
@@ -1,21 +1,26 @@
-import csv
+import ast
 import json
 import logging
 import re
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-import pandas as pd
 from docling.datamodel.base_models import InputFormat
 from docling.datamodel.pipeline_options import AcceleratorDevice, AcceleratorOptions, EasyOcrOptions, PdfPipelineOptions, TesseractCliOcrOptions
 from docling.document_converter import DocumentConverter, PdfFormatOption
 
-from config import CSV_OUTPUT, CSV_VALIDATED_OUTPUT, FAILURE_LOG_PATH
+from config import (CHUNK_MAX_TOKENS, CHUNK_RANKING, CHUNK_TOKEN_BUDGETS, DEFAULT_CHUNK_TOKEN_BUDGET,
+                    IMAGE_EXPORT, MIN_CHUNK_SCORE, STREAM_MAX_COMPLETION_TOKENS, STREAM_MIN_COMPLETION_TOKENS,
+                    STREAM_TOKENS_PER_ITEM, TOKENIZER_ENCODING)
+from job_ledger import get_job_ledger
+from result_sink import write_rows
+from scoring import Score, bm25_scores, get_scorer, pack_chunks
 
 logger = logging.getLogger(__name__)
 
-def setup_converter() -> DocumentConverter:
+def setup_converter(do_ocr: bool = True) -> DocumentConverter:
     """
     Initializes and configures the DocumentConverter for processing PDFs.
 
@@ -23,16 +28,22 @@ def setup_converter() -> DocumentConverter:
     Optical Character Recognition (OCR) and table structure analysis. It is
     configured to use EasyOCR by default.
 
+    Args:
+        do_ocr (bool): If False, builds the text-layer converter used for born-digital
+                       pages: no OCR and no upscaled page images, but the same table
+                       structure analysis and (at native scale) the same image export.
+
     Returns:
         DocumentConverter: A configured instance of the DocumentConverter.
     """
     opts = PdfPipelineOptions()
-    opts.do_ocr = True  # Enable OCR to extract text from images.
+    opts.do_ocr = do_ocr  # Enable OCR to extract text from images.
     opts.do_table_structure = True  # Enable table structure analysis.
     opts.table_structure_options.do_cell_matching = True    # Enable cell matching for better table structure recognition.
-    opts.images_scale = 2.0  # Scale images for better OCR accuracy.
-    opts.generate_page_images = True    # Generate images for each page in the PDF.
-    opts.generate_picture_images = True   # Generate images for pictures in the PDF.
+    opts.images_scale = 2.0 if do_ocr else 1.0  # Scale images for better OCR accuracy.
+    export_images = IMAGE_EXPORT != "off"  # Nothing in the graph reads the images.
+    opts.generate_page_images = export_images    # Generate images for each page in the PDF.
+    opts.generate_picture_images = export_images   # Generate images for pictures in the PDF.
     opts.ocr_options = EasyOcrOptions()   # Use EasyOCR for text extraction from images.
     opts.accelerator_options = AcceleratorOptions(device=AcceleratorDevice.CUDA, num_threads=4)
     opts.ocr_options.lang = ["en"]  # Set the OCR language to English.
@@ -46,6 +57,7 @@ def score_chunk(chunk: str, components: list[str], title: str) -> int:
     This function is used to identify the most relevant parts of a document for extraction.
     It assigns a score by counting occurrences of predefined keywords (e.g., "part number",
     "package") and the component names identified in the anchor extraction step.
+    To score many chunks of the same document, use `score_chunks`.
 
     Args:
         chunk (str): The text chunk to score.
@@ -54,31 +66,127 @@ def score_chunk(chunk: str, components: list[str], title: str) -> int:
     Returns:
         int: The calculated score for the chunk.
     """
-    score = 0
-    chunk_lower = chunk.lower()
-
-    # A regex pattern to find keywords related to component specifications.
-    KEYWORD_PATTERN = re.compile(
-    r"\b("
-    r"part( numbers?)?|"
-    r"type numbers?|"
-    r"ordering|"
-    r"markings?|"
-    r"package options?|"
-    r"product series|"
-    r"packages?"
-    r")\b",
-    re.IGNORECASE
-    )
-    if len(title) >= 5:
-        title_prefix = title[:5].lower()
-        score += chunk_lower.count(title_prefix)*0.5
-    if components:
-        score += sum(1 for m in components if m.lower() in chunk_lower)
-    keyword_matches = KEYWORD_PATTERN.findall(chunk)
-    score += len(keyword_matches)
-    
-    return score
+    return get_scorer(components, title).score_all([chunk])[0]
+
+def score_chunks(chunks: List[str], components: list[str], title: str) -> List[int]:
+    """
+    Scores all chunks of a document in a single pass per pattern.
+
+    Gives the same scores as calling `score_chunk` on every chunk, with the keyword,
+    title and component patterns compiled once (see `scoring.ChunkScorer`).
+
+    Args:
+        chunks (List[str]): The text chunks to score.
+        components (list[str]): A list of component names to search for.
+        title (str): The document title.
+
+    Returns:
+        List[int]: The score of each chunk.
+    """
+    return get_scorer(components, title).score_all(chunks)
+
+# Joins the chunks selected by `select_chunks` into the extraction input.
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+
+def select_chunks(chunks: List[str], components: List[str], title: str, model_name: str,
+                  ranking: str = CHUNK_RANKING,
+                  budget: Optional[int] = None) -> Tuple[List[Score], List[int], Dict[str, Any]]:
+    """
+    Ranks the chunks of a document and packs the relevant chunks with the highest
+    total score into the token budget of a model.
+
+    Args:
+        chunks (List[str]): The chunks.
+        components (List[str]): The component names from the anchor.
+        title (str): The document title.
+        model_name (str): The extraction model, which selects the budget in CHUNK_TOKEN_BUDGETS.
+        ranking (str): "keywords" (`score_chunks`) or "bm25" (`bm25_scores`).
+        budget (Optional[int]): Token budget; defaults to the model's in CHUNK_TOKEN_BUDGETS.
+
+    Returns:
+        Tuple[List[Score], List[int], Dict[str, Any]]: The score of every chunk, the
+        indices of the selected chunks in document order, and a summary of the budget
+        and its utilization.
+    """
+    if ranking == "bm25":
+        scores, min_score = bm25_scores(chunks, components, title), 0
+    else:
+        scores, min_score = score_chunks(chunks, components, title), MIN_CHUNK_SCORE
+    if budget is None:
+        budget = CHUNK_TOKEN_BUDGETS.get(model_name, DEFAULT_CHUNK_TOKEN_BUDGET)
+
+    candidates = [i for i, score in enumerate(scores) if score > min_score]
+    # Each chunk is charged for a separator as well, so the joined text fits too.
+    separator_tokens = count_tokens(CHUNK_SEPARATOR)
+    costs = [count_tokens(chunks[i]) + separator_tokens for i in candidates]
+    packed = pack_chunks([scores[i] for i in candidates], costs, budget)
+
+    selected = [candidates[k] for k in packed]
+    used_tokens = sum(costs[k] for k in packed)
+    chunk_budget = {
+        "ranking": ranking,
+        "model": model_name,
+        "budget_tokens": budget,
+        "used_tokens": used_tokens,
+        "utilization": round(used_tokens / budget, 3) if budget else 0,
+        "selected_chunks": [i + 1 for i in selected],
+        "candidate_chunks": len(candidates),
+        "selected_score": sum(scores[i] for i in selected),
+    }
+    return scores, selected, chunk_budget
+
+def group_chunks(chunks: List[str], max_tokens: int) -> List[str]:
+    """
+    Joins consecutive chunks into parts of at most `max_tokens` tokens each, for
+    map-reduce extraction. A chunk over the limit forms a part on its own.
+
+    Args:
+        chunks (List[str]): The selected chunks, in document order.
+        max_tokens (int): The token limit per part.
+
+    Returns:
+        List[str]: The parts, joined with CHUNK_SEPARATOR.
+    """
+    separator_tokens = count_tokens(CHUNK_SEPARATOR)
+    parts, current, used = [], [], 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk) + separator_tokens
+        if current and used + tokens > max_tokens:
+            parts.append(CHUNK_SEPARATOR.join(current))
+            current, used = [], 0
+        current.append(chunk)
+        used += tokens
+    if current:
+        parts.append(CHUNK_SEPARATOR.join(current))
+    return parts
+
+def normalize_components(raw_components: Any) -> List[str]:
+    """
+    Normalizes the 'component' value of the state into a list of component names.
+
+    The anchor step may return a list, the string representation of a list, or a
+    single quoted name.
+
+    Args:
+        raw_components (Any): The raw 'component' value.
+
+    Returns:
+        List[str]: The component names.
+    """
+    if isinstance(raw_components, str):
+        raw_components = raw_components.strip()
+        if not raw_components:
+            return []
+        try:
+            parsed = ast.literal_eval(raw_components)
+            return parsed if isinstance(parsed, list) else [str(parsed)]
+        except (ValueError, SyntaxError):
+            return [raw_components.strip('"')]
+    if isinstance(raw_components, list):
+        return raw_components
+    return []
+
 
 def clean_markdown_text(document_text: str) -> str:
     """
@@ -149,39 +257,152 @@ def extract_all_tables_with_optional_header(markdown_content: str) -> List[Dict[
 
     return extracted_data
 
-def chunk_markdown(md: str, max_words: int = 1000) -> List[str]:
+# Markdown table delimiter row, e.g. "|---|:---:|".
+TABLE_DELIMITER_PATTERN = re.compile(r"^\s*\|?\s*:?-{3,}")
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Loads the local tokenizer once per process, or returns None if it is unavailable."""
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken is not installed; token counts are estimated from the text length.")
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"Could not load the '{TOKENIZER_ENCODING}' tokenizer ({e}); token counts are estimated from the text length.")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the model tokens in a text.
+
+    Uses the TOKENIZER_ENCODING tiktoken encoding, or about four characters per
+    token when tiktoken is not available.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The token count.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _split_words(line: str, max_tokens: int) -> List[Tuple[str, int]]:
+    # Last resort for a single line over the budget: cut it between words.
+    pieces, words, used = [], [], 0
+    for word in line.split(" "):
+        tokens = count_tokens(word) + 1
+        if words and used + tokens > max_tokens:
+            pieces.append((" ".join(words), used))
+            words, used = [], 0
+        words.append(word)
+        used += tokens
+    if words:
+        pieces.append((" ".join(words), used))
+    return pieces
+
+
+def _split_section(section: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """
+    Splits a section over the token budget into pieces that fit, between lines.
+
+    Table rows are never cut. When a table is split, each continuation piece starts
+    with the table's header and delimiter rows again, so every piece is a valid
+    table with its column names.
+
+    Args:
+        section (str): The oversized section.
+        max_tokens (int): The token budget per piece.
+
+    Returns:
+        List[Tuple[str, int]]: The pieces and their token counts.
+    """
+    pieces = []
+    lines, used = [], 0
+    header, header_tokens, row_index = [], 0, -1
+
+    for line in section.split("\n"):
+        tokens = count_tokens(line) + 1
+        if line.lstrip().startswith("|"):
+            row_index += 1
+            if row_index == 0:
+                header, header_tokens = [line], tokens
+            elif row_index == 1 and TABLE_DELIMITER_PATTERN.match(line):
+                header.append(line)
+                header_tokens += tokens
+        else:
+            header, header_tokens, row_index = [], 0, -1
+
+        if tokens > max_tokens:
+            if lines:
+                pieces.append(("\n".join(lines), used))
+                lines, used = [], 0
+            pieces.extend(_split_words(line, max_tokens))
+            continue
+
+        if lines and used + tokens > max_tokens:
+            pieces.append(("\n".join(lines), used))
+            lines, used = [], 0
+            # Repeat the header, unless it would take most of the next piece itself.
+            if row_index >= 2 and len(header) == 2 and header_tokens + tokens <= max_tokens // 2:
+                lines, used = list(header), header_tokens
+        lines.append(line)
+        used += tokens
+
+    if lines:
+        pieces.append(("\n".join(lines), used))
+    return pieces
+
+
+def chunk_markdown(md: str, max_tokens: int = CHUNK_MAX_TOKENS) -> List[str]:
     """
-    Splits a large markdown document into smaller chunks based on a word limit.
+    Splits a large markdown document into smaller chunks based on a token limit.
 
     This function attempts to keep markdown sections (starting with '##')
     together. It iterates through sections, adding them to a buffer until the
-    word count exceeds the maximum, at which point it creates a new chunk.
+    token count would exceed the maximum, at which point it creates a new chunk.
+    Every section is tokenized once and the buffer's count is kept as a running
+    total, so the cost is linear in the document size. A single section over the
+    limit is split between lines (see `_split_section`).
 
     Args:
         md (str): The markdown content to be chunked.
-        max_words (int): The maximum number of words allowed per chunk.
+        max_tokens (int): The maximum number of model tokens per chunk.
 
     Returns:
         List[str]: A list of markdown text chunks.
     """
-    print(f"Total words: {len(md.split())}")
     sections = re.split(r"\n(?=##\s)", md)
-    chunks, buf = [], ""
-    
+    chunks, sizes = [], []
+    buf, buf_tokens = [], 0
+
     for sec in sections:
         sec = sec.strip()
-        buf_words = len(buf.split())
-        sec_words = len(sec.split())
-        
-        if buf_words + sec_words < max_words:
-            buf += sec + "\n"
-        else:
-            chunks.append(buf.strip())
-            buf = sec + "\n"
-    
-    if buf.strip():
-        chunks.append(buf.strip())
-    print(f"Number of words in chunks: {[len(chunk.split()) for chunk in chunks]}")
+        if not sec:
+            continue
+        sec_tokens = count_tokens(sec) + 1
+        parts = [(sec, sec_tokens)] if sec_tokens <= max_tokens else _split_section(sec, max_tokens)
+
+        for part, part_tokens in parts:
+            if buf and buf_tokens + part_tokens > max_tokens:
+                chunks.append("\n".join(buf))
+                sizes.append(buf_tokens)
+                buf, buf_tokens = [], 0
+            buf.append(part)
+            buf_tokens += part_tokens
+
+    if buf:
+        chunks.append("\n".join(buf))
+        sizes.append(buf_tokens)
+    logger.info(f"Chunked {sum(sizes)} tokens into {len(chunks)} chunk(s) of at most {max_tokens}: {sizes}")
 
     return chunks
 
@@ -217,6 +438,40 @@ def generate_anchor_prompt(excerpt: str) -> str:
     {excerpt}
     """
 
+def generate_batch_anchor_prompt(excerpts: Dict[str, str]) -> str:
+    documents = "\n\n".join(f"=== Document {key} ===\n{excerpt}" for key, excerpt in excerpts.items())
+    return f"""
+    You are given the beginnings of {len(excerpts)} Markdown-formatted technical documents, each for an electronic component.
+    Each document starts with a line like `=== Document <id> ===`. Treat every document independently.
+
+    For **each** document, perform two tasks:
+
+    1.  **Extraction**: Extract the following information:
+        - The **main component name(s)** (e.g., MMBT3906). If a range is shown (e.g., `BZX84C2V4W - BZX84C39W`), extract the **start and end MPNs**.
+        - A **short technical description** of the component (e.g., "40 V, 200 mA PNP switching transistor"). If not found, leave this blank.
+        - The **package case** or type, if available (e.g., SOT-23, DO-214AB, QFN). If not found, leave this blank.
+
+    2.  **Classification**: Set the following boolean flag based on the component type.
+        - `is_chip_component`: Set to **true** ONLY if the component is explicitly described as a **resistor, capacitor (MLCC), inductor, or ferrite bead**. If the type is anything else or is not clearly mentioned, you MUST set this to **false**.
+
+    3.  **Justification**: If you set `is_chip_component` to `true`, you MUST add an `explanation` field briefly stating the reason (e.g., "Component is described as a chip resistor").
+
+    Respond **strictly** with one JSON object that has exactly one key per document id ({", ".join(excerpts)}):
+
+    {{
+      "<id>": {{
+        "component": ["StartMPN", "EndMPN"],
+        "description": "Short description of the component",
+        "package_case": "Package type if available(e.g., SOT-23, DO-214AB)",
+        "is_chip_component": boolean,
+        "explanation": "Brief reason if is_chip_component is true."
+      }}
+    }}
+
+    Markdown excerpts:
+    {documents}
+    """
+
 def generate_prompt(chunk: str, prev_items: List[dict], component: List[dict]) -> str:
     prev = json.dumps(prev_items, indent=2) if prev_items else "[]"
     comp = json.dumps(component, indent=2) if component else "[]"
@@ -264,6 +519,71 @@ def generate_prompt(chunk: str, prev_items: List[dict], component: List[dict]) -
     STRICT INSTRUCTION: Return **only** a valid JSON list (i.e., starting with `[` and ending with `]`) and **nothing else**.
     """
 
+# JSON schema of the extraction output for "json_schema" structured output. Strict
+# schemas need an object at the top level and every property listed as required.
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "mpn": {"type": "string"},
+                    "top_marking": {"type": "string"},
+                    "package_case": {"type": "string"},
+                    "description": {"type": "string"},
+                    "confidence": {"type": "string", "enum": ["high", "medium", "low"]},
+                },
+                "required": ["mpn", "top_marking", "package_case", "description", "confidence"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["items"],
+    "additionalProperties": False,
+}
+
+# Appended to the extraction messages in structured output mode, where the reply must
+# be a JSON object rather than the array `generate_prompt` asks for.
+STRUCTURED_OUTPUT_INSTRUCTION = 'Return the list as the "items" property of a JSON object: {"items": [...]}.'
+
+
+def extraction_response_format(output_format: str) -> Dict[str, Any]:
+    """
+    Returns the `response_format` argument for structured extraction output.
+
+    Args:
+        output_format (str): "json_schema" or "json_object" (see JSON_OUTPUT_FORMATS).
+
+    Returns:
+        Dict[str, Any]: The response format for the chat completions API.
+    """
+    if output_format == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": "extracted_items", "schema": EXTRACTION_SCHEMA, "strict": True}}
+    return {"type": "json_object"}
+
+
+def completion_token_cap(chunk: str, prev_items: List[dict]) -> int:
+    """
+    Sizes the completion cap of a streamed extraction to its input.
+
+    Every table row of the chunk and every previous item may become an item of the
+    answer, so the cap is STREAM_TOKENS_PER_ITEM per expected item (plus some slack),
+    clamped to [STREAM_MIN_COMPLETION_TOKENS, STREAM_MAX_COMPLETION_TOKENS].
+
+    Args:
+        chunk (str): The combined chunk sent to the model.
+        prev_items (List[dict]): The previously extracted items included in the prompt.
+
+    Returns:
+        int: The max_tokens for the request.
+    """
+    rows = sum(1 for line in chunk.splitlines() if line.lstrip().startswith("|"))
+    expected_items = max(rows, len(prev_items)) + 10
+    return max(STREAM_MIN_COMPLETION_TOKENS, min(STREAM_MAX_COMPLETION_TOKENS, expected_items * STREAM_TOKENS_PER_ITEM))
+
+
 def generate_repair_prompt(raw: str) -> str:
     return f"""
     The following JSON array is invalid, incomplete, or malformed.
@@ -320,38 +640,26 @@ def generate_repair_prompt(raw: str) -> str:
 #     """
 
 def log_failure(pdf_path: Path, error: Exception): # <-- Add this entire function
-    """Logs a PDF processing failure to a CSV file."""
-    FAILURE_LOG_PATH.parent.mkdir(exist_ok=True)
-    with open(FAILURE_LOG_PATH, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([datetime.now().isoformat(), pdf_path.name, str(error)])
+    """Logs a PDF processing failure through the result sink and marks the job as errored in the ledger."""
+    get_job_ledger().finish(pdf_path.name, "error", str(error))
+    write_rows("failed_pdfs", [{"timestamp": datetime.now().isoformat(), "pdf_name": pdf_path.name, "error": str(error)}])
 
 def save_items(items: List[dict]):
     """
-    Saves a list of extracted items to a CSV file.
-
-    Appends to the file if it exists, otherwise creates a new file with a header.
+    Saves a list of extracted items through the result sink.
 
     Args:
         items (List[dict]): The list of dictionaries to save.
     """
-    df = pd.DataFrame(items)
-    mode = "a" if CSV_OUTPUT.exists() else "w"
-    header = not CSV_OUTPUT.exists()
-    df.to_csv(CSV_OUTPUT, mode=mode, header=header, index=False)
-    logger.info(f"Saved {len(items)} items to CSV")
+    write_rows("items", items)
+    logger.info(f"Saved {len(items)} items to the result sink")
 
 def save_validated_items(items: List[dict]):
     """
-    Saves a list of validated items to a separate CSV file.
-
-    Appends to the file if it exists, otherwise creates a new file with a header.
+    Saves a list of validated items through the result sink.
 
     Args:
         items (List[dict]): The list of validated dictionaries to save.
     """
-    df = pd.DataFrame(items)
-    mode = "a" if CSV_VALIDATED_OUTPUT.exists() else "w"
-    header = not CSV_VALIDATED_OUTPUT.exists()
-    df.to_csv(CSV_VALIDATED_OUTPUT, mode=mode, header=header, index=False)
-    logger.info(f"Saved {len(items)} validated items to CSV")
+    write_rows("validated_items", items)
+    logger.info(f"Saved {len(items)} validated items to the result sink")
@@ -0,0 +1,99 @@
+import logging
+import os
+import queue
+import threading
+from multiprocessing import util
+from pathlib import Path
+from typing import Dict, Optional
+
+from config import IMAGE_WRITER_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundImageWriter:
+    """
+    Crops, encodes and writes PNG images on a background thread.
+
+    Cropping and PNG encoding of large table and picture crops dominate the export
+    of image-heavy datasheets, while nothing in the graph reads the images. The
+    writer takes that work off the worker's critical path: it is handed callables
+    that cut the crop from the converted document, so no decoded crop exists before
+    the writer gets to it. The queue is bounded, so a slow disk applies
+    backpressure.
+
+    Each image is written to a temporary file and renamed into place, so readers
+    never see a partial PNG. Pending images are flushed when the process exits.
+    """
+
+    def __init__(self, max_pending: int = IMAGE_WRITER_QUEUE_SIZE):
+        self.pid = os.getpid()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="image-writer", daemon=True)
+        self.written = 0
+        self.failed = 0
+        self._thread.start()
+        # Runs at interpreter exit and, unlike atexit, also in pool worker processes.
+        util.Finalize(None, self.close, exitpriority=10)
+
+    def submit(self, path: Path, image):
+        """
+        Queues an image to be written as PNG to `path`; blocks while the queue is full.
+
+        Args:
+            path (Path): The destination file.
+            image: The PIL image to encode, or a callable returning it (or None if
+                   there is nothing to write, e.g. no page image to crop from).
+        """
+        self._queue.put((path, image))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, image = item
+                tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+                try:
+                    if callable(image):
+                        image = image()
+                    if image is None:
+                        continue
+                    with tmp_path.open("wb") as fp:
+                        image.save(fp, "PNG")
+                    tmp_path.replace(path)
+                    self.written += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning(f"Could not write image {path}: {e}")
+                    tmp_path.unlink(missing_ok=True)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Blocks until every queued image has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Flushes the queue and stops the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+            logger.info(f"Image writer {os.getpid()} stopped: {self.written} written, {self.failed} failed.")
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the written, failed and pending image counts of this process."""
+        return {"written": self.written, "failed": self.failed, "pending": self._queue.qsize()}
+
+
+_WRITER: Optional[BackgroundImageWriter] = None
+
+
+def get_image_writer() -> BackgroundImageWriter:
+    """Returns the image writer of the current process, starting it on first use."""
+    global _WRITER
+    # A forked child inherits the object but not its thread.
+    if _WRITER is None or _WRITER.pid != os.getpid():
+        _WRITER = BackgroundImageWriter()
+    return _WRITER
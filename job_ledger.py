@@ -0,0 +1,224 @@
+import asyncio
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from config import JOB_LEDGER_DB_PATH, JOB_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+# Terminal statuses written by the graph's end nodes. "error" (an exception escaped
+# the graph) is retried on the next run until JOB_MAX_ATTEMPTS is reached.
+FINISHED_STATUSES = ("done", "skipped", "failed")
+
+
+class JobLedger:
+    """
+    Durable record of every document's progress in SQLite.
+
+    One row per PDF (keyed by file name) holds its content hash, size, the last
+    graph stage it entered, its status ("pending", "running", "done", "skipped",
+    "failed" or "error"), the number of attempts and its timings. The remaining
+    work of a run is found with batched queries (`unfinished`), and a document
+    whose worker died is picked up again on the next run. Conversion output and LLM responses are
+    cached by content, so a resumed document replays the stages it already
+    completed from those caches and continues at the stage it reached.
+    """
+
+    def __init__(self, db_path: Path = JOB_LEDGER_DB_PATH):
+        self.db_path = Path(db_path)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each process opens its own lazily.
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "pdf_name TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, sha256 TEXT, "
+                "stage TEXT, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                "error TEXT, created_at REAL NOT NULL, started_at REAL, stage_started_at REAL, "
+                "finished_at REAL, seconds REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        return self._conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connection().execute(sql, params)
+
+    def register(self, pdfs: Iterable[Path]) -> int:
+        """
+        Adds the PDFs the ledger does not know yet as pending jobs.
+
+        Args:
+            pdfs (Iterable[Path]): The PDFs found in the documents directory.
+
+        Returns:
+            int: The number of new jobs.
+        """
+        now = time.time()
+        rows = [(pdf.name, str(pdf), now) for pdf in pdfs]
+        with self._lock:
+            conn = self._connection()
+            before = conn.total_changes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR IGNORE INTO jobs (pdf_name, path, created_at) VALUES (?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return conn.total_changes - before
+
+    def unfinished(self, pdf_names: Iterable[str], max_attempts: int = JOB_MAX_ATTEMPTS) -> Set[str]:
+        """
+        Returns which of the given documents still need work: pending ones, ones
+        interrupted while running, and errored ones with attempts left.
+
+        Args:
+            pdf_names (Iterable[str]): Registered document names.
+            max_attempts (int): Attempts after which errored documents are given up.
+
+        Returns:
+            Set[str]: The names with work left.
+        """
+        names = list(pdf_names)
+        found: Set[str] = set()
+        # Stay below SQLite's default limit on bound parameters.
+        for start in range(0, len(names), 900):
+            chunk = names[start:start + 900]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows = self._execute(
+                f"SELECT pdf_name FROM jobs WHERE pdf_name IN ({placeholders}) AND "
+                "(status IN ('pending', 'running') OR (status = 'error' AND attempts < ?))",
+                (*chunk, max_attempts)
+            ).fetchall()
+            found.update(name for (name,) in rows)
+        return found
+
+    def statuses(self, pdf_names: List[str]) -> Dict[str, Tuple[str, Optional[float]]]:
+        """Returns the status and the start time of the last attempt of the given documents."""
+        result = {}
+        for start in range(0, len(pdf_names), 900):
+            chunk = pdf_names[start:start + 900]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows = self._execute(
+                f"SELECT pdf_name, status, started_at FROM jobs WHERE pdf_name IN ({placeholders})", tuple(chunk)
+            ).fetchall()
+            result.update({name: (status, started_at) for name, status, started_at in rows})
+        return result
+
+    def is_finished(self, pdf_name: str) -> bool:
+        """Returns True if the document reached a terminal status."""
+        row = self._execute("SELECT status FROM jobs WHERE pdf_name = ?", (pdf_name,)).fetchone()
+        return row is not None and row[0] in FINISHED_STATUSES
+
+    def start(self, pdf_path: Path, sha256: Optional[str] = None):
+        """
+        Marks a document as running and counts the attempt.
+
+        Args:
+            pdf_path (Path): The PDF being processed.
+            sha256 (Optional[str]): Its content hash, if already known.
+        """
+        now = time.time()
+        size = pdf_path.stat().st_size if pdf_path.exists() else None
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT stage, attempts FROM jobs WHERE pdf_name = ?", (pdf_path.name,)).fetchone()
+            if row and row[0]:
+                logger.info(f"Resuming {pdf_path.name} at stage '{row[0]}' (attempt {row[1] + 1}).")
+            conn.execute(
+                "INSERT INTO jobs (pdf_name, path, size, sha256, status, attempts, created_at, started_at) "
+                "VALUES (?, ?, ?, ?, 'running', 1, ?, ?) "
+                "ON CONFLICT (pdf_name) DO UPDATE SET path = excluded.path, size = excluded.size, "
+                "sha256 = COALESCE(excluded.sha256, sha256), status = 'running', attempts = attempts + 1, "
+                "error = NULL, started_at = excluded.started_at, finished_at = NULL, seconds = NULL",
+                (pdf_path.name, str(pdf_path), size, sha256, now, now)
+            )
+
+    def set_hash(self, pdf_name: str, sha256: str):
+        """Records the content hash of a document."""
+        self._execute("UPDATE jobs SET sha256 = ? WHERE pdf_name = ?", (sha256, pdf_name))
+
+    def mark_stage(self, pdf_name: str, stage: str):
+        """Records that a document entered a graph stage."""
+        self._execute(
+            "UPDATE jobs SET stage = ?, stage_started_at = ? WHERE pdf_name = ?",
+            (stage, time.time(), pdf_name)
+        )
+
+    def finish(self, pdf_name: str, status: str, error: Optional[str] = None):
+        """
+        Records the outcome of a running document. The first outcome of an attempt
+        wins, so a later node can't overwrite an earlier error.
+
+        Args:
+            pdf_name (str): The document name.
+            status (str): One of FINISHED_STATUSES or "error".
+            error (Optional[str]): The error message, for "error".
+        """
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ?, seconds = ? - started_at "
+            "WHERE pdf_name = ? AND status = 'running'",
+            (status, error, now, now, pdf_name)
+        )
+
+    def reopen(self, pdf_name: str, error: str):
+        """
+        Marks a document as failed whatever its status, e.g. when its output rows were
+        lost after it finished, so that the next run processes it again.
+        """
+        self._execute("UPDATE jobs SET status = 'error', error = ? WHERE pdf_name = ?", (error, pdf_name))
+
+    def summary(self) -> Dict[str, int]:
+        """Returns the number of jobs per status."""
+        return dict(self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+_LEDGER: Optional[JobLedger] = None
+
+
+def get_job_ledger() -> JobLedger:
+    """Returns the job ledger of the current process, creating it on first use."""
+    global _LEDGER
+    if _LEDGER is None:
+        _LEDGER = JobLedger()
+    return _LEDGER
+
+
+def track_stage(stage: str, node: Callable) -> Callable:
+    """
+    Wraps a graph node so that entering it is recorded in the job ledger.
+
+    Args:
+        stage (str): The stage name to record.
+        node (Callable): A sync or async graph node.
+
+    Returns:
+        Callable: The wrapped node, of the same kind.
+    """
+    if asyncio.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def async_wrapper(state: Dict) -> Dict:
+            get_job_ledger().mark_stage(Path(state["pdf_path"]).name, stage)
+            return await node(state)
+        return async_wrapper
+
+    @functools.wraps(node)
+    def wrapper(state: Dict) -> Dict:
+        get_job_ledger().mark_stage(Path(state["pdf_path"]).name, stage)
+        return node(state)
+    return wrapper
@@ -0,0 +1,124 @@
+import itertools
+import logging
+import os
+import signal
+import threading
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from config import DOCUMENT_BATCH_SIZE
+from job_ledger import JobLedger
+
+logger = logging.getLogger(__name__)
+
+# Orderings accepted by `iter_pdfs`. "none" streams in directory order without
+# holding the listing in memory; the others sort the listing first.
+ORDERS = ("none", "name", "size", "size-desc", "mtime")
+
+
+def iter_pdfs(directory: Path, order: str = "none") -> Iterator[Path]:
+    """
+    Lists the PDFs of a directory lazily.
+
+    Args:
+        directory (Path): The documents directory.
+        order (str): One of ORDERS. "size" yields the smallest files first, which gives
+                     fast early results; "mtime" yields the oldest files first.
+
+    Yields:
+        Path: The PDF paths.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Unknown document order '{order}'. Choose one of {ORDERS}.")
+
+    def entries():
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith(".pdf") and entry.is_file():
+                    yield entry
+
+    if order == "none":
+        for entry in entries():
+            yield Path(entry.path)
+        return
+
+    # Only (key, path) pairs are kept, not the DirEntry objects.
+    if order == "name":
+        keyed = [(entry.name, entry.path) for entry in entries()]
+    elif order == "mtime":
+        keyed = [(entry.stat().st_mtime, entry.path) for entry in entries()]
+    else:
+        keyed = [(entry.stat().st_size, entry.path) for entry in entries()]
+    keyed.sort(reverse=(order == "size-desc"))
+    for _key, path in keyed:
+        yield Path(path)
+
+
+def iter_remaining(pdfs: Iterable[Path], ledger: JobLedger, batch_size: int = DOCUMENT_BATCH_SIZE) -> Iterator[Path]:
+    """
+    Registers PDFs in the job ledger batch by batch and yields the ones with work left.
+
+    Args:
+        pdfs (Iterable[Path]): The PDFs found, e.g. from `iter_pdfs`.
+        ledger (JobLedger): The job ledger.
+        batch_size (int): How many PDFs are registered and looked up per query.
+
+    Yields:
+        Path: The PDFs that are not finished, in the input order.
+    """
+    pdfs = iter(pdfs)
+    while True:
+        batch = list(itertools.islice(pdfs, batch_size))
+        if not batch:
+            return
+        ledger.register(batch)
+        remaining = ledger.unfinished(pdf.name for pdf in batch)
+        for pdf in batch:
+            if pdf.name in remaining:
+                yield pdf
+
+
+def install_drain_handler() -> threading.Event:
+    """
+    Makes the first Ctrl-C drain the run instead of killing it.
+
+    The first SIGINT sets the returned event: no new documents are submitted, and
+    the ones in flight finish normally. A second SIGINT restores the default handler
+    and aborts with KeyboardInterrupt. Worker processes ignore SIGINT (see
+    `init_worker`), so they are not killed mid-document by the terminal's signal.
+
+    Returns:
+        threading.Event: Set once a drain was requested.
+    """
+    stop = threading.Event()
+
+    def handler(signum, frame):
+        if stop.is_set():
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            raise KeyboardInterrupt
+        stop.set()
+        logger.warning("Interrupt received: finishing the documents in flight, submitting no new ones. "
+                       "Press Ctrl-C again to abort.")
+
+    signal.signal(signal.SIGINT, handler)
+    return stop
+
+
+def until_drained(pdfs: Iterable[Path], stop: threading.Event, limit: Optional[int] = None) -> Iterator[Path]:
+    """
+    Yields PDFs until `limit` were yielded or a drain was requested.
+
+    Args:
+        pdfs (Iterable[Path]): The PDFs to process.
+        stop (threading.Event): The event returned by `install_drain_handler`.
+        limit (Optional[int]): Maximum number of PDFs, None for no limit.
+
+    Yields:
+        Path: The PDFs to submit.
+    """
+    if limit is not None:
+        pdfs = itertools.islice(pdfs, limit)
+    for pdf in pdfs:
+        if stop.is_set():
+            return
+        yield pdf
@@ -0,0 +1,303 @@
+import json
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+# Outcomes of `repair_json`, counted per process by `record_outcome`.
+# "parsed":   the text was valid JSON.
+# "repaired": the local repair produced valid JSON.
+# "salvaged": only the complete objects of the top-level array could be recovered.
+# "failed":   nothing usable; `parse_and_repair` falls back to the LLM repair call.
+OUTCOMES = ("parsed", "repaired", "salvaged", "failed")
+
+_LITERALS = {"True": "true", "False": "false", "None": "null", "NaN": "null", "Infinity": "null", "-Infinity": "null"}
+_BAREWORD_PATTERN = re.compile(r"[A-Za-z0-9_.+\-]+")
+_NUMBER_PATTERN = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?")
+
+
+def _read_string(text: str, i: int) -> Tuple[Optional[str], int]:
+    """Reads a single- or double-quoted string at `text[i]` as a JSON string literal."""
+    quote = text[i]
+    parts = ['"']
+    j = i + 1
+    while j < len(text):
+        char = text[j]
+        if char == "\\" and j + 1 < len(text):
+            escaped = text[j + 1]
+            # \' is not a JSON escape.
+            parts.append("'" if escaped == "'" else text[j:j + 2])
+            j += 2
+            continue
+        if char == quote:
+            parts.append('"')
+            return "".join(parts), j + 1
+        if char == '"':
+            parts.append('\\"')
+        elif char == "\n":
+            parts.append("\\n")
+        elif char == "\t":
+            parts.append("\\t")
+        else:
+            parts.append(char)
+        j += 1
+    # Truncated inside the string.
+    return None, len(text)
+
+
+def _scan(text: str) -> Tuple[str, bool, List[int], int]:
+    """
+    Rewrites JSON-like text into strict JSON in a single pass.
+
+    Converts single quotes, Python literals and bare keys, drops comments, trailing
+    commas and prose after the top-level value, and fixes mismatched closing brackets.
+
+    Returns:
+        Tuple[str, bool, List[int], int]: The rewritten text; whether the top-level value
+        was closed; the offsets of the objects that start directly inside the top-level
+        array; and the length of the prefix that ends after its last complete element.
+    """
+    out: List[str] = []
+    length = 0
+    stack: List[str] = []
+    object_starts: List[int] = []
+    safe_length = 0
+
+    def emit(piece: str):
+        nonlocal length
+        out.append(piece)
+        length += len(piece)
+
+    def value_done():
+        nonlocal safe_length
+        if len(stack) == 1:
+            safe_length = length
+
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char in "\"'":
+            literal, i = _read_string(text, i)
+            if literal is None:
+                break
+            emit(literal)
+            value_done()
+            continue
+        if text.startswith("//", i):
+            end = text.find("\n", i)
+            i = len(text) if end == -1 else end
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = len(text) if end == -1 else end + 2
+            continue
+
+        if char in "[{":
+            if char == "{" and stack == ["["]:
+                object_starts.append(length)
+            stack.append(char)
+            emit(char)
+        elif char in "]}":
+            if not stack:
+                break
+            # Trailing commas.
+            while out and out[-1] in (",", " ", "\n", "\t", "\r"):
+                length -= len(out.pop())
+            emit("]" if stack.pop() == "[" else "}")
+            if not stack:
+                return "".join(out), True, object_starts, length
+            value_done()
+        elif char in ",:":
+            emit(char)
+        elif char.isspace():
+            emit(char)
+        else:
+            match = _BAREWORD_PATTERN.match(text, i)
+            if not match:
+                # Stray prose character.
+                i += 1
+                continue
+            word = match.group(0)
+            i = match.end()
+            rest = text[i:i + 64].lstrip()
+            if stack and stack[-1] == "{" and rest.startswith(":"):
+                emit(json.dumps(word))
+                continue
+            if word in _LITERALS:
+                emit(_LITERALS[word])
+            elif word in ("true", "false", "null") or _NUMBER_PATTERN.fullmatch(word):
+                emit(word)
+            else:
+                emit(json.dumps(word))
+            value_done()
+            continue
+        i += 1
+
+    return "".join(out), not stack and bool(out), object_starts, safe_length
+
+
+def _salvage_objects(text: str, object_starts: List[int]) -> List[Any]:
+    """Decodes every complete object that starts directly inside the top-level array."""
+    decoder = json.JSONDecoder()
+    objects = []
+    resume = 0
+    for start in object_starts:
+        if start < resume:
+            continue
+        try:
+            obj, resume = decoder.raw_decode(text, start)
+        except ValueError:
+            continue
+        if isinstance(obj, dict):
+            objects.append(obj)
+    return objects
+
+
+def repair_json(text: str) -> Tuple[Any, str]:
+    """
+    Parses an LLM's JSON answer, repairing the usual defects locally.
+
+    Handles prose around the value, single quotes, Python literals (True, None),
+    unquoted keys, comments, trailing commas and arrays truncated at the token limit,
+    which are closed after their last complete element. If the result is still
+    invalid, the complete objects of the top-level array are salvaged one by one.
+
+    Args:
+        text (str): The response, with <think> blocks and code fences already removed.
+
+    Returns:
+        Tuple[Any, str]: The parsed value (None if nothing was recovered) and one of OUTCOMES.
+    """
+    try:
+        return json.loads(text), "parsed"
+    except ValueError:
+        pass
+
+    starts = [pos for pos in (text.find("["), text.find("{")) if pos != -1]
+    if not starts:
+        return None, "failed"
+    start = min(starts)
+    rewritten, closed, object_starts, safe_length = _scan(text[start:])
+
+    if closed:
+        candidate = rewritten
+    elif rewritten.startswith("["):
+        candidate = rewritten[:safe_length].rstrip().rstrip(",") + "]"
+    else:
+        candidate = None
+    if candidate is not None:
+        try:
+            data = json.loads(candidate)
+            # A closed value is the model's whole answer, even an empty list; a truncated
+            # array closed with no complete element recovered nothing.
+            if closed or data:
+                return data, "repaired"
+        except ValueError:
+            pass
+
+    objects = _salvage_objects(rewritten, object_starts)
+    if objects:
+        return objects, "salvaged"
+    return None, "failed"
+
+
+_COUNTS: Counter = Counter()
+_COUNTS_LOCK = threading.Lock()
+
+
+def record_outcome(outcome: str):
+    """Counts how a response was parsed ("llm" and "llm_failed" for the LLM repair path)."""
+    with _COUNTS_LOCK:
+        _COUNTS[outcome] += 1
+
+
+def repair_stats() -> Dict[str, int]:
+    """Returns the outcome counters of the current process."""
+    with _COUNTS_LOCK:
+        return dict(_COUNTS)
+
+
+class IncrementalItemParser:
+    """
+    Parses the objects of a streamed JSON array as soon as each one closes.
+
+    Feed it the text of a streamed completion piece by piece; every object that
+    completes directly inside the top-level array is parsed (with `repair_json`, so
+    single quotes and the like are tolerated) and returned. Text before the array,
+    such as a <think> block or a code fence, is skipped. If the stream is cut off,
+    `items` still holds every complete object.
+    """
+
+    def __init__(self):
+        self.items: List[Dict[str, Any]] = []
+        self.started = False
+        self.closed = False
+        self._prefix = ""
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._current: List[str] = []
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """
+        Consumes the next piece of the stream.
+
+        Args:
+            text (str): The new text.
+
+        Returns:
+            List[Dict[str, Any]]: The objects completed by this piece.
+        """
+        if self.closed:
+            return []
+        if not self.started:
+            self._prefix += text
+            start = self._array_start()
+            if start == -1:
+                return []
+            self.started = True
+            self._depth = 1
+            text = self._prefix[start + 1:]
+            self._prefix = ""
+
+        new_items = []
+        for char in text:
+            if self._depth >= 2:
+                self._current.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+                if self._depth == 2:
+                    self._current = [char]
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 1:
+                    data, _ = repair_json("".join(self._current))
+                    if isinstance(data, dict):
+                        self.items.append(data)
+                        new_items.append(data)
+                    self._current = []
+                elif self._depth == 0:
+                    self.closed = True
+                    break
+        return new_items
+
+    def _array_start(self) -> int:
+        # Wait for the end of a reasoning block before looking for the array.
+        offset = 0
+        think = self._prefix.find("<think>")
+        if think != -1:
+            end = self._prefix.find("</think>", think)
+            if end == -1:
+                return -1
+            offset = end + len("</think>")
+        return self._prefix.find("[", offset)
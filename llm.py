@@ -0,0 +1,338 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+from config import (LLM_MAX_RETRIES, RATE_LIMIT_COMPLETION_TOKENS, STREAM_MAX_ITEMS, STREAM_REPEAT_LIMIT,
+                    STREAM_STALL_CHARS)
+from helpers import count_tokens
+from json_repair import IncrementalItemParser
+from llm_cache import cache_key, get_llm_cache
+from rate_limiter import get_rate_limiter
+from resilience import backoff_delay, get_circuit_breaker, is_transient_error
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_request_tokens(messages: List[Dict[str, str]],
+                            completion_tokens: int = RATE_LIMIT_COMPLETION_TOKENS) -> int:
+    """
+    Estimates the tokens a chat completion request will consume against the quota.
+
+    Args:
+        messages (List[Dict[str, str]]): The chat messages, i.e. the output of
+                                         `generate_prompt`, `generate_anchor_prompt`
+                                         or `generate_repair_prompt` plus the system prompt.
+        completion_tokens (int): The completion tokens to budget.
+
+    Returns:
+        int: Estimated prompt tokens plus the budgeted completion tokens.
+    """
+    return sum(count_tokens(m["content"]) for m in messages) + completion_tokens
+
+
+def _total_tokens(usage) -> Optional[int]:
+    """Returns the total tokens of a response's (or stream chunk's) usage, if reported."""
+    return getattr(usage, "total_tokens", None) if usage is not None else None
+
+
+def _stream_tokens(messages: List[Dict[str, str]], collected: "_ItemStream") -> int:
+    """Returns the tokens a stream consumed: its reported usage, else prompt plus streamed text."""
+    reported = _total_tokens(collected.usage)
+    if reported is not None:
+        return reported
+    return estimate_request_tokens(messages, 0) + count_tokens("".join(collected.text))
+
+
+def _chunk_usage(chunk):
+    # OpenAI reports usage on the last chunk, Groq under `x_groq`.
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+    return usage
+
+
+def chat_completion(client, model: str, messages: List[Dict[str, str]], temperature: float = 0, **kwargs) -> str:
+    """
+    Sends a chat completion request and returns the stripped message content.
+
+    Works with both the Groq and the OpenAI clients, which share the same
+    `chat.completions.create` interface. Responses are served from and stored in
+    the persistent LLM response cache. Each attempt first waits for the model's
+    circuit breaker to be closed and for the shared rate limiter to grant quota.
+    Transient failures (connection errors, timeouts, throttling, 5xx) are retried
+    up to LLM_MAX_RETRIES times with jittered exponential backoff; other errors are
+    raised immediately.
+
+    Args:
+        client: A synchronous Groq or OpenAI client.
+        model (str): The model to query.
+        messages (List[Dict[str, str]]): The chat messages.
+        temperature (float): Sampling temperature.
+        **kwargs: Extra arguments passed through to the client.
+
+    Returns:
+        str: The content of the first choice.
+    """
+    cache = get_llm_cache()
+    key = cache_key(model, messages, temperature, **kwargs)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    breaker = get_circuit_breaker()
+    tokens = estimate_request_tokens(messages)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        breaker.wait_until_closed(model)
+        get_rate_limiter().acquire(model, tokens)
+        try:
+            resp = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                **kwargs
+            )
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            breaker.record_failure(model)
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"Transient error from {model} ({e}); retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s.")
+            time.sleep(delay)
+            continue
+        breaker.record_success(model)
+        get_rate_limiter().settle(model, tokens, _total_tokens(getattr(resp, "usage", None)))
+        content = resp.choices[0].message.content.strip()
+        cache.put(key, model, content)
+        return content
+
+
+async def achat_completion(client, model: str, messages: List[Dict[str, str]], temperature: float = 0, **kwargs) -> str:
+    """
+    Async counterpart of `chat_completion` for the AsyncGroq and AsyncOpenAI clients.
+
+    Args:
+        client: An asynchronous Groq or OpenAI client.
+        model (str): The model to query.
+        messages (List[Dict[str, str]]): The chat messages.
+        temperature (float): Sampling temperature.
+        **kwargs: Extra arguments passed through to the client.
+
+    Returns:
+        str: The content of the first choice.
+    """
+    cache = get_llm_cache()
+    key = cache_key(model, messages, temperature, **kwargs)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return cached
+
+    breaker = get_circuit_breaker()
+    tokens = estimate_request_tokens(messages)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await breaker.await_closed(model)
+        await get_rate_limiter().aacquire(model, tokens)
+        try:
+            resp = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                **kwargs
+            )
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            await asyncio.to_thread(breaker.record_failure, model)
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"Transient error from {model} ({e}); retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+            continue
+        await asyncio.to_thread(breaker.record_success, model)
+        await asyncio.to_thread(get_rate_limiter().settle, model, tokens, _total_tokens(getattr(resp, "usage", None)))
+        content = resp.choices[0].message.content.strip()
+        await asyncio.to_thread(cache.put, key, model, content)
+        return content
+
+
+class _ItemStream:
+    """
+    Collects the items of one streamed extraction and decides when to stop reading.
+
+    The stream is stopped once the top-level array is closed, and early when the
+    generation runs away: more than STREAM_MAX_ITEMS items, the same item
+    STREAM_REPEAT_LIMIT times in a row, or STREAM_STALL_CHARS characters without
+    completing an item.
+    """
+
+    def __init__(self):
+        self.parser = IncrementalItemParser()
+        self.text: List[str] = []
+        self.stop_reason: Optional[str] = None
+        self.usage = None
+        self._since_item = 0
+        self._repeats = 0
+        self._last = None
+
+    def add(self, piece: str) -> bool:
+        """Consumes a piece of the completion; returns True when reading should stop."""
+        self.text.append(piece)
+        new_items = self.parser.feed(piece)
+        self._since_item = 0 if new_items else self._since_item + len(piece)
+        for item in new_items:
+            key = json.dumps(item, sort_keys=True)
+            self._repeats = self._repeats + 1 if key == self._last else 1
+            self._last = key
+
+        if self.parser.closed:
+            return True
+        if len(self.parser.items) >= STREAM_MAX_ITEMS:
+            self.stop_reason = f"{STREAM_MAX_ITEMS} items"
+        elif self._repeats >= STREAM_REPEAT_LIMIT:
+            self.stop_reason = f"the same item {self._repeats} times in a row"
+        elif self.parser.started and self._since_item > STREAM_STALL_CHARS:
+            self.stop_reason = f"{self._since_item} characters without a complete item"
+        return self.stop_reason is not None
+
+    def content(self) -> str:
+        """The completion as a JSON array of the complete items, or the raw text if no array was found."""
+        if not self.parser.started:
+            return "".join(self.text).strip()
+        items = self.parser.items
+        if self._repeats >= STREAM_REPEAT_LIMIT:
+            # Keep one copy of the repeated item.
+            items = items[:len(items) - self._repeats + 1]
+        return json.dumps(items, ensure_ascii=False)
+
+
+def _delta_text(chunk) -> str:
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+
+def stream_items(client, model: str, messages: List[Dict[str, str]], max_tokens: int, temperature: float = 0) -> str:
+    """
+    Streams an extraction and parses its items as each object closes.
+
+    Shares the cache, circuit breaker, rate limiting and retries of `chat_completion`.
+    Reading stops early on runaway output (see `_ItemStream`), and a stream that is
+    cut off after some items keeps them instead of being retried.
+
+    Args:
+        client: A synchronous Groq or OpenAI client.
+        model (str): The model to query.
+        messages (List[Dict[str, str]]): The chat messages.
+        max_tokens (int): The completion cap.
+        temperature (float): Sampling temperature.
+
+    Returns:
+        str: The complete items as a JSON array (the raw text if the reply had no array).
+    """
+    cache = get_llm_cache()
+    key = cache_key(model, messages, temperature, max_tokens=max_tokens, stream=True)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    breaker = get_circuit_breaker()
+    tokens = estimate_request_tokens(messages, max_tokens)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        breaker.wait_until_closed(model)
+        get_rate_limiter().acquire(model, tokens)
+        collected = _ItemStream()
+        try:
+            stream = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            try:
+                for chunk in stream:
+                    collected.usage = _chunk_usage(chunk) or collected.usage
+                    if collected.add(_delta_text(chunk)):
+                        break
+            finally:
+                stream.close()
+        except Exception as e:
+            if collected.parser.items:
+                logger.warning(f"Stream from {model} cut off ({e}); keeping {len(collected.parser.items)} complete item(s).")
+                get_rate_limiter().settle(model, tokens, _stream_tokens(messages, collected))
+                return collected.content()
+            if not is_transient_error(e):
+                raise
+            breaker.record_failure(model)
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"Transient error from {model} ({e}); retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s.")
+            time.sleep(delay)
+            continue
+        breaker.record_success(model)
+        get_rate_limiter().settle(model, tokens, _stream_tokens(messages, collected))
+        if collected.stop_reason:
+            logger.warning(f"Stopped the stream from {model} early after {collected.stop_reason}.")
+        content = collected.content()
+        cache.put(key, model, content)
+        return content
+
+
+async def astream_items(client, model: str, messages: List[Dict[str, str]], max_tokens: int,
+                        temperature: float = 0) -> str:
+    """
+    Async counterpart of `stream_items` for the AsyncGroq and AsyncOpenAI clients.
+    """
+    cache = get_llm_cache()
+    key = cache_key(model, messages, temperature, max_tokens=max_tokens, stream=True)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return cached
+
+    breaker = get_circuit_breaker()
+    tokens = estimate_request_tokens(messages, max_tokens)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await breaker.await_closed(model)
+        await get_rate_limiter().aacquire(model, tokens)
+        collected = _ItemStream()
+        try:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            try:
+                async for chunk in stream:
+                    collected.usage = _chunk_usage(chunk) or collected.usage
+                    if collected.add(_delta_text(chunk)):
+                        break
+            finally:
+                await stream.close()
+        except Exception as e:
+            if collected.parser.items:
+                logger.warning(f"Stream from {model} cut off ({e}); keeping {len(collected.parser.items)} complete item(s).")
+                await asyncio.to_thread(get_rate_limiter().settle, model, tokens, _stream_tokens(messages, collected))
+                return collected.content()
+            if not is_transient_error(e):
+                raise
+            await asyncio.to_thread(breaker.record_failure, model)
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"Transient error from {model} ({e}); retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+            continue
+        await asyncio.to_thread(breaker.record_success, model)
+        await asyncio.to_thread(get_rate_limiter().settle, model, tokens, _stream_tokens(messages, collected))
+        if collected.stop_reason:
+            logger.warning(f"Stopped the stream from {model} early after {collected.stop_reason}.")
+        content = collected.content()
+        await asyncio.to_thread(cache.put, key, model, content)
+        return content
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from config import LLM_CACHE_DB_PATH, LLM_CACHE_ENABLED, LLM_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Set by `main.py --no-llm-cache`; inherited by the worker processes.
+BYPASS_ENV_VAR = "LLM_CACHE_BYPASS"
+
+# How many writes happen between two checks of the total cache size.
+EVICTION_CHECK_INTERVAL = 100
+
+
+def cache_key(model: str, messages: List[Dict[str, str]], temperature: float, **kwargs: Any) -> str:
+    """
+    Returns the content address of a chat completion request.
+
+    Args:
+        model (str): The model name.
+        messages (List[Dict[str, str]]): The chat messages.
+        temperature (float): Sampling temperature.
+        **kwargs: Any other request arguments that change the response.
+
+    Returns:
+        str: A SHA-256 hex digest of the canonical JSON form of the request.
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, **kwargs},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Persistent, content-addressed cache of LLM responses in SQLite.
+
+    Responses are stored under `cache_key` of their request, so a rerun that sends a
+    byte-identical prompt to the same model gets the stored response instead of a
+    new API call. When the stored responses grow beyond `max_bytes`, the least
+    recently used ones are evicted. Hits and misses are counted per process.
+    """
+
+    def __init__(self, db_path: Path = LLM_CACHE_DB_PATH, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each process opens its own lazily.
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        return self._conn
+
+    @property
+    def bypassed(self) -> bool:
+        return not LLM_CACHE_ENABLED or os.environ.get(BYPASS_ENV_VAR) == "1"
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Looks up a cached response.
+
+        Args:
+            key (str): The request's `cache_key`.
+
+        Returns:
+            Optional[str]: The cached response, or None on a miss or when bypassed.
+        """
+        if self.bypassed:
+            return None
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, model: str, response: str):
+        """
+        Stores a response, evicting the least recently used ones if the cache is too big.
+
+        Responses are stored even when lookups are bypassed, so a bypassed run
+        refreshes the cache.
+
+        Args:
+            key (str): The request's `cache_key`.
+            model (str): The model that produced the response.
+            response (str): The response content.
+        """
+        if not LLM_CACHE_ENABLED:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode("utf-8")), now, now)
+            )
+            self._writes += 1
+            if self._writes % EVICTION_CHECK_INTERVAL == 0:
+                self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% of the limit so that eviction does not run on every write.
+        to_free = total - int(self.max_bytes * 0.9)
+        freed = evicted = 0
+        conn.execute("BEGIN IMMEDIATE")
+        while freed < to_free:
+            rows = conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 1000").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if freed >= to_free:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                freed += size
+                evicted += 1
+        conn.execute("COMMIT")
+        logger.info(f"LLM cache evicted {evicted} responses ({freed} bytes).")
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit and miss counters of the current process."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_CACHE: Optional[LLMResponseCache] = None
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """Returns the LLM response cache of the current process, creating it on first use."""
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = LLMResponseCache()
+    return _CACHE
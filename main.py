@@ -1,75 +1,213 @@
 # Standard Library
+import argparse
 import concurrent.futures
-import csv
+import contextlib
+import json
 import logging
+import multiprocessing
 import os
-import shutil
 import ssl
-from datetime import datetime
+import time
 from pathlib import Path
+from typing import Iterable, Optional
 
 # Third-Party
 from dotenv import find_dotenv, load_dotenv
-from groq import Groq
-from openai import OpenAI
 
 # Local Application
-from config import (ANCHOR_MODEL_NAME, DOCUMENTS_DIR, FAILURE_LOG_PATH,
-                    MODEL_NAME, PROCESSED_DIR, SKIPPED_LARGE_FILES_DIR)
-from graph_builder import build_graph
-from helpers import log_failure, setup_converter
+from anchor_batcher import AnchorBatcher
+from config import (ANCHOR_BATCH_SIZE, ANCHOR_BEFORE_CONVERSION, DOCUMENT_LIMIT, DOCUMENT_ORDER, DOCUMENTS_DIR,
+                    LEASE_DB_PATH, MAX_IN_FLIGHT, MAX_WORKERS, MERGED_OUTPUT_DIR, MPN_INDEX_DB_PATH,
+                    NODE_ID, NUM_GPUS, PIPELINE_MODE, RESULT_SINK_BACKEND)
+from helpers import log_failure
+from job_ledger import get_job_ledger
+from job_source import ORDERS, install_drain_handler, iter_pdfs, iter_remaining, until_drained
+from llm_cache import BYPASS_ENV_VAR
+from pipeline import run_async, run_two_stage
+from resilience import get_circuit_breaker, is_transient_message
+from mpn_index import MpnIndex
+from result_sink import BACKENDS, ResultSink
+from sharding import (SHARD_MODES, LeaseKeeper, LeaseStore, iter_hash_partition, iter_leased, merge_outputs,
+                      node_output_dir)
+from workers import build_initial_state, get_worker_resources, init_worker, record_document_timing, report_timings
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
 logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO)
 
-NUM_GPUS = 5
-MAX_WORKERS = (NUM_GPUS * 4)
 
-
-def process_single_pdf(pdf_path: Path, gpu_id: int):
+def process_single_pdf(pdf_path: Path, anchor: Optional[dict] = None):
     """
     This function encapsulates the entire workflow for processing a single PDF file.
-    It is assigned a specific GPU to use.
+    It reuses the converter, clients and compiled graph loaded once by the worker
+    initializer, and returns a timing record for the startup-vs-steady-state report.
+    The anchor fields of a document classified by the `AnchorBatcher` are passed in
+    `anchor`.
     """
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
-    logging.info(f"Worker for {pdf_path.name} assigned to GPU: {gpu_id}")
+    logging.info(f"Worker {os.getpid()} picked up {pdf_path.name} on GPU: {os.environ.get('CUDA_VISIBLE_DEVICES', 'default')}")
 
-    if (PROCESSED_DIR / pdf_path.name).exists():
+    ledger = get_job_ledger()
+    if ledger.is_finished(pdf_path.name):
         logging.info(f"Skipping already processed file: {pdf_path.name}")
-        return
+        return None
 
+    # Don't start a document while an LLM provider is known to be down.
+    get_circuit_breaker().wait_until_closed()
     logging.info(f"Starting processing for: {pdf_path.name}")
 
+    resources = get_worker_resources()
+    start_time = time.time()
+    ledger.start(pdf_path)
     try:
-        client = Groq()
-        client_anchor = OpenAI()
-        converter = setup_converter()
-        app = build_graph()
-
-        state = {
-            "pdf_path": str(pdf_path),
-            "title": pdf_path.stem,
-            "client": client,
-            "client_anchor": client_anchor,
-            "converter": converter,
-            "model_name": MODEL_NAME,
-            "anchor_model_name": ANCHOR_MODEL_NAME
-        }
-
-        app.invoke(state, {"recursion_limit": 100})
+        state = {**build_initial_state(pdf_path, resources), **(anchor or {})}
+
+        resources["app"].invoke(state, {"recursion_limit": 100})
         logging.info(f"Successfully finished processing: {pdf_path.name}")
 
     except Exception as e:
         logging.error(f"A critical error occurred while processing {pdf_path.name}: {e}")
         log_failure(pdf_path, e)
 
+    return record_document_timing(time.time() - start_time)
+
+
+def collect_transient_failures(out_dir: Optional[Path] = None) -> list[Path]:
+    """
+    Collects the PDFs whose most recent logged failure is transient.
+
+    Reads the 'failed_pdfs' output (`FAILURE_LOG_PATH` with the CSV backend) and keeps
+    the documents whose latest 'error' looks like a connection problem, timeout or
+    throttling (see `resilience.is_transient_message`), that are still in the
+    documents directory and have not been processed since.
+
+    Args:
+        out_dir (Optional[Path]): The node output directory of a sharded run.
 
-def main():
+    Returns:
+        list[Path]: The PDFs to requeue.
+    """
+    latest_error = {}
+    backend = BACKENDS[RESULT_SINK_BACKEND](out_dir)
+    try:
+        for row in backend.read_rows("failed_pdfs"):
+            if row.get("pdf_name"):
+                latest_error[row["pdf_name"]] = row.get("error") or ""
+    finally:
+        backend.close()
+
+    ledger = get_job_ledger()
+    requeue = []
+    for pdf_name, error in latest_error.items():
+        pdf_path = Path(DOCUMENTS_DIR) / pdf_name
+        if is_transient_message(error) and pdf_path.exists() and not ledger.is_finished(pdf_name):
+            requeue.append(pdf_path)
+
+    logging.info(f"{len(requeue)} of {len(latest_error)} logged failures are transient and will be requeued.")
+    return requeue
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Extract structured component data from PDF datasheets.")
+    parser.add_argument("--requeue-transient", action="store_true",
+                        help="Only re-run documents whose last logged failure (failed_pdfs) was transient.")
+    parser.add_argument("--no-llm-cache", action="store_true",
+                        help="Bypass LLM response cache lookups for this run (fresh responses are still stored).")
+    parser.add_argument("--limit", type=int, default=DOCUMENT_LIMIT,
+                        help="Maximum number of documents to process in this run.")
+    parser.add_argument("--order", choices=ORDERS, default=DOCUMENT_ORDER,
+                        help="Submission order; 'size' processes the smallest PDFs first for fast early results.")
+    parser.add_argument("--shard-mode", choices=SHARD_MODES,
+                        help="Share the documents directory with other nodes: a fixed hash partition "
+                             f"or expiring leases in {LEASE_DB_PATH}.")
+    parser.add_argument("--shard-index", type=int, default=0, help="Hash partition of this node (0-based).")
+    parser.add_argument("--shard-count", type=int, default=1, help="Number of hash partitions (nodes).")
+    parser.add_argument("--node-id", default=NODE_ID, help="Name of this node in leases and per-node outputs.")
+    parser.add_argument("--merge-outputs", action="store_true",
+                        help=f"Merge the per-node outputs of a sharded run into {MERGED_OUTPUT_DIR} and exit.")
+    parser.add_argument("--lookup-mpn", metavar="MPN",
+                        help=f"Print the merged entry of an MPN from {MPN_INDEX_DB_PATH} and exit.")
+    parser.add_argument("--export-mpn-index", type=Path, metavar="CSV",
+                        help=f"Export {MPN_INDEX_DB_PATH} (one row per MPN, merged across sources) to CSV and exit.")
+    parser.add_argument("--rebuild-mpn-index", action="store_true",
+                        help=f"Rebuild {MPN_INDEX_DB_PATH} from the validated items already written and exit.")
+    return parser.parse_args()
+
+
+def run_single_stage(pdfs: Iterable[Path], sink: ResultSink, anchors: Optional[AnchorBatcher] = None) -> list:
+    """
+    Processes every PDF end to end in a pool of warm worker processes.
+
+    PDFs are pulled from `pdfs` only while fewer than MAX_IN_FLIGHT documents are
+    submitted, so neither the listing nor the futures are held in memory.
+
+    Args:
+        pdfs (Iterable[Path]): The PDFs to process, consumed lazily.
+        sink (ResultSink): The running result sink the workers write to.
+        anchors (Optional[AnchorBatcher]): The batcher that classified `pdfs`, if any.
+
+    Returns:
+        list: The timing records returned by the workers.
+    """
+    # Assign a GPU to each worker process in a round-robin fashion; every worker
+    # keeps its GPU (and its warm converter, clients and graph) for its whole life.
+    gpu_queue = multiprocessing.Queue()
+    for i in range(MAX_WORKERS):
+        gpu_queue.put(i % NUM_GPUS)
+
+    timings = []
+
+    def collect(done, future_to_pdf):
+        for future in done:
+            pdf = future_to_pdf.pop(future)
+            try:
+                timings.append(future.result())
+            except Exception as exc:
+                logging.error(f'{pdf.name} generated an exception in the worker: {exc}')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker,
+                                                initargs=(gpu_queue, "full", sink.queue)) as executor:
+        logging.info(f"Starting PDF processing with {MAX_WORKERS} parallel workers across {NUM_GPUS} GPUs...")
+
+        future_to_pdf = {}
+        for pdf in pdfs:
+            if len(future_to_pdf) >= MAX_IN_FLIGHT:
+                done, _ = concurrent.futures.wait(future_to_pdf, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done, future_to_pdf)
+            anchor = anchors.pop_anchor(pdf.name) if anchors else None
+            future_to_pdf[executor.submit(process_single_pdf, pdf, anchor)] = pdf
+
+        while future_to_pdf:
+            done, _ = concurrent.futures.wait(future_to_pdf, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done, future_to_pdf)
+    return timings
+
+
+def main(args: argparse.Namespace):
     """
     Main function to manage the batch processing of PDF documents across multiple GPUs.
     """
     load_dotenv(find_dotenv())
+    if args.merge_outputs:
+        merge_outputs(RESULT_SINK_BACKEND)
+        return
+
+    if args.lookup_mpn or args.export_mpn_index or args.rebuild_mpn_index:
+        index = MpnIndex()
+        if args.rebuild_mpn_index:
+            backend = BACKENDS[RESULT_SINK_BACKEND]()
+            try:
+                index.rebuild(backend.read_rows("validated_items"))
+            finally:
+                backend.close()
+        if args.lookup_mpn:
+            entry = index.lookup(args.lookup_mpn)
+            print(json.dumps(entry, indent=2, ensure_ascii=False) if entry else f"{args.lookup_mpn}: not in the index")
+        if args.export_mpn_index:
+            index.export(args.export_mpn_index)
+        return
+    if args.no_llm_cache:
+        # Set before the worker pools start so that every worker process inherits it.
+        os.environ[BYPASS_ENV_VAR] = "1"
 
     if NUM_GPUS == 0:
         logging.error("No GPUs found. Please ensure PyTorch and CUDA are set up correctly. Exiting.")
@@ -77,40 +215,48 @@ def main():
     
     logging.info(f"Found {NUM_GPUS} GPUs. Distributing work accordingly.")
 
-    all_pdfs = list(Path(DOCUMENTS_DIR).glob("*.pdf"))
-    logging.info(f"Found {len(all_pdfs)} total PDFs in the documents directory.")
+    ledger = get_job_ledger()
+    if args.requeue_transient:
+        pdfs = iter(collect_transient_failures(node_output_dir(args.node_id) if args.shard_mode else None))
+    else:
+        pdfs = iter_pdfs(Path(DOCUMENTS_DIR), args.order)
+        if args.shard_mode == "hash":
+            pdfs = iter_hash_partition(pdfs, args.shard_index, args.shard_count)
+        pdfs = iter_remaining(pdfs, ledger)
 
-    if not all_pdfs:
-        logging.info("No PDFs to process. Exiting.")
-        return
-
-    file_limit = 4000
-    files_to_process = all_pdfs[:file_limit]
-    logging.info(f"Processing up to {len(files_to_process)} files due to limit of {file_limit}.")
+    # Sharded runs write per-node outputs, merged afterwards with --merge-outputs.
+    out_dir = None
+    leases = contextlib.nullcontext()
+    if args.shard_mode:
+        out_dir = node_output_dir(args.node_id)
+        logging.info(f"Node '{args.node_id}' running in {args.shard_mode} shard mode; outputs go to {out_dir}.")
+    if args.shard_mode == "lease":
+        store = LeaseStore(LEASE_DB_PATH, node_id=args.node_id)
+        pdfs = iter_leased(pdfs, store)
+        leases = LeaseKeeper(store, ledger)
+    stop = install_drain_handler()
+    files_to_process = until_drained(pdfs, stop, args.limit)
+    logging.info(f"Streaming PDFs from {DOCUMENTS_DIR} (order: {args.order}, limit: {args.limit or 'none'}).")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        logging.info(f"Starting PDF processing with {MAX_WORKERS} parallel workers across {NUM_GPUS} GPUs...")
-
-        future_to_pdf = {}
-        for i, pdf in enumerate(files_to_process):
-            # Assign a GPU to each task in a round-robin fashion
-            gpu_id_to_use = i % NUM_GPUS
-            future = executor.submit(process_single_pdf, pdf, gpu_id_to_use)
-            future_to_pdf[future] = pdf
-
-        for future in concurrent.futures.as_completed(future_to_pdf):
-            pdf = future_to_pdf[future]
-            try:
-                future.result()
-            except Exception as exc:
-                logging.error(f'{pdf.name} generated an exception in the worker: {exc}')
+    # Every worker sends its output rows to this single writer.
+    with leases, ResultSink(out_dir=out_dir) as sink:
+        anchors = None
+        if ANCHOR_BEFORE_CONVERSION and ANCHOR_BATCH_SIZE > 1:
+            anchors = AnchorBatcher()
+            files_to_process = anchors.iter_anchored(files_to_process)
+        if PIPELINE_MODE == "async":
+            timings = run_async(files_to_process, anchors)
+        elif PIPELINE_MODE == "two_stage":
+            timings = run_two_stage(files_to_process, anchors)
+        else:
+            timings = run_single_stage(files_to_process, sink, anchors)
 
     logging.info("All PDF processing tasks have been completed.")
+    logging.info(f"Job ledger status counts: {ledger.summary()}")
+    report_timings(timings)
+    if anchors:
+        anchors.report()
 
 
 if __name__ == "__main__":
-    if not FAILURE_LOG_PATH.exists():
-        with open(FAILURE_LOG_PATH, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["timestamp", "pdf_name", "error"])
-    main()
\ No newline at end of file
+    main(parse_args())
\ No newline at end of file
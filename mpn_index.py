@@ -0,0 +1,230 @@
+import csv
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from config import MPN_INDEX_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Columns of `MpnIndex.export`; the list-valued ones are joined with ", ".
+EXPORT_COLUMNS = ["mpn", "top_markings", "package_cases", "description", "manufacturers", "sources", "source_count"]
+_LIST_FIELDS = ("top_markings", "package_cases", "manufacturers", "sources")
+
+_DASHES = str.maketrans({"‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "−": "-"})
+
+# SQLite limits the number of host parameters of one statement.
+_LOOKUP_BATCH = 500
+
+
+def normalize_mpn(mpn: Any) -> str:
+    """
+    Returns the index key of an MPN: upper case, without whitespace, with unicode
+    dashes as "-". Suffixes and punctuation are kept, since "X.A" and "X" are
+    different parts.
+    """
+    if mpn is None:
+        return ""
+    return re.sub(r"\s+", "", str(mpn).translate(_DASHES)).upper()
+
+
+def _values(value: Any, split: bool = False) -> List[str]:
+    # Validated items hold merged package cases as "A, B". Top markings and manufacturer
+    # names can contain commas themselves ("Diodes, Inc."), so they are kept whole.
+    if not value:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [str(v).strip() for v in value if str(v).strip()]
+    parts = str(value).split(",") if split else [str(value)]
+    return [part.strip() for part in parts if part.strip()]
+
+
+class MpnIndex:
+    """
+    On-disk index of the validated items of the whole corpus, keyed by normalized MPN.
+
+    `update` merges new validated rows into the entries of their MPNs: top markings,
+    package cases, manufacturers and sources are accumulated across documents, and the
+    first non-empty description is kept. The result sink calls it for every flushed
+    batch of validated items, so the index stays current without rescanning the
+    output files. `lookup` is a primary-key read; `export` streams the entries in MPN
+    order.
+    """
+
+    def __init__(self, db_path: Path = MPN_INDEX_DB_PATH):
+        self.db_path = Path(db_path)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each process opens its own lazily.
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS mpns ("
+                "key TEXT PRIMARY KEY, mpn TEXT NOT NULL, top_markings TEXT NOT NULL, package_cases TEXT NOT NULL, "
+                "description TEXT NOT NULL, manufacturers TEXT NOT NULL, sources TEXT NOT NULL, "
+                "source_count INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def _fetch(self, conn: sqlite3.Connection, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        entries = {}
+        for start in range(0, len(keys), _LOOKUP_BATCH):
+            batch = keys[start:start + _LOOKUP_BATCH]
+            rows = conn.execute(
+                f"SELECT key, {', '.join(EXPORT_COLUMNS)} FROM mpns WHERE key IN ({', '.join('?' for _ in batch)})",
+                batch
+            )
+            for row in rows:
+                entry = dict(zip(EXPORT_COLUMNS, row[1:]))
+                for field in _LIST_FIELDS:
+                    entry[field] = json.loads(entry[field])
+                entries[row[0]] = entry
+        return entries
+
+    def update(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Merges validated item rows into the index, in one transaction.
+
+        Args:
+            rows (Iterable[Dict[str, Any]]): Rows with the validated item columns
+                                             (mpn, top_marking, package_case, description,
+                                             manufacturer, source).
+
+        Returns:
+            int: The number of index entries that were created or updated.
+        """
+        grouped: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            key = normalize_mpn(row.get("mpn"))
+            if key:
+                grouped.setdefault(key, []).append(row)
+        if not grouped:
+            return 0
+
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                entries = self._fetch(conn, list(grouped))
+                now = time.time()
+                upserts = []
+                for key, group in grouped.items():
+                    entry = entries.get(key) or {
+                        "mpn": str(group[0]["mpn"]).strip(), "description": "",
+                        **{field: [] for field in _LIST_FIELDS}
+                    }
+                    merged = {field: set(entry[field]) for field in _LIST_FIELDS}
+                    for row in group:
+                        merged["top_markings"].update(_values(row.get("top_marking")))
+                        merged["package_cases"].update(_values(row.get("package_case"), split=True))
+                        merged["manufacturers"].update(_values(row.get("manufacturer")))
+                        if row.get("source"):
+                            merged["sources"].add(str(row["source"]))
+                        if not entry["description"] and row.get("description"):
+                            entry["description"] = str(row["description"])
+                    lists = {field: json.dumps(sorted(values)) for field, values in merged.items()}
+                    upserts.append((
+                        key, entry["mpn"], lists["top_markings"], lists["package_cases"], entry["description"],
+                        lists["manufacturers"], lists["sources"], len(merged["sources"]), now
+                    ))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO mpns (key, mpn, top_markings, package_cases, description, manufacturers, "
+                    "sources, source_count, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    upserts
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(upserts)
+
+    def lookup(self, mpn: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the merged entry of an MPN, or None if it was never extracted.
+
+        Args:
+            mpn (str): The MPN, in any spelling that normalizes to the same key.
+
+        Returns:
+            Optional[Dict[str, Any]]: The entry with the EXPORT_COLUMNS fields.
+        """
+        key = normalize_mpn(mpn)
+        if not key:
+            return None
+        with self._lock:
+            return self._fetch(self._connection(), [key]).get(key)
+
+    def entries(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yields every entry of the index in MPN order.
+
+        The rows are streamed from their own read connection (WAL readers do not block
+        the writer), so neither the whole index nor the shared connection is held.
+        """
+        with self._lock:
+            self._connection()  # Creates the database and table if needed.
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            for row in conn.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM mpns ORDER BY key"):
+                entry = dict(zip(EXPORT_COLUMNS, row))
+                for field in _LIST_FIELDS:
+                    entry[field] = json.loads(entry[field])
+                yield entry
+        finally:
+            conn.close()
+
+    def export(self, path: Path) -> int:
+        """
+        Writes the index to a CSV file with EXPORT_COLUMNS.
+
+        Args:
+            path (Path): The CSV file to write.
+
+        Returns:
+            int: The number of exported MPNs.
+        """
+        count = 0
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+            for entry in self.entries():
+                writer.writerow({k: ", ".join(v) if k in _LIST_FIELDS else v for k, v in entry.items()})
+                count += 1
+        logger.info(f"Exported {count} MPNs from {self.db_path} to {path}")
+        return count
+
+    def rebuild(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Recreates the index from scratch, e.g. from the validated items written before
+        the index existed.
+
+        Args:
+            rows (Iterable[Dict[str, Any]]): All validated item rows.
+
+        Returns:
+            int: The number of indexed MPNs.
+        """
+        with self._lock:
+            self._connection().execute("DELETE FROM mpns")
+        self.update(rows)
+        with self._lock:
+            count = self._connection().execute("SELECT COUNT(*) FROM mpns").fetchone()[0]
+        logger.info(f"Rebuilt {self.db_path} with {count} MPNs.")
+        return count
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
@@ -1,28 +1,93 @@
-import ast
+import asyncio
 import json
 import logging
 import re
 import shutil
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List
 
-import pandas as pd
-from docling_core.types.doc import (ImageRefMode, PictureItem, TableItem)
-
-from config import CSV_FAILED_OUTPUT, CSV_SKIPPED_OUTPUT, FAILED_DIR, MARKDOWN_DIR, METADATA_DIR, PROCESSED_DIR, SKIPPED_DIR
-from helpers import chunk_markdown, clean_markdown_text, extract_all_tables_with_optional_header, generate_anchor_prompt, generate_prompt, generate_repair_prompt, save_items, save_validated_items, score_chunk, log_failure
+from config import (ANCHOR_BEFORE_CONVERSION, ANCHOR_EXCERPT_MIN_CHARS, ANCHOR_EXCERPT_PAGES, ARCHIVE_FINISHED_PDFS,
+                    DEDUP_ENABLED, EXTRACTION_OUTPUT_MODE, EXTRACTION_STRATEGY, FAILED_DIR, JSON_OUTPUT_FORMATS,
+                    MAP_REDUCE_CALL_TOKENS, MAP_REDUCE_CONCURRENCY, MAP_REDUCE_MAX_CALLS, MARKDOWN_DIR, METADATA_DIR,
+                    PROCESSED_DIR, SKIPPED_DIR)
+from helpers import CHUNK_SEPARATOR, STRUCTURED_OUTPUT_INSTRUCTION, chunk_markdown, clean_markdown_text, completion_token_cap, extraction_response_format, extract_all_tables_with_optional_header, group_chunks, generate_anchor_prompt, generate_prompt, generate_repair_prompt, normalize_components, save_items, save_validated_items, select_chunks, log_failure
+from conversion import convert_with_cache, file_sha256, page_count, read_text_layer, record_skipped_conversion
+from dedup import get_dedup_store, minhash_signature
+from job_ledger import get_job_ledger
+from json_repair import record_outcome, repair_json
+from llm import achat_completion, astream_items, chat_completion, stream_items
+from result_sink import write_rows
 logger = logging.getLogger(__name__)
 
+# Results of a canonical document that a duplicate reuses.
+DUPLICATE_RESULT_KEYS = ("items", "validated_items", "component", "description", "package_case")
+
+def check_duplicate(state: Dict) -> Dict:
+    """
+    Node: Detects whether the document duplicates an already extracted one.
+
+    Runs before the conversion on the PDF bytes and text layer and, for documents
+    whose text layer was too short to compare (e.g. scans), once more on the
+    converted markdown. A document with the same SHA-256 as a canonical document, or
+    whose MinHash signature is at least DEDUP_SIMILARITY similar to one, takes over
+    the canonical document's results and goes straight to `finalize`, which attributes
+    them to its own source.
+
+    Args:
+        state (Dict): The current state, must contain 'pdf_path'.
+
+    Returns:
+        Dict: The state with 'duplicate_of' and the reused results set, or with the
+              document's 'sha256' and 'dedup_signature' for its later registration.
+    """
+    pdf = Path(state["pdf_path"])
+    signature = state.get("dedup_signature")
+    if not DEDUP_ENABLED or signature or get_job_ledger().is_finished(pdf.name):
+        return state
+    if signature is None:
+        try:
+            text = "\n".join(read_text_layer(pdf))
+        except Exception as e:
+            logger.warning(f"Could not read the text layer of {pdf.name}: {e}")
+            text = ""
+    elif state.get("full_markdown_content"):
+        text = state["full_markdown_content"]
+    else:
+        return state
+
+    sha256 = state.get("sha256") or file_sha256(pdf)
+    signature = minhash_signature(text)
+    match = get_dedup_store().find(pdf.name, sha256, signature)
+    if match is None:
+        return {**state, "sha256": sha256, "dedup_signature": signature}
+    canonical, score, result = match
+    logger.info(f"{pdf.name} duplicates {canonical} (similarity {score:.2f}); reusing its extraction.")
+    return {**state, **{k: result.get(k) for k in DUPLICATE_RESULT_KEYS}, "sha256": sha256,
+            "dedup_signature": signature, "duplicate_of": canonical, "duplicate_similarity": round(score, 3)}
+
+def _register_canonical(state: Dict):
+    """Registers a finished extraction in the duplicate detection store."""
+    if not DEDUP_ENABLED or state.get("duplicate_of") or not state.get("sha256"):
+        return
+    result = {k: state.get(k) for k in DUPLICATE_RESULT_KEYS}
+    try:
+        get_dedup_store().register(Path(state["pdf_path"]).name, state["sha256"],
+                                   state.get("dedup_signature") or b"", result)
+    except Exception as e:
+        logger.warning(f"Could not register {Path(state['pdf_path']).name} for duplicate detection: {e}")
+
 def load_and_split(state: Dict) -> Dict:
     """
     Node: Loads a PDF, converts it to markdown, and splits it into chunks.
 
     This is the entry point of the processing graph. It performs the following steps:
     1. Checks if the PDF has already been processed and skips if so.
-    2. If no markdown file exists, it converts the PDF to markdown, saving referenced
-       images and tables.
+    2. Converts the PDF to markdown, saving referenced images and tables, unless the
+       conversion cache already holds the output for the same PDF bytes and
+       converter options. Pages with a usable text layer skip OCR when a
+       'text_converter' is given.
     3. It cleans the markdown and extracts only the tables and their headers.
     4. The table-focused markdown is then split into smaller, manageable chunks.
     5. Updates the state with the markdown content and the list of chunks.
@@ -37,49 +102,26 @@ def load_and_split(state: Dict) -> Dict:
     converter = state["converter"]
 
     MARKDOWN_DIR.mkdir(exist_ok=True)
-    PROCESSED_DIR.mkdir(exist_ok=True)
 
-    processed_path = PROCESSED_DIR / pdf.name
-    if processed_path.exists():
+    ledger = get_job_ledger()
+    if ledger.is_finished(pdf.name):
         logger.info(f"Skipping already processed: {pdf.name}")
         return state
 
     output_dir = MARKDOWN_DIR / pdf.stem
     output_dir.mkdir(parents=True, exist_ok=True)
-    md_path = output_dir / f"{pdf.stem}-with-image-refs.md"
 
     logger.info(f"Processing for OCR: {pdf.name}")
 
     try:
-        if not md_path.exists():
-            logger.info("Markdown not found. Converting PDF...")
-            start_time = time.time()
-            conv_res = converter.convert(pdf)
-
-            doc_filename = pdf.stem
-
-            table_counter = 0
-            picture_counter = 0
-
-            for element, _level in conv_res.document.iterate_items():
-                if isinstance(element, TableItem):
-                    table_counter += 1
-                    element_image_filename = output_dir / f"{doc_filename}-table-{table_counter}.png"
-                    with element_image_filename.open("wb") as fp:
-                        element.get_image(conv_res.document).save(fp, "PNG")
-
-                if isinstance(element, PictureItem):
-                    picture_counter += 1
-                    element_image_filename = output_dir / f"{doc_filename}-picture-{picture_counter}.png"
-                    with element_image_filename.open("wb") as fp:
-                        element.get_image(conv_res.document).save(fp, "PNG")
-
-            conv_res.document.save_as_markdown(md_path,image_mode=ImageRefMode.REFERENCED)
-            logger.info(f"Markdown with image refs saved to: {md_path}")
-
-            logger.info(f"Document converted and figures exported in {time.time() - start_time:.2f} seconds.")
-        else:
-            logger.info("Markdown already exists. Skipping conversion.")
+        # `check_duplicate` usually hashed the PDF already.
+        sha256 = state.get("sha256") or file_sha256(pdf)
+        md_path, conversion_key, conversion_stats = convert_with_cache(pdf, converter, state.get("text_converter"),
+                                                                       sha256=sha256)
+        state["sha256"] = sha256
+        state["conversion_key"] = conversion_key
+        state["conversion_stats"] = conversion_stats
+        ledger.set_hash(pdf.name, sha256)
 
         # Save picture text into a separate JSON file
         # logger.info("Extracting picture text...")
@@ -135,42 +177,24 @@ def load_and_split(state: Dict) -> Dict:
 
         return {**state, "chunks": []}
     
-def extract_anchor(state: Dict) -> Dict:
-    """
-    Node: Extracts the "anchor" component information from the start of the document.
-
-    This node calls the LLM with a specialized prompt to get the main component name,
-    description, and classification. It uses this information to decide whether to
-    skip processing the document entirely (e.g., if it's a chip component or THT).
-
-    Args:
-        state (Dict): The current state, must contain 'markdown' and 'client_anchor'.
-
-    Returns:
-        Dict: The updated state with 'component', 'description', and potentially a 'skip_reason'.
-    """
-    client = state["client_anchor"]
-    excerpt = "\n".join(state["markdown"].splitlines()[:100]).strip()
-
+def _anchor_messages(text: str) -> List[Dict[str, str]]:
+    """Builds the chat messages for the anchor extraction from the start of a document's text."""
+    excerpt = "\n".join(text.splitlines()[:100]).strip()
     prompt = generate_anchor_prompt(excerpt)
+    return [
+        {"role": "system", "content": "You are an information extraction assistant."},
+        {"role": "user", "content": prompt}
+    ]
 
-    resp = client.chat.completions.create(
-        model=state["anchor_model_name"],
-        messages=[
-            {"role": "system", "content": "You are an information extraction assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0
-    )
-
-    raw = resp.choices[0].message.content.strip()
-
+def _apply_anchor_response(state: Dict, raw: str) -> Dict:
+    """Parses the anchor response and decides whether the document is skipped."""
     match = re.search(r"```json\s*(.*?)```", raw, re.DOTALL)
     if match:
         json_to_parse = match.group(1).strip()
     else:
         json_to_parse = raw
 
+    component, description, package_case, is_chip, explanation = [], "", "", False, None
     try:
         data = json.loads(json_to_parse)
         if isinstance(data, list) and len(data) > 0:
@@ -180,12 +204,8 @@ def extract_anchor(state: Dict) -> Dict:
             package_case = item_data.get("package_case", "")
             is_chip = item_data.get("is_chip_component", False)
             explanation = item_data.get("explanation")
-
-        else:
-            component, description, is_chip = [], "", False, False
     except Exception as e:
         logger.warning(f"Anchor parse failed: {e}")
-        component, description, is_chip = [], "", False, False
     
     skip_reason = None
     if is_chip:
@@ -197,41 +217,118 @@ def extract_anchor(state: Dict) -> Dict:
     
     return {**state, "component": component, "package_case": package_case, "description": description, "items": []}
 
+def extract_anchor(state: Dict) -> Dict:
+    """
+    Node: Extracts the "anchor" component information from the start of the document.
+
+    This node calls the LLM with a specialized prompt to get the main component name,
+    description, and classification. It uses this information to decide whether to
+    skip processing the document entirely (e.g., if it's a chip component or THT).
+
+    Args:
+        state (Dict): The current state, must contain 'markdown' and 'client_anchor'.
+
+    Returns:
+        Dict: The updated state with 'component', 'description', and potentially a 'skip_reason'.
+    """
+    raw = chat_completion(state["client_anchor"], state["anchor_model_name"], _anchor_messages(state["markdown"]))
+    return {**_apply_anchor_response(state, raw), "anchor_source": "markdown"}
+
+async def aextract_anchor(state: Dict) -> Dict:
+    """
+    Node: Async version of `extract_anchor`, for use with the async LLM clients.
+    """
+    raw = await achat_completion(state["client_anchor"], state["anchor_model_name"], _anchor_messages(state["markdown"]))
+    return {**_apply_anchor_response(state, raw), "anchor_source": "markdown"}
+
+def anchor_excerpt(state: Dict) -> str:
+    """
+    Returns the text layer of the first pages of the PDF for the early anchor step, or
+    "" if there is nothing to classify early (disabled, already anchored by the batched
+    anchor step, already processed, or too little embedded text, e.g. a scanned document).
+    """
+    pdf = Path(state["pdf_path"])
+    if not ANCHOR_BEFORE_CONVERSION or state.get("anchor_source") or get_job_ledger().is_finished(pdf.name):
+        return ""
+    try:
+        excerpt = "\n".join(read_text_layer(pdf, max_pages=ANCHOR_EXCERPT_PAGES)).strip()
+    except Exception as e:
+        logger.warning(f"Could not read the text layer of {pdf.name}: {e}")
+        return ""
+    if len(excerpt) < ANCHOR_EXCERPT_MIN_CHARS:
+        logger.info(f"Text layer of {pdf.name} too short for the early anchor; classifying after conversion.")
+        return ""
+    return excerpt
+
+def apply_early_anchor_response(state: Dict, raw: str) -> Dict:
+    """Applies the anchor response of the text-layer excerpt and counts the conversion it saved."""
+    state = {**_apply_anchor_response(state, raw), "anchor_source": "text_layer"}
+    if state.get("skip_reason"):
+        try:
+            record_skipped_conversion(page_count(Path(state["pdf_path"])))
+        except Exception as e:
+            logger.warning(f"Could not count the pages of {Path(state['pdf_path']).name}: {e}")
+    return state
+
+def anchor_before_conversion(state: Dict) -> Dict:
+    """
+    Node: Runs the anchor extraction on the text layer of the first pages, before the
+    conversion.
+
+    Documents classified as skipped components then never pay the conversion cost. If
+    the PDF has too little embedded text, the state is returned unchanged and the
+    anchor runs on the converted markdown (`extract_anchor`) instead. A state already
+    classified by the batched anchor step (`anchor_batcher.py`) is returned unchanged.
+
+    Args:
+        state (Dict): The current state, must contain 'pdf_path' and 'client_anchor'.
+
+    Returns:
+        Dict: The state with the anchor fields and 'anchor_source' set, or unchanged.
+    """
+    excerpt = anchor_excerpt(state)
+    if not excerpt:
+        return state
+    raw = chat_completion(state["client_anchor"], state["anchor_model_name"], _anchor_messages(excerpt))
+    return apply_early_anchor_response(state, raw)
+
+async def aanchor_before_conversion(state: Dict) -> Dict:
+    """
+    Node: Async version of `anchor_before_conversion`, for use with the async LLM clients.
+    """
+    excerpt = await asyncio.to_thread(anchor_excerpt, state)
+    if not excerpt:
+        return state
+    raw = await achat_completion(state["client_anchor"], state["anchor_model_name"], _anchor_messages(excerpt))
+    return await asyncio.to_thread(apply_early_anchor_response, state, raw)
+
 def filter_chunks(state: Dict) -> Dict:
     """
     Node: Filters and combines chunks to create a single, high-relevance input for the LLM.
 
-    This optimization step scores all chunks, selects the top 4 highest-scoring chunks,
-    and then combines them into a single, dense text block. This reduces the number
-    of LLM calls and focuses the model on the most important parts of the document.
+    This optimization step scores all chunks (keyword counts or BM25, per
+    CHUNK_RANKING), selects the relevant chunks with the highest total score that fit the token budget of the
+    model (CHUNK_TOKEN_BUDGETS), and then combines them into a single, dense text
+    block. This reduces the number of LLM calls and focuses the model on the most
+    important parts of the document without overflowing its context.
 
     Args:
         state (Dict): The current state, must contain 'chunks' and 'component'.
 
     Returns:
-        Dict: The updated state with 'final_chunks' containing the combined top chunks.
+        Dict: The updated state with 'final_chunks' containing the combined top chunks
+        and 'chunk_budget' describing the budget and its utilization.
     """
     chunks = state.get("chunks", [])
-    raw_components = state.get("component", "[]")
+    components = normalize_components(state.get("component", "[]"))
     title = state.get("title", "")
-    
-    if isinstance(raw_components, str):
-        raw_components = raw_components.strip()
-        try:
-            parsed = ast.literal_eval(raw_components)
-            components = parsed if isinstance(parsed, list) else [str(parsed)]
-        except (ValueError, SyntaxError):
-            components = [raw_components.strip('"')]
-    elif isinstance(raw_components, list):
-        components = raw_components
-    else:
-        components = []
 
-    # 1. Score each chunk and store it with its original index.
-    indexed_scored_chunks = [
-        (i, chunk, score_chunk(chunk, components, title))
-        for i, chunk in enumerate(chunks)
-    ]
+    # 1. Score each chunk and pack the relevant ones with the highest total score
+    #    into the model's token budget.
+    map_reduce = EXTRACTION_STRATEGY == "map_reduce"
+    budget = MAP_REDUCE_MAX_CALLS * MAP_REDUCE_CALL_TOKENS if map_reduce else None
+    scores, selected, chunk_budget = select_chunks(chunks, components, title, state.get("model_name", ""), budget=budget)
+    indexed_scored_chunks = list(zip(range(len(chunks)), chunks, scores))
 
     print("\n--- Chunk Scoring Details ---")
     if not indexed_scored_chunks:
@@ -241,27 +338,19 @@ def filter_chunks(state: Dict) -> Dict:
             print(f"  - Chunk {i+1:02d}/{len(chunks):02d} | Score: {score}")
     print("---------------------------\n")
 
-    high_scoring_chunks = [
-        (i, chunk, score) 
-        for i, chunk, score in indexed_scored_chunks if score > 1
-    ]
-    
-    # 2. Temporarily sort the high-scoring chunks by score to find the top 3.
-    sorted_by_score = sorted(high_scoring_chunks, key=lambda x: x[2], reverse=True)
-
-    # 3. Slice to get only the top 6 entries.
-    top_entries = sorted_by_score[:6]
-
-    # 4. Sort the top entries back by their original index.
-    top_entries_in_original_order = sorted(top_entries, key=lambda x: x[0])
-
-    # 5. Extract the text of the top chunks.
-    final_top_chunks = [chunk for i, chunk, score in top_entries_in_original_order]
-
-    # 6. Combine the top chunks into a single final_chunk ---
-    if final_top_chunks:
-        final_chunk = "\n\n---\n\n".join(final_top_chunks)
-        logger.info(f"Combined the top {len(final_top_chunks)} chunks into a single chunk for processing.")
+    # 2. Extract the text of the selected chunks, in their original order.
+    final_top_chunks = [chunks[i] for i in selected]
+
+    # 3. Combine the selected chunks into a single final_chunk, or into parts for
+    #    map-reduce extraction ---
+    if final_top_chunks and map_reduce:
+        chunks_for_llm = group_chunks(final_top_chunks, MAP_REDUCE_CALL_TOKENS)
+        logger.info(f"Grouped {len(final_top_chunks)} of {chunk_budget['candidate_chunks']} relevant chunks into "
+                    f"{len(chunks_for_llm)} part(s) for map-reduce extraction ({chunk_budget['used_tokens']} tokens).")
+    elif final_top_chunks:
+        final_chunk = CHUNK_SEPARATOR.join(final_top_chunks)
+        logger.info(f"Combined {len(final_top_chunks)} of {chunk_budget['candidate_chunks']} relevant chunks into a single chunk "
+                    f"({chunk_budget['used_tokens']}/{chunk_budget['budget_tokens']} tokens, {chunk_budget['utilization']:.0%} of the budget).")
         chunks_for_llm = [final_chunk]
     else:
         logger.warning("No relevant chunks found after filtering. Nothing to process.")
@@ -272,7 +361,67 @@ def filter_chunks(state: Dict) -> Dict:
         for i, chunk, score in indexed_scored_chunks
     ]
 
-    return {**state, "final_chunks": chunks_for_llm, "chunk_scores": chunk_scores_data, "items": []}
+    chunk_budget["calls"] = len(chunks_for_llm)
+
+    return {**state, "final_chunks": chunks_for_llm, "chunk_scores": chunk_scores_data,
+            "chunk_budget": chunk_budget, "items": []}
+
+def _extraction_messages(state: Dict, chunk: str, prev_items: List[dict]) -> List[Dict[str, str]]:
+    """Builds the chat messages for the main extraction from a chunk."""
+    prompt = generate_prompt(chunk, prev_items, state["component"])
+    return [
+        {"role": "system", "content": "You are an information extraction assistant."},
+        {"role": "user", "content": prompt}
+    ]
+
+def _extraction_output_mode(model_name: str) -> str:
+    """Resolves EXTRACTION_OUTPUT_MODE for a model: "text", "stream", "json_schema" or "json_object"."""
+    if EXTRACTION_OUTPUT_MODE == "json":
+        return JSON_OUTPUT_FORMATS.get(model_name, "stream")
+    return EXTRACTION_OUTPUT_MODE
+
+def _structured_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Asks for the items wrapped in a JSON object, as structured output requires."""
+    return messages + [{"role": "user", "content": STRUCTURED_OUTPUT_INSTRUCTION}]
+
+def _unwrap_structured(raw: str) -> str:
+    """Returns the "items" array of a structured reply as JSON, or the reply itself."""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return raw
+    if isinstance(data, dict) and isinstance(data.get("items"), list):
+        return json.dumps(data["items"], ensure_ascii=False)
+    return raw
+
+def _request_items(state: Dict, chunk: str, prev_items: List[dict]) -> str:
+    """Sends one extraction request for a chunk, in the configured output mode."""
+    messages = _extraction_messages(state, chunk, prev_items)
+    output_mode = _extraction_output_mode(state["model_name"])
+    if output_mode == "stream":
+        return stream_items(state["client"], state["model_name"], messages, completion_token_cap(chunk, prev_items))
+    if output_mode == "text":
+        return chat_completion(state["client"], state["model_name"], messages)
+    return _unwrap_structured(chat_completion(
+        state["client"], state["model_name"], _structured_messages(messages),
+        response_format=extraction_response_format(output_mode)
+    ))
+
+async def _arequest_items(state: Dict, chunk: str, prev_items: List[dict]) -> str:
+    """Async version of `_request_items`."""
+    messages = _extraction_messages(state, chunk, prev_items)
+    output_mode = _extraction_output_mode(state["model_name"])
+    if output_mode == "stream":
+        return await astream_items(state["client"], state["model_name"], messages, completion_token_cap(chunk, prev_items))
+    if output_mode == "text":
+        return await achat_completion(state["client"], state["model_name"], messages)
+    return _unwrap_structured(await achat_completion(
+        state["client"], state["model_name"], _structured_messages(messages),
+        response_format=extraction_response_format(output_mode)
+    ))
+
+def _as_items(data: Any) -> List[dict]:
+    return [item for item in data if isinstance(item, dict)] if isinstance(data, list) else []
 
 def call_llm(state: Dict) -> Dict:
     """
@@ -280,6 +429,14 @@ def call_llm(state: Dict) -> Dict:
 
     This node takes the (filtered and combined) chunk, constructs the main extraction
     prompt, sends it to the LLM, and stores the raw string response in the state.
+    Depending on EXTRACTION_OUTPUT_MODE the reply is a plain completion, structured
+    JSON output, or a stream whose items are parsed as they arrive; the latter two
+    store the items as a JSON array.
+
+    With several parts in 'final_chunks' (map-reduce extraction), each part is
+    extracted by an independent call, up to MAP_REDUCE_CONCURRENCY at a time, and
+    every response is parsed on its own; the concatenated items are stored in
+    'merged_items' for `parse_and_repair`.
 
     Args:
         state (Dict): The current state, containing 'final_chunks', 'items', 'component', etc.
@@ -287,73 +444,105 @@ def call_llm(state: Dict) -> Dict:
     Returns:
         Dict: The updated state with the 'raw_response' from the LLM.
     """
-    chunk = state["final_chunks"][0]
-    prompt = generate_prompt(chunk, state["items"], state["component"])
-    
-    resp = state["client"].chat.completions.create(
-        model=state["model_name"],
-        messages=[
-            {"role": "system", "content": "You are an information extraction assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0
-    )
+    parts = state["final_chunks"]
+    if len(parts) == 1:
+        raw = _request_items(state, parts[0], state["items"])
+        return {**state, "raw_response": raw, "merged_items": None}
 
-    return {**state, "raw_response": resp.choices[0].message.content.strip()}
+    def extract_part(chunk: str) -> List[dict]:
+        return _as_items(_parse_response(state, _request_items(state, chunk, [])))
 
-def parse_and_repair(state: Dict) -> Dict:
-    """
-    Node: Parses the LLM's response and attempts to repair it if it's invalid JSON.
-
-    It first tries to parse the 'raw_response'. If parsing fails, it calls the LLM
-    again with a 'repair' prompt. If the repaired response is valid JSON, it updates
-    the state. Otherwise, it logs a warning.
-
-    Args:
-        state (Dict): The current state, must contain 'raw_response' and 'client'.
+    with ThreadPoolExecutor(max_workers=MAP_REDUCE_CONCURRENCY) as pool:
+        partial_items = list(pool.map(extract_part, parts))
+    return _merge_partial_items(state, partial_items)
 
-    Returns:
-        Dict: The updated state with the parsed 'items'.
+async def acall_llm(state: Dict) -> Dict:
     """
-    client = state["client"]
-    raw = state["raw_response"]
-    cleaned_raw = re.sub(r'<think>.*?</think>', '', raw, flags=re.DOTALL)
-    match = re.search(r'```json\s*([\s\S]*?)\s*```|(\[[\s\S]*\])', cleaned_raw.strip())
-    json_to_parse = None
-    if match:
-        json_to_parse = match.group(1) or match.group(2)
-    else:
-        json_to_parse = cleaned_raw.strip()
-    try:
-        data = json.loads(json_to_parse)
-    except Exception:
-        logger.info("Initial JSON parsing failed. Attempting repair...")
+    Node: Async version of `call_llm`, for use with the async LLM clients.
+    """
+    parts = state["final_chunks"]
+    if len(parts) == 1:
+        raw = await _arequest_items(state, parts[0], state["items"])
+        return {**state, "raw_response": raw, "merged_items": None}
 
-        repair_prompt = generate_repair_prompt(json_to_parse)
+    semaphore = asyncio.Semaphore(MAP_REDUCE_CONCURRENCY)
 
-        resp = client.chat.completions.create(
-            model=state["model_name"],
-            messages=[
-                {"role": "system", "content": "You are a JSON repair assistant."},
-                {"role": "user","content": repair_prompt}
-            ],
-            temperature=0
-        )
+    async def extract_part(chunk: str) -> List[dict]:
+        async with semaphore:
+            raw = await _arequest_items(state, chunk, [])
+            return _as_items(await _aparse_response(state, raw))
 
-        fixed_raw = resp.choices[0].message.content.strip()
+    partial_items = await asyncio.gather(*(extract_part(chunk) for chunk in parts))
+    return _merge_partial_items(state, partial_items)
 
-        match = re.search(r"```json\s*(.*?)```", fixed_raw, re.DOTALL)
-        if match:
-            raw_json = match.group(1).strip()
-        else:
-            raw_json = fixed_raw
+def _merge_partial_items(state: Dict, partial_items: List[List[dict]]) -> Dict:
+    """Concatenates the items of the map-reduce calls; `validate_items` merges them by MPN."""
+    items = [item for part in partial_items for item in part]
+    logger.info(f"Map-reduce extraction: {len(partial_items)} call(s) returned {[len(p) for p in partial_items]} item(s).")
+    return {**state, "raw_response": json.dumps(items, ensure_ascii=False), "merged_items": items}
 
-        try:
-            data = json.loads(raw_json)
-        except Exception as e:
-            logger.warning(f"Final JSON parse after repair failed: {e}")
-            data = []
+def _extract_json_candidate(raw: str) -> str:
+    """Strips <think> blocks and returns the fenced or bracketed JSON part of a response."""
+    cleaned_raw = re.sub(r'<think>.*?</think>', '', raw, flags=re.DOTALL)
+    match = re.search(r'```json\s*([\s\S]*?)\s*```|(\[[\s\S]*\])', cleaned_raw.strip())
+    if match:
+        return match.group(1) or match.group(2)
+    return cleaned_raw.strip()
+
+def _repair_messages(json_to_parse: str) -> List[Dict[str, str]]:
+    """Builds the chat messages asking the LLM to repair a malformed JSON array."""
+    repair_prompt = generate_repair_prompt(json_to_parse)
+    return [
+        {"role": "system", "content": "You are a JSON repair assistant."},
+        {"role": "user","content": repair_prompt}
+    ]
 
+def _parse_locally(json_to_parse: str) -> Any:
+    """Parses a response, repairing it locally if needed; None if the LLM must repair it."""
+    data, outcome = repair_json(json_to_parse)
+    record_outcome(outcome)
+    if outcome in ("repaired", "salvaged"):
+        logger.info(f"Invalid JSON {outcome} locally ({len(data) if isinstance(data, list) else 1} item(s)).")
+    return None if outcome == "failed" else data
+
+def _parse_repaired(fixed_raw: str) -> Any:
+    """Parses the response of the repair call, returning [] if it is still invalid."""
+    record_outcome("llm")
+    match = re.search(r"```json\s*(.*?)```", fixed_raw, re.DOTALL)
+    if match:
+        raw_json = match.group(1).strip()
+    else:
+        raw_json = fixed_raw
+
+    data, outcome = repair_json(raw_json)
+    if outcome == "failed":
+        record_outcome("llm_failed")
+        logger.warning("Final JSON parse after repair failed.")
+        return []
+    return data
+
+def _parse_response(state: Dict, raw: str) -> Any:
+    """Parses an extraction response, repairing it locally or, failing that, with the LLM."""
+    json_to_parse = _extract_json_candidate(raw)
+    data = _parse_locally(json_to_parse)
+    if data is None:
+        logger.info("Local JSON repair failed. Attempting repair with the LLM...")
+        fixed_raw = chat_completion(state["client"], state["model_name"], _repair_messages(json_to_parse))
+        data = _parse_repaired(fixed_raw)
+    return data
+
+async def _aparse_response(state: Dict, raw: str) -> Any:
+    """Async version of `_parse_response`."""
+    json_to_parse = _extract_json_candidate(raw)
+    data = _parse_locally(json_to_parse)
+    if data is None:
+        logger.info("Local JSON repair failed. Attempting repair with the LLM...")
+        fixed_raw = await achat_completion(state["client"], state["model_name"], _repair_messages(json_to_parse))
+        data = _parse_repaired(fixed_raw)
+    return data
+
+def _apply_items(state: Dict, data: Any) -> Dict:
+    """Stores the parsed items in the state if the data is a non-empty list."""
     if isinstance(data, list) and data:
         state["items"] = data
     else:
@@ -361,6 +550,33 @@ def parse_and_repair(state: Dict) -> Dict:
 
     return {**state}
 
+def parse_and_repair(state: Dict) -> Dict:
+    """
+    Node: Parses the LLM's response and attempts to repair it if it's invalid JSON.
+
+    It first tries to parse the 'raw_response', repairing common defects locally
+    (see `json_repair.repair_json`). Only if that fails, it calls the LLM again with
+    a 'repair' prompt. If the repaired response is valid JSON, it updates the
+    state. Otherwise, it logs a warning.
+
+    Args:
+        state (Dict): The current state, must contain 'raw_response' and 'client'.
+
+    Returns:
+        Dict: The updated state with the parsed 'items'.
+    """
+    if state.get("merged_items") is not None:
+        return _apply_items(state, state["merged_items"])
+    return _apply_items(state, _parse_response(state, state["raw_response"]))
+
+async def aparse_and_repair(state: Dict) -> Dict:
+    """
+    Node: Async version of `parse_and_repair`, for use with the async LLM clients.
+    """
+    if state.get("merged_items") is not None:
+        return _apply_items(state, state["merged_items"])
+    return _apply_items(state, await _aparse_response(state, state["raw_response"]))
+
 def decide_what_to_do_next(state: Dict) -> str:
     """
     Node: A central router that decides the next step after an extraction attempt.
@@ -400,7 +616,7 @@ def decide_what_to_do_next(state: Dict) -> str:
 def log_extraction_failure(state: Dict) -> Dict:
     """
     Node: Logs documents from which no items could be extracted after all attempts.
-    Moves the source PDF to the FAILED_EXTRACTION_DIR.
+    Records the failure in the job ledger (and moves the PDF to FAILED_DIR with ARCHIVE_FINISHED_PDFS).
     """
     source_path = Path(state["pdf_path"])
     logger.info(f"Logging complete extraction failure for: {source_path.name}")
@@ -410,13 +626,11 @@ def log_extraction_failure(state: Dict) -> Dict:
         "timestamp": datetime.now().isoformat(),
         "reason": "No structured items could be extracted after two attempts (table-only and full-text)."
     }
-    df = pd.DataFrame([failure_info])
-    
-    mode = "a" if CSV_FAILED_OUTPUT.exists() else "w"
-    header = not CSV_FAILED_OUTPUT.exists()
-    df.to_csv(CSV_FAILED_OUTPUT, mode=mode, header=header, index=False)
-    FAILED_DIR.mkdir(exist_ok=True)
-    shutil.move(source_path, FAILED_DIR / source_path.name)
+    write_rows("failed_extractions", [failure_info])
+    get_job_ledger().finish(source_path.name, "failed", failure_info["reason"])
+    if ARCHIVE_FINISHED_PDFS:
+        FAILED_DIR.mkdir(exist_ok=True)
+        shutil.move(source_path, FAILED_DIR / source_path.name)
     
     return state   
 
@@ -502,9 +716,11 @@ def finalize(state: Dict) -> Dict:
     """
     Node: Saves the final results and moves the processed file.
 
-    This is a terminal node for a successful run. It adds the source filename
-    to each extracted item, saves both the raw and validated items to CSV files,
-    and moves the original PDF to the 'processed' directory to prevent reprocessing.
+    This is a terminal node for a successful run. It registers the results for
+    duplicate detection (unless the document is itself a duplicate), adds the source
+    filename to each extracted item, saves both the raw and validated items through the result sink,
+    and marks the document as done in the job ledger so it is not processed again
+    (moving it to the 'processed' directory as well with ARCHIVE_FINISHED_PDFS).
 
     Args:
         state (Dict): The final state containing 'items' and 'validated_items'.
@@ -512,6 +728,8 @@ def finalize(state: Dict) -> Dict:
     Returns:
         Dict: The final state.
     """
+    # Registered before the items are attributed to this document's source.
+    _register_canonical(state)
     pdf_path = Path(state["pdf_path"])
     filename = pdf_path.name
     manufacturer = None
@@ -541,14 +759,17 @@ def finalize(state: Dict) -> Dict:
     
     save_items(state["items"])
     save_validated_items(state["validated_items"])
-    shutil.move(pdf_path, PROCESSED_DIR / filename)
+    get_job_ledger().finish(filename, "done")
+    if ARCHIVE_FINISHED_PDFS:
+        PROCESSED_DIR.mkdir(exist_ok=True)
+        shutil.move(pdf_path, PROCESSED_DIR / filename)
     return state
 
 def save_full_state(state: Dict) -> Dict:
     print("Save Full State STATE KEYS:", list(state.keys()))
     METADATA_DIR.mkdir(exist_ok=True)
 
-    keys_to_save = ['title', 'model_name', 'component', 'description', 'package_case', 'chunks', 'final_chunks']
+    keys_to_save = ['title', 'model_name', 'conversion_key', 'conversion_stats', 'component', 'description', 'package_case', 'chunks', 'final_chunks', 'chunk_budget', 'anchor_source', 'duplicate_of', 'duplicate_similarity']
 
     metadata = {
         k: json.dumps(state[k], ensure_ascii=False)
@@ -572,8 +793,9 @@ def save_skipped_component(state: Dict) -> Dict:
     Node: Logs information about a skipped document and moves the file.
 
     This is a terminal node for a skipped run. It records the filename and the
-    reason for skipping to a dedicated CSV log file. It then moves the PDF to
-    the 'skipped' directory.
+    reason for skipping to the skipped-components output and marks the document
+    as skipped in the job ledger (moving it to the 'skipped' directory with
+    ARCHIVE_FINISHED_PDFS).
 
     Args:
         state (Dict): The state, must contain 'pdf_path' and 'skip_reason'.
@@ -589,14 +811,12 @@ def save_skipped_component(state: Dict) -> Dict:
         "explanation": state.get("explanation", ""),
         "reason": state.get("skip_reason", "")
     }
-    df = pd.DataFrame([skipped_info])
-    
-    mode = "a" if CSV_SKIPPED_OUTPUT.exists() else "w"
-    header = not CSV_SKIPPED_OUTPUT.exists()
-    df.to_csv(CSV_SKIPPED_OUTPUT, mode=mode, header=header, index=False)
-    
-    logger.info(f"Logged skipped component from '{skipped_info['source']}' to {CSV_SKIPPED_OUTPUT}")
-    SKIPPED_DIR.mkdir(exist_ok=True)
-    shutil.move(pdf_path, SKIPPED_DIR / pdf_path.name)
+    write_rows("skipped_components", [skipped_info])
+
+    logger.info(f"Logged skipped component from '{skipped_info['source']}'")
+    get_job_ledger().finish(pdf_path.name, "skipped")
+    if ARCHIVE_FINISHED_PDFS:
+        SKIPPED_DIR.mkdir(exist_ok=True)
+        shutil.move(pdf_path, SKIPPED_DIR / pdf_path.name)
 
     return state
\ No newline at end of file
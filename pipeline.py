@@ -0,0 +1,342 @@
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from anchor_batcher import AnchorBatcher
+from config import ASYNC_MAX_CONCURRENCY, CONVERSION_WORKERS, LLM_WORKERS, NUM_GPUS, PIPELINE_MAX_PENDING, PIPELINE_REPORT_SECONDS
+from helpers import log_failure
+from resilience import get_circuit_breaker
+from result_sink import get_result_queue
+from workers import build_initial_state, convert_single_pdf, get_worker_resources, init_worker, record_document_timing
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats:
+    """
+    Thread-safe counters for one stage of the pipeline.
+
+    Tracks how many documents were submitted to, started and finished by the stage,
+    from which the throughput, the number of documents in flight and the depth of
+    the queue in front of the stage are derived. Stages running in a process pool
+    cannot observe when a job starts (`tracks_start=False`); for them every pending
+    document beyond one per worker is counted as queued.
+    """
+
+    def __init__(self, name: str, workers: int, tracks_start: bool = True):
+        self.name = name
+        self.workers = workers
+        self.tracks_start = tracks_start
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def on_submit(self):
+        with self._lock:
+            self.submitted += 1
+
+    def on_start(self):
+        with self._lock:
+            self.started += 1
+
+    def on_done(self, ok: bool = True):
+        with self._lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    @property
+    def finished(self) -> int:
+        return self.completed + self.failed
+
+    @property
+    def in_flight(self) -> int:
+        if not self.tracks_start:
+            return min(self.submitted - self.finished, self.workers)
+        return self.started - self.finished
+
+    @property
+    def queue_depth(self) -> int:
+        return self.submitted - self.finished - self.in_flight
+
+    def throughput(self) -> float:
+        """Finished documents per minute since the stage was created."""
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return self.finished * 60 / elapsed
+
+    def summary(self) -> str:
+        return (f"[{self.name}] workers={self.workers} done={self.completed} failed={self.failed} "
+                f"in_flight={self.in_flight} queue_depth={self.queue_depth} "
+                f"throughput={self.throughput():.1f} docs/min")
+
+
+def extract_converted_pdf(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    LLM stage of the two-stage pipeline: runs the graph from the anchor step on.
+
+    Args:
+        state (Dict[str, Any]): A state produced by `convert_single_pdf`.
+
+    Returns:
+        Dict[str, Any]: A timing record for the document.
+    """
+    resources = get_worker_resources("llm")
+    pdf_path = Path(state["pdf_path"])
+    start_time = time.time()
+    try:
+        resources["app"].invoke({**state, **build_initial_state(pdf_path, resources)}, {"recursion_limit": 100})
+        logger.info(f"Successfully finished processing: {pdf_path.name}")
+    except Exception as e:
+        logger.error(f"A critical error occurred while extracting {pdf_path.name}: {e}")
+        log_failure(pdf_path, e)
+        raise
+    finally:
+        timing = record_document_timing(time.time() - start_time, "llm")
+    return timing
+
+
+async def aextract_converted_pdf(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async LLM stage: runs the async graph from the anchor step on.
+
+    Args:
+        state (Dict[str, Any]): A state produced by `convert_single_pdf`.
+
+    Returns:
+        Dict[str, Any]: A timing record for the document.
+    """
+    resources = get_worker_resources("async")
+    pdf_path = Path(state["pdf_path"])
+    start_time = time.time()
+    try:
+        await resources["app"].ainvoke({**state, **build_initial_state(pdf_path, resources)}, {"recursion_limit": 100})
+        logger.info(f"Successfully finished processing: {pdf_path.name}")
+    except Exception as e:
+        logger.error(f"A critical error occurred while extracting {pdf_path.name}: {e}")
+        log_failure(pdf_path, e)
+        raise
+    finally:
+        timing = record_document_timing(time.time() - start_time, "async")
+    return timing
+
+
+def _llm_consumer(handoff: "queue.Queue", stats: StageStats, timings: List):
+    """Worker thread of the LLM stage: drains converted states until a None sentinel."""
+    while True:
+        state = handoff.get()
+        if state is None:
+            return
+        # Don't start a document while an LLM provider is known to be down.
+        get_circuit_breaker().wait_until_closed()
+        stats.on_start()
+        try:
+            timings.append(extract_converted_pdf(state))
+            stats.on_done(True)
+        except Exception:
+            stats.on_done(False)
+
+
+def _new_gpu_queue(workers: int):
+    """Returns a multiprocessing queue handing out GPU ids round-robin to `workers` processes."""
+    gpu_queue = multiprocessing.Queue()
+    for i in range(workers):
+        gpu_queue.put(i % max(NUM_GPUS, 1))
+    return gpu_queue
+
+
+def run_two_stage(pdfs: Iterable[Path], anchors: Optional[AnchorBatcher] = None) -> list:
+    """
+    Processes PDFs with separately sized conversion and LLM stages.
+
+    A bounded process pool (`CONVERSION_WORKERS`) only converts and chunks PDFs.
+    Converted states are put on a queue drained by a much wider pool of threads
+    (`LLM_WORKERS`) that run the anchor/filter/llm/parse/validate part of the graph,
+    so the conversion hardware never waits on network calls. Submission to the
+    conversion stage pauses while `PIPELINE_MAX_PENDING` documents are converting
+    or waiting for the LLM stage. Both stages periodically report their throughput
+    and queue depth.
+
+    Args:
+        pdfs (Iterable[Path]): The PDFs to process.
+        anchors (Optional[AnchorBatcher]): The batcher that classified `pdfs`, if any.
+
+    Returns:
+        list: The timing records of both stages.
+    """
+    conversion_stats = StageStats("conversion", CONVERSION_WORKERS, tracks_start=False)
+    llm_stats = StageStats("llm", LLM_WORKERS)
+    handoff: "queue.Queue" = queue.Queue()
+    conversion_timings: List = []
+    llm_timings: List = []
+
+    consumers = [
+        threading.Thread(target=_llm_consumer, args=(handoff, llm_stats, llm_timings), daemon=True)
+        for _ in range(LLM_WORKERS)
+    ]
+    for consumer in consumers:
+        consumer.start()
+
+    last_report = time.time()
+
+    def report(force: bool = False):
+        nonlocal last_report
+        if force or time.time() - last_report >= PIPELINE_REPORT_SECONDS:
+            logger.info(conversion_stats.summary())
+            logger.info(llm_stats.summary())
+            last_report = time.time()
+
+    def hand_off(done, future_to_pdf):
+        for future in done:
+            pdf = future_to_pdf.pop(future)
+            try:
+                state = future.result()
+            except Exception as exc:
+                logger.error(f'{pdf.name} generated an exception in the conversion worker: {exc}')
+                log_failure(pdf, exc)
+                conversion_stats.on_done(False)
+                continue
+            conversion_stats.on_done(True)
+            conversion_timings.append(state.pop("timing", None))
+            # No markdown means the PDF was already processed, skipped, or its failure was logged.
+            if state.get("markdown"):
+                llm_stats.on_submit()
+                handoff.put(state)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=CONVERSION_WORKERS, initializer=init_worker,
+                                                initargs=(_new_gpu_queue(CONVERSION_WORKERS), "conversion", get_result_queue())) as executor:
+        logger.info(f"Starting two-stage pipeline with {CONVERSION_WORKERS} conversion workers "
+                    f"and {LLM_WORKERS} LLM workers...")
+        future_to_pdf = {}
+        for pdf in pdfs:
+            while len(future_to_pdf) + handoff.qsize() >= PIPELINE_MAX_PENDING:
+                if future_to_pdf:
+                    done, _ = concurrent.futures.wait(future_to_pdf, timeout=1,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    hand_off(done, future_to_pdf)
+                else:
+                    time.sleep(1)
+                report()
+            anchor = anchors.pop_anchor(pdf.name) if anchors else None
+            future_to_pdf[executor.submit(convert_single_pdf, pdf, anchor)] = pdf
+            conversion_stats.on_submit()
+
+        while future_to_pdf:
+            done, _ = concurrent.futures.wait(future_to_pdf, timeout=PIPELINE_REPORT_SECONDS,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            hand_off(done, future_to_pdf)
+            report()
+
+    for _ in consumers:
+        handoff.put(None)
+    for consumer in consumers:
+        while consumer.is_alive():
+            consumer.join(timeout=PIPELINE_REPORT_SECONDS)
+            report()
+
+    report(force=True)
+    return conversion_timings + llm_timings
+
+
+def run_async(pdfs: Iterable[Path], anchors: Optional[AnchorBatcher] = None) -> list:
+    """
+    Processes PDFs with a conversion process pool and an asyncio LLM stage.
+
+    Conversion runs in the same bounded process pool as in `run_two_stage`, but the
+    LLM part of the graph runs as asyncio tasks in this process with the async Groq
+    and OpenAI clients. Up to `ASYNC_MAX_CONCURRENCY` documents are extracted
+    concurrently, so LLM throughput scales without adding processes.
+
+    Args:
+        pdfs (Iterable[Path]): The PDFs to process.
+        anchors (Optional[AnchorBatcher]): The batcher that classified `pdfs`, if any.
+
+    Returns:
+        list: The timing records of both stages.
+    """
+    return asyncio.run(_run_async(pdfs, anchors))
+
+
+async def _run_async(pdfs: Iterable[Path], anchors: Optional[AnchorBatcher] = None) -> list:
+    loop = asyncio.get_running_loop()
+    conversion_stats = StageStats("conversion", CONVERSION_WORKERS, tracks_start=False)
+    llm_stats = StageStats("llm-async", ASYNC_MAX_CONCURRENCY)
+    llm_slots = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+    # Bounds the documents that are converting or converted but waiting for an LLM slot.
+    pending_slots = asyncio.Semaphore(PIPELINE_MAX_PENDING)
+    timings: List = []
+
+    async def process(executor, pdf: Path, anchor: Optional[Dict[str, Any]]):
+        released = False
+        try:
+            try:
+                state = await loop.run_in_executor(executor, convert_single_pdf, pdf, anchor)
+            except Exception as exc:
+                logger.error(f'{pdf.name} generated an exception in the conversion worker: {exc}')
+                log_failure(pdf, exc)
+                conversion_stats.on_done(False)
+                return
+            conversion_stats.on_done(True)
+            timings.append(state.pop("timing", None))
+            # No markdown means the PDF was already processed, skipped, or its failure was logged.
+            if not state.get("markdown"):
+                return
+
+            llm_stats.on_submit()
+            # Don't start a document while an LLM provider is known to be down.
+            await get_circuit_breaker().await_closed()
+            async with llm_slots:
+                pending_slots.release()
+                released = True
+                llm_stats.on_start()
+                try:
+                    timings.append(await aextract_converted_pdf(state))
+                    llm_stats.on_done(True)
+                except Exception:
+                    llm_stats.on_done(False)
+        finally:
+            if not released:
+                pending_slots.release()
+
+    async def report():
+        while True:
+            await asyncio.sleep(PIPELINE_REPORT_SECONDS)
+            logger.info(conversion_stats.summary())
+            logger.info(llm_stats.summary())
+
+    reporter = asyncio.create_task(report())
+    with concurrent.futures.ProcessPoolExecutor(max_workers=CONVERSION_WORKERS, initializer=init_worker,
+                                                initargs=(_new_gpu_queue(CONVERSION_WORKERS), "conversion", get_result_queue())) as executor:
+        logger.info(f"Starting async pipeline with {CONVERSION_WORKERS} conversion workers "
+                    f"and up to {ASYNC_MAX_CONCURRENCY} concurrent extractions...")
+        tasks = set()
+        pdfs = iter(pdfs)
+        while True:
+            await pending_slots.acquire()
+            # Pulling a document scans the directory, reads the ledger and claims leases, and
+            # the batched anchor step makes blocking requests; none of it runs on the loop.
+            pdf = await loop.run_in_executor(None, next, pdfs, None)
+            if pdf is None:
+                pending_slots.release()
+                break
+            conversion_stats.on_submit()
+            anchor = anchors.pop_anchor(pdf.name) if anchors else None
+            task = asyncio.create_task(process(executor, pdf, anchor))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    reporter.cancel()
+    logger.info(conversion_stats.summary())
+    logger.info(llm_stats.summary())
+    return timings
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from config import RATE_LIMIT_DB_PATH, RATE_LIMITS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucketRateLimiter:
+    """
+    Cross-process token-bucket rate limiter for requests and tokens per minute.
+
+    Every model has two buckets, one for requests and one for tokens, that refill
+    continuously at `rpm / 60` and `tpm / 60` per second up to one minute's worth
+    of quota. The bucket levels live in a small SQLite database, so all worker
+    processes (and threads) of a run draw from the same quota: a caller takes what
+    it needs inside an `IMMEDIATE` transaction, or learns how long it has to wait
+    until enough quota has refilled.
+    """
+
+    def __init__(self, db_path: Path = RATE_LIMIT_DB_PATH, limits: Optional[Dict[str, Dict[str, int]]] = None):
+        self.db_path = Path(db_path)
+        self.limits = RATE_LIMITS if limits is None else limits
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each process opens its own lazily.
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "model TEXT PRIMARY KEY, requests REAL NOT NULL, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def _try_acquire(self, model: str, tokens: int) -> float:
+        """
+        Takes one request and `tokens` tokens from the buckets of `model` if available.
+
+        Returns:
+            float: 0 if the quota was taken, otherwise the seconds to wait before retrying.
+        """
+        limit = self.limits.get(model)
+        if not limit:
+            return 0.0
+        rpm, tpm = limit["rpm"], limit["tpm"]
+        # A request larger than a full bucket could never be served; cap it.
+        tokens = min(tokens, tpm)
+
+        with self._lock:
+            return self._take(model, tokens, rpm, tpm)
+
+    def _take(self, model: str, tokens: int, rpm: int, tpm: int) -> float:
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT requests, tokens, updated_at FROM buckets WHERE model = ?", (model,)).fetchone()
+            if row is None:
+                requests_left, tokens_left = float(rpm), float(tpm)
+            else:
+                elapsed = max(now - row[2], 0.0)
+                requests_left = min(rpm, row[0] + elapsed * rpm / 60)
+                tokens_left = min(tpm, row[1] + elapsed * tpm / 60)
+
+            if requests_left >= 1 and tokens_left >= tokens:
+                requests_left -= 1
+                tokens_left -= tokens
+                wait = 0.0
+            else:
+                wait = max((1 - requests_left) * 60 / rpm, (tokens - tokens_left) * 60 / tpm, 0.05)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (model, requests, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                (model, requests_left, tokens_left, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def acquire(self, model: str, tokens: int):
+        """
+        Blocks until one request and `tokens` tokens of `model`'s quota are available.
+
+        Args:
+            model (str): The model about to be called. Models without a configured
+                         limit are not throttled.
+            tokens (int): Estimated tokens of the call (prompt plus completion).
+        """
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(model, tokens)
+            if not wait:
+                break
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            logger.debug(f"Rate limiter held a {model} call for {waited:.2f} seconds.")
+
+    def settle(self, model: str, estimated: int, actual: Optional[int]):
+        """
+        Corrects the token bucket of `model` once the real usage of a call is known.
+
+        `acquire` debits an estimate (prompt tokens plus a completion budget); the
+        difference to the reported usage is refunded or charged afterwards, so the
+        bucket follows the provider's count. A bucket may go into debt down to one
+        minute's worth of tokens, which later callers wait out.
+
+        Args:
+            model (str): The model that was called.
+            estimated (int): The tokens passed to `acquire`.
+            actual (Optional[int]): The total tokens of the response; None leaves the
+                                    estimate in place.
+        """
+        limit = self.limits.get(model)
+        if not limit or actual is None:
+            return
+        tpm = limit["tpm"]
+        difference = actual - min(estimated, tpm)
+        if not difference:
+            return
+        with self._lock:
+            self._connection().execute(
+                "UPDATE buckets SET tokens = MIN(?, MAX(?, tokens - ?)) WHERE model = ?", (tpm, -tpm, difference, model)
+            )
+
+    async def aacquire(self, model: str, tokens: int):
+        """
+        Async counterpart of `acquire` that sleeps without blocking the event loop.
+        The SQLite transaction runs in a worker thread, since it can wait on other
+        processes' locks.
+        """
+        waited = 0.0
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire, model, tokens)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited:
+            logger.debug(f"Rate limiter held a {model} call for {waited:.2f} seconds.")
+
+
+_LIMITER: Optional[TokenBucketRateLimiter] = None
+
+
+def get_rate_limiter() -> TokenBucketRateLimiter:
+    """Returns the rate limiter of the current process, creating it on first use."""
+    global _LIMITER
+    if _LIMITER is None:
+        _LIMITER = TokenBucketRateLimiter()
+    return _LIMITER
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from config import (CIRCUIT_BREAKER_COOLDOWN_SECONDS, CIRCUIT_BREAKER_DB_PATH, CIRCUIT_BREAKER_THRESHOLD,
+                    LLM_RETRY_BASE_SECONDS, LLM_RETRY_MAX_SECONDS)
+
+logger = logging.getLogger(__name__)
+
+# Exception class names (shared by the openai and groq SDKs) that indicate a failure
+# worth retrying: the provider was unreachable, overloaded or throttling us.
+TRANSIENT_ERROR_TYPES = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "RateLimitError",
+    "InternalServerError",
+    "ConnectionError",
+    "TimeoutError",
+}
+
+# The same failures as they appear in exception messages and in the 'error' column of
+# the failure log. Status codes only count next to "HTTP", "status" or "error code"
+# ("Error code: 429 - ..."), so that e.g. "max 500 tokens" is not mistaken for a 5xx.
+TRANSIENT_ERROR_PATTERN = re.compile(
+    r"connection error|timed out|timeout|rate limit|too many requests|overloaded|"
+    r"service unavailable|bad gateway|gateway time-?out|"
+    r"\b(?:http|status(?:[ _]code)?|error code)\s*[:=]?\s*(?:429|50[0234])\b",
+    re.IGNORECASE
+)
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Decides whether an exception from an LLM call is transient and worth retrying.
+
+    The exception type and the HTTP status code decide first; the message is only
+    matched (`is_transient_message`) for exceptions that carry neither.
+
+    Args:
+        error (BaseException): The raised exception.
+
+    Returns:
+        bool: True for connection problems, timeouts, throttling and 5xx responses.
+    """
+    if type(error).__name__ in TRANSIENT_ERROR_TYPES:
+        return True
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status_code, int):
+        return status_code == 429 or status_code >= 500
+    return is_transient_message(str(error))
+
+
+def is_transient_message(message: str) -> bool:
+    """
+    Classifies a logged error message (e.g. from `failed_pdfs.csv`) as transient.
+
+    Args:
+        message (str): The error message.
+
+    Returns:
+        bool: True if the message describes a transient failure.
+    """
+    return bool(TRANSIENT_ERROR_PATTERN.search(message or ""))
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Returns the jittered exponential backoff delay before retry number `attempt`.
+
+    Uses "full jitter": a uniform random delay between zero and the exponential
+    ceiling, so that many workers failing at once do not retry in lockstep.
+
+    Args:
+        attempt (int): The zero-based retry number.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    ceiling = min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """
+    Cross-process circuit breaker per LLM model.
+
+    Consecutive transient failures of a model are counted in a SQLite database
+    shared by all workers. Once CIRCUIT_BREAKER_THRESHOLD is reached the circuit
+    opens for CIRCUIT_BREAKER_COOLDOWN_SECONDS: every worker pauses before calling
+    the model or starting a new document, instead of burning through the queue
+    while the provider is down. After the cooldown calls go through again; the
+    next failure reopens the circuit right away, the next success closes it.
+    """
+
+    def __init__(self, db_path: Path = CIRCUIT_BREAKER_DB_PATH, threshold: int = CIRCUIT_BREAKER_THRESHOLD,
+                 cooldown: float = CIRCUIT_BREAKER_COOLDOWN_SECONDS):
+        self.db_path = Path(db_path)
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each process opens its own lazily.
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS breakers ("
+                "name TEXT PRIMARY KEY, failures INTEGER NOT NULL, opened_until REAL NOT NULL)"
+            )
+        return self._conn
+
+    def record_success(self, name: str):
+        """Closes the circuit of `name` and resets its failure count."""
+        with self._lock:
+            self._connection().execute(
+                "UPDATE breakers SET failures = 0, opened_until = 0 WHERE name = ? AND failures > 0", (name,)
+            )
+
+    def record_failure(self, name: str):
+        """Counts a transient failure of `name`, opening the circuit at the threshold."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT failures, opened_until FROM breakers WHERE name = ?", (name,)).fetchone()
+                failures = (row[0] if row else 0) + 1
+                opened_until = row[1] if row else 0.0
+                now = time.time()
+                if failures >= self.threshold and opened_until <= now:
+                    opened_until = now + self.cooldown
+                    logger.warning(f"Circuit breaker for {name} opened after {failures} consecutive failures; "
+                                   f"pausing calls for {self.cooldown:.0f} seconds.")
+                conn.execute(
+                    "INSERT OR REPLACE INTO breakers (name, failures, opened_until) VALUES (?, ?, ?)",
+                    (name, failures, opened_until)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def remaining_open_seconds(self, name: Optional[str] = None) -> float:
+        """
+        Returns how long the circuit stays open.
+
+        Args:
+            name (Optional[str]): The model to check; None checks all models.
+
+        Returns:
+            float: Seconds until the circuit closes, 0 if it is closed.
+        """
+        with self._lock:
+            conn = self._connection()
+            if name is None:
+                row = conn.execute("SELECT MAX(opened_until) FROM breakers").fetchone()
+            else:
+                row = conn.execute("SELECT opened_until FROM breakers WHERE name = ?", (name,)).fetchone()
+        if not row or row[0] is None:
+            return 0.0
+        return max(row[0] - time.time(), 0.0)
+
+    def wait_until_closed(self, name: Optional[str] = None):
+        """Blocks while the circuit of `name` (or of any model if None) is open."""
+        while True:
+            remaining = self.remaining_open_seconds(name)
+            if not remaining:
+                return
+            logger.info(f"Circuit breaker open for {name or 'an LLM provider'}; waiting {remaining:.0f} seconds.")
+            time.sleep(remaining)
+
+    async def await_closed(self, name: Optional[str] = None):
+        """Async counterpart of `wait_until_closed`; the SQLite read runs in a worker thread."""
+        while True:
+            remaining = await asyncio.to_thread(self.remaining_open_seconds, name)
+            if not remaining:
+                return
+            logger.info(f"Circuit breaker open for {name or 'an LLM provider'}; waiting {remaining:.0f} seconds.")
+            await asyncio.sleep(remaining)
+
+
+_BREAKER: Optional[CircuitBreaker] = None
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Returns the circuit breaker of the current process, creating it on first use."""
+    global _BREAKER
+    if _BREAKER is None:
+        _BREAKER = CircuitBreaker()
+    return _BREAKER
@@ -0,0 +1,333 @@
+import csv
+import importlib.util
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from config import (CSV_FAILED_OUTPUT, CSV_OUTPUT, FAILURE_LOG_PATH, CSV_SKIPPED_OUTPUT, CSV_VALIDATED_OUTPUT, MPN_INDEX_DB_PATH,
+                    MPN_INDEX_ENABLED, RESULT_SINK_BACKEND, RESULT_SINK_BATCH_ROWS, RESULT_SINK_FALLBACK_DIR,
+                    RESULT_SINK_FLUSH_SECONDS, RESULT_SINK_MAX_WRITE_ATTEMPTS, RESULTS_DB_PATH, RESULTS_PARQUET_DIR)
+from job_ledger import get_job_ledger
+from mpn_index import MpnIndex
+
+logger = logging.getLogger(__name__)
+
+ITEM_COLUMNS = ["mpn", "top_marking", "package_case", "description", "confidence", "source", "manufacturer"]
+
+# Output tables and their fixed columns. Every row of a table is written with the
+# same columns, in the same order, whatever keys the LLM returned.
+TABLES: Dict[str, List[str]] = {
+    "items": ITEM_COLUMNS,
+    "validated_items": ITEM_COLUMNS,
+    "skipped_components": ["source", "component", "description", "explanation", "reason"],
+    "failed_extractions": ["source", "timestamp", "reason"],
+    "failed_pdfs": ["timestamp", "pdf_name", "error"],
+}
+
+CSV_PATHS: Dict[str, Path] = {
+    "items": CSV_OUTPUT,
+    "validated_items": CSV_VALIDATED_OUTPUT,
+    "skipped_components": CSV_SKIPPED_OUTPUT,
+    "failed_extractions": CSV_FAILED_OUTPUT,
+    "failed_pdfs": FAILURE_LOG_PATH,
+}
+
+
+def _cell(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, (list, dict)):
+        return str(value)
+    return value
+
+
+class CsvBackend:
+    """
+    Appends rows to the per-table CSV files, writing the header once.
+
+    Files go to the paths in CSV_PATHS, or under `out_dir` with the same names.
+    """
+
+    def __init__(self, out_dir: Optional[Path] = None):
+        self._out_dir = out_dir
+        if out_dir is not None:
+            out_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, table: str) -> Path:
+        return CSV_PATHS[table] if self._out_dir is None else self._out_dir / CSV_PATHS[table].name
+
+    def write(self, table: str, rows: List[Dict[str, Any]]):
+        path = self._path(table)
+        header = not path.exists() or path.stat().st_size == 0
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=TABLES[table], extrasaction="ignore")
+            if header:
+                writer.writeheader()
+            writer.writerows({k: _cell(row.get(k)) for k in TABLES[table]} for row in rows)
+
+    def read_rows(self, table: str) -> List[Dict[str, Any]]:
+        path = self._path(table)
+        if not path.exists():
+            return []
+        with open(path, newline="", encoding="utf-8") as f:
+            return list(csv.DictReader(f))
+
+    def close(self):
+        pass
+
+
+class SqliteBackend:
+    """Inserts rows into one SQLite table per output, in a single transaction per batch."""
+
+    def __init__(self, out_dir: Optional[Path] = None):
+        db_path = RESULTS_DB_PATH if out_dir is None else out_dir / RESULTS_DB_PATH.name
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for table, columns in TABLES.items():
+            cols = ", ".join(f"{c} TEXT" for c in columns)
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, {cols})")
+        self._conn.commit()
+
+    def write(self, table: str, rows: List[Dict[str, Any]]):
+        columns = TABLES[table]
+        placeholders = ", ".join("?" for _ in columns)
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                [[_cell(row.get(c)) for c in columns] for row in rows]
+            )
+
+    def read_rows(self, table: str) -> List[Dict[str, Any]]:
+        columns = TABLES[table]
+        rows = self._conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id").fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+class ParquetBackend:
+    """
+    Writes every batch as a new Parquet file under `RESULTS_PARQUET_DIR/<table>/`.
+
+    Parquet files cannot be appended to, so a dataset is a directory of parts; read it
+    back with `pd.read_parquet(RESULTS_PARQUET_DIR / table)`.
+    """
+
+    def __init__(self, out_dir: Optional[Path] = None):
+        # Fail when the sink starts rather than at its first flush.
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ImportError("The parquet result sink requires pyarrow (pip install pyarrow).")
+        self._out_dir = RESULTS_PARQUET_DIR if out_dir is None else out_dir / RESULTS_PARQUET_DIR.name
+        self._part = 0
+
+    def write(self, table: str, rows: List[Dict[str, Any]]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = TABLES[table]
+        data = {c: [None if row.get(c) is None else str(_cell(row.get(c))) for row in rows] for c in columns}
+        table_dir = self._out_dir / table
+        table_dir.mkdir(parents=True, exist_ok=True)
+        self._part += 1
+        part_path = table_dir / f"part-{int(time.time() * 1000)}-{os.getpid()}-{self._part}.parquet"
+        pq.write_table(pa.table(data), part_path)
+
+    def read_rows(self, table: str) -> List[Dict[str, Any]]:
+        import pyarrow.parquet as pq
+
+        table_dir = self._out_dir / table
+        if not table_dir.exists():
+            return []
+        return pq.read_table(table_dir).to_pylist()
+
+    def close(self):
+        pass
+
+
+BACKENDS = {"csv": CsvBackend, "sqlite": SqliteBackend, "parquet": ParquetBackend}
+
+
+def mpn_index_path(out_dir: Optional[Path] = None) -> Path:
+    """Returns the MPN index that goes with the outputs in `out_dir` (the default outputs if None)."""
+    return MPN_INDEX_DB_PATH if out_dir is None else out_dir / MPN_INDEX_DB_PATH.name
+
+
+class ResultSink:
+    """
+    The single writer of all output rows.
+
+    Workers never touch the output files: they put (table, rows) messages on a
+    multiprocessing queue, and one thread in the main process batches them and
+    flushes them in bulk to the configured backend. Rows therefore can't interleave
+    or get duplicate headers, and output I/O does not contend across workers.
+    A batch is flushed when RESULT_SINK_BATCH_ROWS rows are buffered, after
+    RESULT_SINK_FLUSH_SECONDS, and on close. With MPN_INDEX_ENABLED, every flushed
+    batch of validated items is also merged into the corpus-wide MPN index.
+
+    Rows whose write fails stay buffered and are retried on the next flushes. After
+    RESULT_SINK_MAX_WRITE_ATTEMPTS failures, or at close, they are spilled as CSV to
+    RESULT_SINK_FALLBACK_DIR; if even that fails, their documents are reopened in the
+    job ledger so the next run extracts them again.
+
+    Use it as a context manager around the worker pools, and pass `sink.queue` to
+    `init_worker` so that worker processes publish to it. With `out_dir` (per-node
+    outputs of a sharded run) the files are written there instead of the default
+    locations.
+    """
+
+    def __init__(self, backend: str = RESULT_SINK_BACKEND, out_dir: Optional[Path] = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown result sink backend '{backend}'. Choose one of {sorted(BACKENDS)}.")
+        self.backend_name = backend
+        self._backend = BACKENDS[backend](out_dir)
+        self._index = MpnIndex(mpn_index_path(out_dir)) if MPN_INDEX_ENABLED else None
+        self._fallback_dir = RESULT_SINK_FALLBACK_DIR if out_dir is None else out_dir / RESULT_SINK_FALLBACK_DIR.name
+        # Consecutive failed writes per table.
+        self._failures: Dict[str, int] = {table: 0 for table in TABLES}
+        self.queue = multiprocessing.Queue()
+        self._thread = threading.Thread(target=self._run, name="result-sink", daemon=True)
+        self.rows_written = 0
+
+    def __enter__(self) -> "ResultSink":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def start(self):
+        """Starts the writer thread and routes this process's writes to the queue."""
+        connect(self.queue)
+        self._thread.start()
+        logger.info(f"Result sink started ({self.backend_name} backend).")
+
+    def close(self):
+        """Flushes every pending row and stops the writer thread."""
+        self.queue.put(None)
+        self._thread.join()
+        self._backend.close()
+        if self._index is not None:
+            self._index.close()
+        connect(None)
+        logger.info(f"Result sink closed: {self.rows_written} rows written ({self.backend_name} backend).")
+
+    def _flush(self, buffers: Dict[str, List[Dict[str, Any]]], final: bool = False):
+        for table, rows in buffers.items():
+            if not rows:
+                continue
+            try:
+                self._backend.write(table, rows)
+                self.rows_written += len(rows)
+                self._failures[table] = 0
+            except Exception as e:
+                self._failures[table] += 1
+                if not final and self._failures[table] < RESULT_SINK_MAX_WRITE_ATTEMPTS:
+                    logger.warning(f"Result sink failed to write {len(rows)} rows to '{table}' "
+                                   f"(attempt {self._failures[table]}); retrying on the next flush: {e}")
+                    continue
+                logger.error(f"Result sink failed to write {len(rows)} rows to '{table}': {e}")
+                self._spill(table, rows, e)
+                self._failures[table] = 0
+                rows.clear()
+                continue
+            if table == "validated_items" and self._index is not None:
+                try:
+                    self._index.update(rows)
+                except Exception as e:
+                    logger.error(f"Result sink failed to index {len(rows)} validated items: {e}")
+            rows.clear()
+
+    def _spill(self, table: str, rows: List[Dict[str, Any]], error: Exception):
+        """Saves rows that could not be written to the fallback CSV, or reopens their documents."""
+        try:
+            CsvBackend(self._fallback_dir).write(table, rows)
+            logger.error(f"Spilled {len(rows)} '{table}' rows to {self._fallback_dir}.")
+            return
+        except Exception as e:
+            logger.error(f"Result sink could not spill {len(rows)} '{table}' rows either: {e}")
+        sources = sorted({str(row["source"]) for row in rows if row.get("source")})
+        ledger = get_job_ledger()
+        for source in sources:
+            ledger.reopen(source, f"Output rows of '{table}' were lost: {error}")
+        logger.error(f"Reopened {len(sources)} document(s) in the job ledger: {', '.join(sources)}")
+
+    def _run(self):
+        buffers: Dict[str, List[Dict[str, Any]]] = {table: [] for table in TABLES}
+        buffered = 0
+        last_flush = time.time()
+        while True:
+            timeout = max(0.0, RESULT_SINK_FLUSH_SECONDS - (time.time() - last_flush))
+            try:
+                message = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                message = ()
+            if message is None:
+                self._flush(buffers, final=True)
+                return
+            if message:
+                table, rows = message
+                buffers[table].extend(rows)
+                buffered += len(rows)
+            if buffered >= RESULT_SINK_BATCH_ROWS or time.time() - last_flush >= RESULT_SINK_FLUSH_SECONDS:
+                self._flush(buffers)
+                # Rows of failed writes stay buffered for the retry.
+                buffered = sum(len(rows) for rows in buffers.values())
+                last_flush = time.time()
+
+
+# Queue of the running sink, set in the main process by `ResultSink.start` and in
+# worker processes by `init_worker`.
+_QUEUE = None
+_DIRECT_LOCK = threading.Lock()
+
+
+def connect(result_queue):
+    """Routes the writes of this process to `result_queue` (None to write directly)."""
+    global _QUEUE
+    _QUEUE = result_queue
+
+
+def write_rows(table: str, rows: List[Dict[str, Any]]):
+    """
+    Publishes output rows to the result sink.
+
+    Without a running sink (e.g. when a node is run on its own from a notebook) the
+    rows are written directly with the configured backend.
+
+    Args:
+        table (str): One of `TABLES`.
+        rows (List[Dict[str, Any]]): The rows; keys outside the table's columns are ignored.
+    """
+    if table not in TABLES:
+        raise ValueError(f"Unknown output table '{table}'.")
+    if not rows:
+        return
+    rows = [dict(row) for row in rows]
+    if _QUEUE is not None:
+        _QUEUE.put((table, rows))
+        return
+    with _DIRECT_LOCK:
+        backend = BACKENDS[RESULT_SINK_BACKEND]()
+        try:
+            backend.write(table, rows)
+        finally:
+            backend.close()
+        if table == "validated_items" and MPN_INDEX_ENABLED:
+            index = MpnIndex()
+            try:
+                index.update(rows)
+            finally:
+                index.close()
+
+
+def get_result_queue() -> Optional[Any]:
+    """Returns the queue this process publishes to, to hand it to worker processes."""
+    return _QUEUE
@@ -0,0 +1,356 @@
+import bisect
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+# Keywords related to component specifications, counted in every chunk.
+KEYWORD_PATTERN = re.compile(
+    r"\b("
+    r"part( numbers?)?|"
+    r"type numbers?|"
+    r"ordering|"
+    r"markings?|"
+    r"package options?|"
+    r"product series|"
+    r"packages?"
+    r")\b",
+    re.IGNORECASE
+)
+
+# The same keywords, matched case-sensitively on lowercased text with one pattern per
+# leading word. Each pattern starts with a literal, so `re` skips ahead to its
+# occurrences instead of trying the alternation at every position, and the lookbehind
+# after the literal stands in for the leading `\b`. No keyword match contains another
+# keyword's leading word at a word start, so the matches of all patterns are exactly
+# those of KEYWORD_PATTERN. This is exact unless the text contains one of
+# `_CASE_FOLD_TRAPS`: non-ASCII characters that IGNORECASE matches against an ASCII
+# letter (or, for U+0130, that `str.lower` expands to two characters).
+LOWER_KEYWORD_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r"part(?<!\wpart)(?: numbers?)?\b",
+    r"type(?<!\wtype) numbers?\b",
+    r"ordering(?<!\wordering)\b",
+    r"marking(?<!\wmarking)s?\b",
+    r"package(?<!\wpackage)(?: options?|s)?\b",
+    r"product(?<!\wproduct) series\b",
+))
+_CASE_FOLD_TRAPS = ("\u0130", "\u0131", "\u017f", "\u212a")
+
+# From this many distinct component names on, one trie regex over the whole document
+# beats a C substring search per name and chunk.
+TRIE_MIN_COMPONENTS = 200
+
+# Joins the chunks of a document so that each pattern scans them in one pass. It can
+# not occur in a keyword, a title prefix or (after `_usable`) a component name, and
+# it is a non-word character, so `\b` behaves as at the start and end of a chunk.
+SEPARATOR = "\x00"
+
+Score = Union[int, float]
+
+
+def _trie_pattern(words: Sequence[str]) -> str:
+    """
+    Builds a regex that matches the longest of `words` starting at a position.
+
+    The words are merged into a trie and the trie is written out as nested groups,
+    so the regex engine follows one branch per character instead of trying every
+    word in turn. Optional groups are greedy, so longer words win.
+    """
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def emit(node: Dict) -> str:
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return "(?:" + body + ")?"
+        return body
+
+    return emit(trie)
+
+
+def _usable(component: str) -> bool:
+    return bool(component) and SEPARATOR not in component
+
+
+class ChunkScorer:
+    """
+    Precompiled multi-pattern scorer for the chunks of one document.
+
+    Gives exactly the scores of `score_chunk`: +1 per keyword match, +1 per
+    component name found (case-insensitively) in the chunk, and +0.5 per
+    occurrence of the first five characters of the title. All chunks are joined and
+    scanned once per pattern; match positions are mapped back to chunks by binary
+    search.
+
+    Component names are lowercased and deduplicated once. Up to TRIE_MIN_COMPONENTS
+    names, each is looked up with `in` in the pre-lowered chunks. For larger lists
+    they are matched Aho-Corasick style: a single trie regex, run as a lookahead at
+    every position, reports the longest name starting there, and the precomputed
+    `_prefixes` table (the automaton's output function) adds every shorter name that
+    is a prefix of it.
+    """
+
+    def __init__(self, components: Sequence[str], title: str):
+        # Duplicate names count once per occurrence in the list, as in `score_chunk`.
+        self._weights = Counter(m.lower() for m in components)
+        self._always = self._weights.pop("", 0)
+        names = sorted(name for name in self._weights if _usable(name))
+        self._component_pattern = None
+        self._prefixes: Dict[str, Tuple[str, ...]] = {}
+        if len(names) >= TRIE_MIN_COMPONENTS:
+            self._component_pattern = re.compile("(?=(" + _trie_pattern(names) + "))")
+            self._prefixes = {name: tuple(other for other in names if name.startswith(other)) for name in names}
+            self._substring_names = [(name, weight) for name, weight in self._weights.items() if not _usable(name)]
+        else:
+            self._substring_names = list(self._weights.items())
+        self._has_title = len(title) >= 5
+        self._title_prefix = title[:5].lower()
+        self._title_pattern = re.compile(re.escape(self._title_prefix)) if self._has_title else None
+
+    def score_all(self, chunks: Sequence[str]) -> List[Score]:
+        """
+        Scores all chunks of a document.
+
+        Args:
+            chunks (Sequence[str]): The chunks.
+
+        Returns:
+            List[Score]: One score per chunk, equal to `score_chunk` for that chunk.
+        """
+        if not chunks:
+            return []
+        if SEPARATOR in self._title_prefix or any(SEPARATOR in chunk for chunk in chunks):
+            return [self._score_one(chunk) for chunk in chunks]
+
+        lowered = [chunk.lower() for chunk in chunks]
+        starts = _offsets(chunks)
+        lowered_starts = _offsets(lowered)
+        text = SEPARATOR.join(chunks)
+        lowered_text = SEPARATOR.join(lowered)
+
+        if any(trap in text for trap in _CASE_FOLD_TRAPS):
+            keyword_counts = _chunk_counts([match.start() for match in KEYWORD_PATTERN.finditer(text)], starts)
+        else:
+            keyword_counts = _chunk_counts(
+                [match.start() for pattern in LOWER_KEYWORD_PATTERNS for match in pattern.finditer(lowered_text)],
+                lowered_starts
+            )
+
+        title_counts = [0] * len(chunks)
+        if self._title_pattern is not None:
+            title_counts = _chunk_counts([match.start() for match in self._title_pattern.finditer(lowered_text)],
+                                         lowered_starts)
+
+        found = [set() for _ in chunks]
+        if self._component_pattern is not None:
+            for match in self._component_pattern.finditer(lowered_text):
+                if match.group(1):
+                    found[bisect.bisect_right(lowered_starts, match.start()) - 1].update(
+                        self._prefixes[match.group(1)]
+                    )
+
+        scores = []
+        for i, chunk_lower in enumerate(lowered):
+            component_hits = self._always + sum(self._weights[name] for name in found[i])
+            component_hits += sum(weight for name, weight in self._substring_names if name in chunk_lower)
+            scores.append(self._combine(title_counts[i], component_hits, keyword_counts[i]))
+        return scores
+
+    def _score_one(self, chunk: str) -> Score:
+        # Plain per-chunk scoring, for the rare chunk that contains SEPARATOR itself.
+        chunk_lower = chunk.lower()
+        title_count = chunk_lower.count(self._title_prefix) if self._has_title else 0
+        component_hits = self._always + sum(weight for name, weight in self._weights.items() if name in chunk_lower)
+        return self._combine(title_count, component_hits, len(KEYWORD_PATTERN.findall(chunk)))
+
+    def _combine(self, title_count: int, component_hits: int, keyword_count: int) -> Score:
+        # Same operations in the same order as `score_chunk`, so the scores are
+        # identical, including whether they are int or float.
+        score = 0
+        if self._has_title:
+            score += title_count * 0.5
+        score += component_hits
+        score += keyword_count
+        return score
+
+
+def _offsets(parts: Sequence[str]) -> List[int]:
+    """Start offsets of `parts` in `SEPARATOR.join(parts)`."""
+    starts = []
+    position = 0
+    for part in parts:
+        starts.append(position)
+        position += len(part) + len(SEPARATOR)
+    return starts
+
+
+def _chunk_counts(positions: List[int], starts: List[int]) -> List[int]:
+    """Counts the match `positions` per chunk, given the chunk `starts` from `_offsets`."""
+    chunk_ids = np.searchsorted(np.asarray(starts), np.asarray(positions, dtype=np.int64), side="right") - 1
+    return np.bincount(chunk_ids, minlength=len(starts)).tolist()
+
+
+@lru_cache(maxsize=256)
+def _cached_scorer(components: Tuple[str, ...], title: str) -> ChunkScorer:
+    return ChunkScorer(components, title)
+
+
+def get_scorer(components: Sequence[str], title: str) -> ChunkScorer:
+    """Returns a compiled scorer, reused across calls with the same components and title."""
+    return _cached_scorer(tuple(components), title)
+
+
+def pack_chunks(scores: Sequence[Score], costs: Sequence[int], budget: int, steps: int = 500) -> List[int]:
+    """
+    Selects the chunks with the highest total score whose token costs fit a budget.
+
+    Solves the 0/1 knapsack problem by dynamic programming over the budget. Costs are
+    rounded up to `budget // steps` tokens, so the work stays at most `steps` cells
+    per chunk and the selection is guaranteed to fit.
+
+    Args:
+        scores (Sequence[Score]): The value of each chunk.
+        costs (Sequence[int]): The token cost of each chunk.
+        budget (int): The token budget.
+        steps (int): The resolution of the budget.
+
+    Returns:
+        List[int]: The indices of the selected chunks, in ascending order.
+    """
+    unit = max(1, budget // steps)
+    capacity = budget // unit
+    items = [i for i in range(len(scores)) if 0 < costs[i] <= budget and scores[i] > 0]
+    weights = [-(-costs[i] // unit) for i in items]
+
+    best = [0.0] * (capacity + 1)
+    taken = []
+    for k, i in enumerate(items):
+        weight, value = weights[k], scores[i]
+        row = bytearray(capacity + 1)
+        for c in range(capacity, weight - 1, -1):
+            candidate = best[c - weight] + value
+            if candidate > best[c]:
+                best[c] = candidate
+                row[c] = 1
+        taken.append(row)
+
+    selected = []
+    c = capacity
+    for k in range(len(items) - 1, -1, -1):
+        if taken[k][c]:
+            selected.append(items[k])
+            c -= weights[k]
+    return sorted(selected)
+
+
+# --- BM25 ranking ---
+# Okapi BM25 parameters: term frequency saturation and document length normalization.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Terms are lowercase runs of letters and digits; "-", ".", "/" and "+" inside a run
+# are kept, so part numbers like "bc847b-7" or "sot-23" stay one term.
+TERM_PATTERN = re.compile(r"[a-z0-9]+(?:[-./+][a-z0-9]+)*")
+
+# The ordering keywords of KEYWORD_PATTERN as single terms.
+ORDERING_TERMS = ("part", "number", "numbers", "type", "ordering", "marking", "markings",
+                  "package", "packages", "options", "product", "series")
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits a text into BM25 terms."""
+    return TERM_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Sparse term index over the chunks of one document, scored with Okapi BM25.
+
+    The index is kept as parallel NumPy arrays with one entry per (chunk, term) pair
+    that occurs, holding the term's BM25 weight in that chunk. Scoring a query is one
+    gather and one `bincount` over those arrays for all chunks at once. Unlike the
+    keyword counts of `score_chunk`, a term found in every chunk (e.g. "package" in a
+    package-heavy datasheet) weighs little, while rare ones such as the part numbers
+    of the ordering table weigh a lot.
+    """
+
+    def __init__(self, chunks: Sequence[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.vocabulary: Dict[str, int] = {}
+        term_ids: List[int] = []
+        counts = []
+        for chunk in chunks:
+            terms = tokenize(chunk)
+            counts.append(len(terms))
+            term_ids.extend(self.vocabulary.setdefault(term, len(self.vocabulary)) for term in terms)
+
+        self.num_chunks = len(chunks)
+        size = max(len(self.vocabulary), 1)
+        lengths = np.array(counts, dtype=np.float64)
+        doc_ids = np.repeat(np.arange(self.num_chunks, dtype=np.int64), counts)
+        unique, tf = np.unique(doc_ids * size + np.array(term_ids, dtype=np.int64), return_counts=True)
+        self._docs = unique // size
+        self._terms = unique % size
+
+        df = np.bincount(self._terms, minlength=size)
+        idf = np.log1p((self.num_chunks - df + 0.5) / (df + 0.5))
+        avg_length = lengths.mean() if self.num_chunks and lengths.mean() > 0 else 1.0
+        norm = k1 * (1 - b + b * lengths / avg_length)
+        self._weights = idf[self._terms] * tf * (k1 + 1) / (tf + norm[self._docs])
+
+    def score(self, query_terms: Sequence[str]) -> np.ndarray:
+        """
+        Scores every chunk against a query.
+
+        Args:
+            query_terms (Sequence[str]): The query terms; repeated terms count more.
+
+        Returns:
+            np.ndarray: One BM25 score per chunk.
+        """
+        query = np.zeros(max(len(self.vocabulary), 1))
+        for term, count in Counter(query_terms).items():
+            if term in self.vocabulary:
+                query[self.vocabulary[term]] = count
+        scores = np.zeros(self.num_chunks)
+        if self._docs.size:
+            scores += np.bincount(self._docs, weights=self._weights * query[self._terms], minlength=self.num_chunks)
+        return scores
+
+
+def bm25_query(components: Sequence[str], title: str) -> List[str]:
+    """
+    Builds the BM25 query of a document: the ordering keywords, the terms of the
+    anchor's component names, and the first word of the title (its part number).
+    """
+    terms = list(ORDERING_TERMS)
+    for component in components:
+        terms.extend(tokenize(component))
+    if len(title) >= 5:
+        terms.extend(tokenize(re.split(r"[_\s]", title, maxsplit=1)[0]))
+    return terms
+
+
+def bm25_scores(chunks: Sequence[str], components: Sequence[str], title: str) -> List[float]:
+    """
+    Scores all chunks of a document with BM25 against `bm25_query`.
+
+    Args:
+        chunks (Sequence[str]): The chunks.
+        components (Sequence[str]): The component names from the anchor.
+        title (str): The document title.
+
+    Returns:
+        List[float]: One score per chunk; 0 for chunks sharing no term with the query.
+    """
+    if not chunks:
+        return []
+    return BM25Index(chunks).score(bm25_query(components, title)).tolist()
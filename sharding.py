@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+
+from config import (LEASE_DB_PATH, LEASE_RENEW_SECONDS, LEASE_SECONDS, MERGED_OUTPUT_DIR, MPN_INDEX_ENABLED,
+                    NODE_OUTPUT_DIR)
+from job_ledger import FINISHED_STATUSES, JobLedger
+from mpn_index import MpnIndex
+from result_sink import BACKENDS, TABLES, mpn_index_path
+
+logger = logging.getLogger(__name__)
+
+# How several nodes split a shared documents directory.
+# "hash":  every node takes a fixed partition, `shard_of(name) == shard_index`.
+# "lease": nodes claim documents one by one through expiring leases in LEASE_DB_PATH.
+SHARD_MODES = ("hash", "lease")
+
+
+def shard_of(pdf_name: str, shard_count: int) -> int:
+    """Returns the hash partition of a document, stable across nodes and runs."""
+    digest = hashlib.sha1(pdf_name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def iter_hash_partition(pdfs: Iterable[Path], shard_index: int, shard_count: int) -> Iterator[Path]:
+    """
+    Yields the PDFs of one hash partition.
+
+    Args:
+        pdfs (Iterable[Path]): All PDFs.
+        shard_index (int): The partition of this node, 0 <= shard_index < shard_count.
+        shard_count (int): The number of nodes.
+
+    Yields:
+        Path: The PDFs this node owns.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is outside 0..{shard_count - 1}.")
+    for pdf in pdfs:
+        if shard_of(pdf.name, shard_count) == shard_index:
+            yield pdf
+
+
+class LeaseStore:
+    """
+    Expiring per-document leases in a SQLite database shared by all nodes.
+
+    A node processes a document only after `claim` succeeded. A lease lasts
+    `lease_seconds` and is renewed while the document is in flight; when a node dies,
+    its leases expire and another node takes the documents over. A finished document
+    keeps a permanent lease so no node processes it again.
+
+    SQLite on a network filesystem stands in for a real coordination service here:
+    it relies on the filesystem's locking, which NFS and SMB only provide when
+    configured for it.
+    """
+
+    def __init__(self, db_path: Path = LEASE_DB_PATH, node_id: str = "", lease_seconds: float = LEASE_SECONDS):
+        self.db_path = Path(db_path)
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        # Held leases and when they were claimed.
+        self.held: Dict[str, float] = {}
+        self.recovered = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each process opens its own lazily.
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None, check_same_thread=False)
+            # WAL needs shared memory, which does not work across machines; use a rollback journal.
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "pdf_name TEXT PRIMARY KEY, node TEXT NOT NULL, expires_at REAL NOT NULL, "
+                "done INTEGER NOT NULL DEFAULT 0, claims INTEGER NOT NULL DEFAULT 1)"
+            )
+        return self._conn
+
+    def claim(self, pdf_name: str) -> bool:
+        """
+        Tries to take the lease of a document.
+
+        Succeeds if nobody holds it, if this node already holds it, or if another
+        node's lease has expired (stale-lease recovery). Fails for finished documents.
+
+        Args:
+            pdf_name (str): The document name.
+
+        Returns:
+            bool: True if this node may process the document.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT node, expires_at, done FROM leases WHERE pdf_name = ?",
+                                   (pdf_name,)).fetchone()
+                if row is None:
+                    conn.execute("INSERT INTO leases (pdf_name, node, expires_at) VALUES (?, ?, ?)",
+                                 (pdf_name, self.node_id, now + self.lease_seconds))
+                elif row[2] or (row[0] != self.node_id and row[1] > now):
+                    conn.execute("COMMIT")
+                    return False
+                else:
+                    if row[0] != self.node_id:
+                        self.recovered += 1
+                        logger.warning(f"Taking over stale lease of {pdf_name} from node '{row[0]}'.")
+                    conn.execute("UPDATE leases SET node = ?, expires_at = ?, claims = claims + 1 WHERE pdf_name = ?",
+                                 (self.node_id, now + self.lease_seconds, pdf_name))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self.held[pdf_name] = now
+            return True
+
+    def renew(self):
+        """Extends every lease this node holds."""
+        if not self.held:
+            return
+        expires_at = time.time() + self.lease_seconds
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("UPDATE leases SET expires_at = ? WHERE pdf_name = ? AND node = ? AND done = 0",
+                             [(expires_at, name, self.node_id) for name in self.held])
+
+    def release(self, pdf_name: str, done: bool):
+        """
+        Gives a lease back: permanently for a finished document, otherwise so that
+        any node may retry it right away.
+        """
+        with self._lock:
+            conn = self._connection()
+            if done:
+                conn.execute("UPDATE leases SET done = 1 WHERE pdf_name = ? AND node = ?", (pdf_name, self.node_id))
+            else:
+                conn.execute("UPDATE leases SET expires_at = 0 WHERE pdf_name = ? AND node = ?",
+                             (pdf_name, self.node_id))
+            self.held.pop(pdf_name, None)
+
+    def sync_with_ledger(self, ledger: JobLedger):
+        """
+        Releases the leases of documents the local ledger has settled, and renews the rest.
+
+        Only outcomes of attempts started after the claim count, so an error left over
+        from an earlier run does not release a lease that was just taken.
+
+        Args:
+            ledger (JobLedger): The job ledger the workers of this node record outcomes in.
+        """
+        with self._lock:
+            names = list(self.held)
+        statuses = ledger.statuses(names)
+        for name, (status, started_at) in statuses.items():
+            if started_at is None or started_at < self.held.get(name, float("inf")):
+                continue
+            if status in FINISHED_STATUSES:
+                self.release(name, done=True)
+            elif status == "error":
+                self.release(name, done=False)
+        self.renew()
+
+
+def iter_leased(pdfs: Iterable[Path], store: LeaseStore) -> Iterator[Path]:
+    """Yields the PDFs whose lease this node obtained."""
+    for pdf in pdfs:
+        if store.claim(pdf.name):
+            yield pdf
+
+
+class LeaseKeeper:
+    """
+    Background thread that keeps the leases of a node alive.
+
+    Every LEASE_RENEW_SECONDS it releases the leases of documents that finished (as
+    recorded in the job ledger by the workers) and renews the others, so a long
+    document never loses its lease while its node is alive.
+    """
+
+    def __init__(self, store: LeaseStore, ledger: JobLedger, interval: float = LEASE_RENEW_SECONDS):
+        self.store = store
+        self.ledger = ledger
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+
+    def __enter__(self) -> "LeaseKeeper":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.store.sync_with_ledger(self.ledger)
+        # Anything still held was interrupted; let other nodes take it immediately.
+        for name in list(self.store.held):
+            self.store.release(name, done=False)
+        if self.store.recovered:
+            logger.info(f"Recovered {self.store.recovered} stale lease(s) from other nodes.")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.store.sync_with_ledger(self.ledger)
+            except Exception as e:
+                logger.warning(f"Lease renewal failed: {e}")
+
+
+def node_output_dir(node_id: str) -> Path:
+    """Returns the directory the outputs of one node of a sharded run are written to."""
+    return NODE_OUTPUT_DIR / node_id
+
+
+def merge_outputs(backend: str) -> Dict[str, int]:
+    """
+    Merges the per-node outputs of a sharded run into MERGED_OUTPUT_DIR.
+
+    The merged outputs are rebuilt from scratch on every call. Exact duplicate rows
+    (a document that was processed twice after a lease takeover) are written once.
+    With MPN_INDEX_ENABLED, the MPN index of the merged validated items is rebuilt too.
+
+    Args:
+        backend (str): The result sink backend the nodes wrote with.
+
+    Returns:
+        Dict[str, int]: The number of merged rows per table.
+    """
+    node_dirs = sorted(p for p in NODE_OUTPUT_DIR.iterdir() if p.is_dir()) if NODE_OUTPUT_DIR.exists() else []
+    shutil.rmtree(MERGED_OUTPUT_DIR, ignore_errors=True)
+    target = BACKENDS[backend](MERGED_OUTPUT_DIR)
+    counts = {}
+    try:
+        for table, columns in TABLES.items():
+            seen = set()
+            merged = []
+            for node_dir in node_dirs:
+                source = BACKENDS[backend](node_dir)
+                try:
+                    for row in source.read_rows(table):
+                        identity = tuple(str(row.get(c) or "") for c in columns)
+                        if identity not in seen:
+                            seen.add(identity)
+                            merged.append(row)
+                finally:
+                    source.close()
+            if merged:
+                target.write(table, merged)
+            counts[table] = len(merged)
+            if table == "validated_items" and MPN_INDEX_ENABLED:
+                index = MpnIndex(mpn_index_path(MERGED_OUTPUT_DIR))
+                try:
+                    index.rebuild(merged)
+                finally:
+                    index.close()
+    finally:
+        target.close()
+    logger.info(f"Merged the outputs of {len(node_dirs)} node(s) into {MERGED_OUTPUT_DIR}: {counts}")
+    return counts
@@ -0,0 +1,282 @@
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from groq import AsyncGroq, Groq
+from openai import AsyncOpenAI, OpenAI
+
+from config import ANCHOR_BEFORE_CONVERSION, ANCHOR_MODEL_NAME, MODEL_NAME, OCR_MODE
+from conversion import conversion_savings
+from dedup import get_dedup_store
+from graph_builder import build_graph
+from helpers import setup_converter
+from job_ledger import get_job_ledger, track_stage
+from json_repair import OUTCOMES, repair_stats
+from llm_cache import get_llm_cache
+from nodes import anchor_before_conversion, check_duplicate, finalize, load_and_split, save_skipped_component
+from result_sink import connect
+
+logger = logging.getLogger(__name__)
+
+# Long-lived, per-process resources, keyed by worker role. Populated once by
+# `init_worker` (or lazily on first use) and reused for every document.
+#   "full":       converters, LLM clients and the complete graph (single-stage mode).
+#   "conversion": the converters, and the anchor client with ANCHOR_BEFORE_CONVERSION
+#                 (conversion stage of the two-stage pipeline).
+#   "llm":        LLM clients and the graph without the load step (LLM stage).
+#   "async":      async LLM clients and the async graph without the load step.
+_RESOURCES: Dict[str, Dict[str, Any]] = {}
+# The LLM stage threads of `run_two_stage` share the resources of this process.
+_RESOURCES_LOCK = threading.Lock()
+_DOCUMENTS_LOCK = threading.Lock()
+
+
+def init_worker(gpu_queue=None, role: str = "full", result_queue=None):
+    """
+    Initializer for the worker processes of the ProcessPoolExecutor.
+
+    Pins the process to a GPU taken from `gpu_queue` and loads the resources of its
+    role once, so that the per-document work no longer pays model loading and graph
+    compilation.
+
+    Args:
+        gpu_queue: Optional multiprocessing queue holding the GPU ids to hand out,
+                   one per worker process.
+        role (str): Which resources to load ("full", "conversion", "llm" or "async").
+        result_queue: Optional queue of the `ResultSink` that output rows are sent to.
+    """
+    # Ctrl-C is handled by the parent, which drains the pool (see `install_drain_handler`).
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if result_queue is not None:
+        connect(result_queue)
+    gpu_id = None
+    if gpu_queue is not None:
+        try:
+            gpu_id = gpu_queue.get_nowait()
+        except queue.Empty:
+            gpu_id = None
+    if gpu_id is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
+    logger.info(f"Worker {os.getpid()} ({role}) starting up on GPU: {os.environ.get('CUDA_VISIBLE_DEVICES', 'default')}")
+    get_worker_resources(role)
+
+
+def get_worker_resources(role: str = "full") -> Dict[str, Any]:
+    """
+    Returns the warm resources of the current process, loading them on first use.
+
+    Args:
+        role (str): Which resources to load ("full", "conversion", "llm" or "async").
+
+    Returns:
+        Dict[str, Any]: The resources of the role (any of 'client', 'client_anchor',
+                        'converter', 'text_converter' and 'app'), plus the 'startup_seconds' it took
+                        to create them.
+    """
+    if role in _RESOURCES:
+        return _RESOURCES[role]
+    with _RESOURCES_LOCK:
+        if role in _RESOURCES:
+            return _RESOURCES[role]
+        start_time = time.time()
+        resources: Dict[str, Any] = {}
+        if role in ("full", "llm"):
+            resources["client"] = Groq()
+            resources["client_anchor"] = OpenAI()
+            resources["app"] = build_graph(include_conversion=(role == "full"))
+        if role == "async":
+            resources["client"] = AsyncGroq()
+            resources["client_anchor"] = AsyncOpenAI()
+            resources["app"] = build_graph(include_conversion=False, use_async=True)
+        if role in ("full", "conversion"):
+            resources["converter"] = setup_converter()
+            if OCR_MODE == "auto":
+                resources["text_converter"] = setup_converter(do_ocr=False)
+        if role == "conversion" and ANCHOR_BEFORE_CONVERSION:
+            resources["client_anchor"] = OpenAI()
+        resources["startup_seconds"] = time.time() - start_time
+        resources["documents_handled"] = 0
+        _RESOURCES[role] = resources
+        logger.info(f"Worker {os.getpid()} ({role}) warmed up in {resources['startup_seconds']:.2f} seconds.")
+    return _RESOURCES[role]
+
+
+def build_initial_state(pdf_path: Path, resources: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Builds the graph input state for a PDF from the warm resources of the process.
+
+    Args:
+        pdf_path (Path): The PDF to process.
+        resources (Dict[str, Any]): Resources returned by `get_worker_resources`.
+
+    Returns:
+        Dict[str, Any]: The initial state for the graph.
+    """
+    state = {
+        "pdf_path": str(pdf_path),
+        "title": pdf_path.stem,
+        "model_name": MODEL_NAME,
+        "anchor_model_name": ANCHOR_MODEL_NAME
+    }
+    for key in ("client", "client_anchor", "converter", "text_converter"):
+        if key in resources:
+            state[key] = resources[key]
+    return state
+
+
+def convert_single_pdf(pdf_path: Path, anchor: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Conversion stage of the two-stage pipeline: converts and chunks one PDF.
+
+    Checks for duplicates (`check_duplicate`), runs the early anchor step
+    (`anchor_before_conversion`) and, unless the document is skipped there,
+    `load_and_split` with the warm converter of the process. Duplicates and skipped
+    documents are recorded right here and never reach the LLM stage. Returns a
+    picklable state that the LLM stage can pick up.
+
+    Args:
+        pdf_path (Path): The PDF to convert.
+        anchor (Optional[Dict[str, Any]]): Anchor fields from the `AnchorBatcher`, if the
+                                           document was already classified.
+
+    Returns:
+        Dict[str, Any]: The state after `load_and_split`, without the converters and
+                        clients and with a 'timing' record. It has no 'markdown' if
+                        the PDF was already processed, a duplicate, skipped or the
+                        conversion failed.
+    """
+    resources = get_worker_resources("conversion")
+    start_time = time.time()
+    ledger = get_job_ledger()
+    if not ledger.is_finished(pdf_path.name):
+        ledger.start(pdf_path)
+    state = check_duplicate({**build_initial_state(pdf_path, resources), **(anchor or {})})
+    if state.get("duplicate_of"):
+        state = track_stage("finalize", finalize)(state)
+    else:
+        if "client_anchor" in state:
+            state = track_stage("anchor", anchor_before_conversion)(state)
+        if state.get("skip_reason"):
+            state = save_skipped_component(state)
+        else:
+            state = load_and_split(state)
+    for key in ("converter", "text_converter", "client_anchor"):
+        state.pop(key, None)
+    state["timing"] = record_document_timing(time.time() - start_time, "conversion")
+    return state
+
+
+def record_document_timing(seconds: float, role: str = "full") -> Dict[str, Any]:
+    """
+    Records the steady-state processing time of one document in the current process.
+
+    Args:
+        seconds (float): Wall-clock time spent on the document, excluding startup.
+        role (str): The role whose resources were used for the document.
+
+    Returns:
+        Dict[str, Any]: A picklable timing record to send back to the parent process.
+    """
+    resources = get_worker_resources(role)
+    with _DOCUMENTS_LOCK:
+        resources["documents_handled"] += 1
+        document_index = resources["documents_handled"]
+    return {
+        "pid": os.getpid(),
+        "role": role,
+        "startup_seconds": resources["startup_seconds"],
+        "document_seconds": seconds,
+        "document_index": document_index,
+        "llm_cache": get_llm_cache().stats(),
+        "json_repair": repair_stats(),
+        "conversion_savings": conversion_savings(),
+        "dedup": get_dedup_store().stats(),
+    }
+
+
+def report_timings(timings: List[Optional[Dict[str, Any]]]):
+    """
+    Logs a startup-vs-steady-state report from the timing records of all workers.
+
+    Args:
+        timings (List[Optional[Dict[str, Any]]]): Records returned by the workers;
+                                                   None entries are ignored.
+    """
+    timings = [t for t in timings if t]
+    if not timings:
+        logger.info("Timing report: no documents were processed.")
+        return
+
+    for role in sorted({t.get("role", "full") for t in timings}):
+        role_timings = [t for t in timings if t.get("role", "full") == role]
+        startup_by_pid = {t["pid"]: t["startup_seconds"] for t in role_timings}
+        startup_total = sum(startup_by_pid.values())
+        startup_mean = startup_total / len(startup_by_pid)
+        steady_total = sum(t["document_seconds"] for t in role_timings)
+        steady_mean = steady_total / len(role_timings)
+        # Without the warm pool every document would have paid the startup cost again.
+        saved = startup_mean * (len(role_timings) - len(startup_by_pid))
+
+        logger.info(f"--- Worker Timing Report ({role}) ---")
+        logger.info(f"  Workers started:          {len(startup_by_pid)}")
+        logger.info(f"  Documents processed:      {len(role_timings)}")
+        logger.info(f"  Startup (mean/total):     {startup_mean:.2f}s / {startup_total:.2f}s")
+        logger.info(f"  Per-document (mean):      {steady_mean:.2f}s")
+        logger.info(f"  Startup time saved (est): {saved:.2f}s")
+        logger.info("----------------------------")
+
+    # The cache counters are cumulative per process, so only the latest record of
+    # each process counts.
+    latest_by_pid = {}
+    for t in timings:
+        if t.get("llm_cache") and t["document_index"] >= latest_by_pid.get(t["pid"], {}).get("document_index", 0):
+            latest_by_pid[t["pid"]] = t
+    hits = sum(t["llm_cache"]["hits"] for t in latest_by_pid.values())
+    misses = sum(t["llm_cache"]["misses"] for t in latest_by_pid.values())
+    if hits or misses:
+        logger.info(f"LLM cache: {hits} hits, {misses} misses ({hits * 100 / (hits + misses):.1f}% hit rate).")
+
+    repairs = Counter()
+    for t in latest_by_pid.values():
+        repairs.update(t.get("json_repair", {}))
+    responses = sum(repairs[outcome] for outcome in OUTCOMES)
+    if responses:
+        logger.info(
+            f"JSON responses: {repairs['parsed']} valid, {repairs['repaired']} repaired and "
+            f"{repairs['salvaged']} salvaged locally, {repairs['llm']} sent to the LLM repair "
+            f"({repairs['llm'] * 100 / responses:.1f}%), {repairs['llm_failed']} still invalid."
+        )
+
+    # The counters of this (the main) process are taken as they are now rather than from
+    # its latest record: they also cover the `AnchorBatcher`, and in the two-stage and
+    # async modes the LLM stage records of this process would otherwise count twice.
+    worker_records = [t for pid, t in latest_by_pid.items() if pid != os.getpid()]
+
+    savings = Counter()
+    for t in worker_records:
+        savings.update(t.get("conversion_savings", {}))
+    savings.update(conversion_savings())
+    if savings["skipped_documents"]:
+        # Estimated from the mean conversion time per page of the documents that were converted.
+        per_page = savings["conversion_seconds"] / savings["converted_pages"] if savings["converted_pages"] else 0.0
+        logger.info(
+            f"Anchor before conversion: {savings['skipped_documents']} skipped document(s) with "
+            f"{savings['skipped_pages']} page(s) never converted, saving ~{savings['skipped_pages'] * per_page:.1f}s "
+            f"of conversion ({per_page:.2f}s per page over {savings['converted_pages']} converted page(s))."
+        )
+
+    duplicates = Counter()
+    for t in worker_records:
+        duplicates.update(t.get("dedup", {}))
+    duplicates.update(get_dedup_store().stats())
+    if duplicates:
+        logger.info(
+            f"Duplicates: {duplicates['exact']} identical and {duplicates['near']} near-identical document(s) "
+            f"reused the results of an earlier extraction."
+        )